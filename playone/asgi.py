@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'playone.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# 即時更新的SSE endpoint在Django前面處理
+from volleyball.live import live_application  # noqa: E402
+
+application = live_application(django_application)
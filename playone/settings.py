@@ -71,6 +71,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'volleyball.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -79,6 +80,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'volleyball.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'playone.urls'
@@ -108,13 +110,36 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # 測試用檔案資料庫，in-memory的shared cache不會等lock，併發測試會直接失敗
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
+# 唯讀副本的alias，列表/詳細頁從這裡讀。本機可設 PLAYONE_REPLICAS=2 用兩個SQLite檔模擬，
+# 再用 manage.py sync_replicas 從primary複製過去
+DATABASE_REPLICAS = []
+for n in range(1, int(os.environ.get('PLAYONE_REPLICAS', 0)) + 1):
+    DATABASES['replica%d' % n] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / ('db_replica%d.sqlite3' % n),
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+    DATABASE_REPLICAS.append('replica%d' % n)
+DATABASE_ROUTERS = ['volleyball.routers.ReplicaRouter']
+# 使用者寫入後幾秒內都從primary讀 (讀得到自己剛寫的)；副本連不上時停用幾秒；
+# 從副本讀出來的資料最多快取幾秒 (副本可能落後，不能用version stamp的長快取)
+REPLICA_STICKY_SECONDS = 5
+REPLICA_RETRY_AFTER = 30
+REPLICA_CACHE_TIMEOUT = 10
+
 AUTH_USER_MODEL = 'volleyball.Player'
 AUTHENTICATION_BACKENDS = [
     'volleyball.backends.EmailBackend',
-    'allauth.account.auth_backends.AuthenticationBackend',
+    'volleyball.backends.AccountBackend',
 ]
 
 LOGIN_URL = 'login'
@@ -169,12 +194,31 @@ TIME_FORMAT = '%H:%M'
 # pagination
 PAGINATE_BY = 10
 
+# 過期活動清理：每批最多更新幾筆，以及in-process背景清理的間隔秒數 (None = 不啟動，改用 manage.py expire_events)
+EVENT_EXPIRY_BATCH_SIZE = 500
+EVENT_EXPIRY_SWEEP_INTERVAL = None
+# 封存：打完超過幾天的活動搬到封存表 (manage.py archive_events)，每個transaction搬幾筆
+ARCHIVE_HORIZON_DAYS = 180
+ARCHIVE_BATCH_SIZE = 200
+# 通知outbox：manage.py send_notifications每批處理幾個收件人
+NOTIFICATION_BATCH_SIZE = 100
+# 通知排好之後等幾秒才由背景工作寄出，期間的通知併成一封
+NOTIFICATION_DRAIN_DELAY = 60
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+# 球場照片的衍生圖：各尺寸的寬度 (px)，背景產生的thread數，產生同一張圖時等待鎖的秒數
+IMAGE_SIZES = {
+    'thumb': 160,
+    'detail': 640,
+    'retina': 1280,
+}
+IMAGE_WORKERS = 2
+IMAGE_LOCK_TIMEOUT = 30
 
 # 讓控制台看的到寄出的email
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -218,5 +262,51 @@ CACHES = {
         # }
     }
 }
-# SESSION_ENGINE = "django.contrib.sessions.backends.cache"
-# SESSION_CACHE_ALIAS = "default"
\ No newline at end of file
+# 球場、球團列表快取秒數 (資料變動時會靠version stamp失效)
+LISTING_CACHE_TIMEOUT = 60 * 10
+# 球場地理索引重新載入的秒數 (其他worker新增的球場最晚多久看得到)，以及預設的附近距離
+COURT_INDEX_TTL = 60 * 5
+NEAR_DISTANCE_KM = 5
+# 附近搜尋的km上限，太大會掃過太多格子
+NEAR_MAX_DISTANCE_KM = 100
+# 球場自動完成最多回幾筆
+AUTOCOMPLETE_LIMIT = 10
+# 搜尋：每個查詢最多保留幾筆排序結果，熱門查詢結果快取秒數
+SEARCH_MAX_RESULTS = 200
+SEARCH_CACHE_TIMEOUT = 60 * 5
+# 首頁個人dashboard快取秒數
+DASHBOARD_CACHE_TIMEOUT = 60 * 10
+# 活動、球團頁面片段快取秒數 (靠version stamp失效)
+FRAGMENT_CACHE_TIMEOUT = 60 * 10
+# admin列表最多算到幾筆，超過就顯示估計值
+ADMIN_COUNT_LIMIT = 10000
+# 即時更新 (server-sent events，只在ASGI下提供)
+# 多個worker要互通時改用 'volleyball.live.FileSpoolBackend'
+LIVE_BACKEND = 'volleyball.live.LocalBackend'
+LIVE_URL_PREFIX = '/live/'
+LIVE_KEEPALIVE = 15
+LIVE_QUEUE_SIZE = 100
+LIVE_SPOOL_PATH = BASE_DIR / 'live.spool'
+LIVE_SPOOL_POLL_INTERVAL = 0.2
+LIVE_SPOOL_MAX_BYTES = 1 << 20
+# 同一個request裡同樣的SQL執行幾次以上視為可能的N+1；每隔幾秒把各view統計寫進log (None不寫)
+SQL_N_PLUS_ONE_THRESHOLD = 5
+METRICS_LOG_INTERVAL = 60
+
+# session先讀快取，沒有才查資料庫；登入的使用者也從快取拿 (volleyball.backends)
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'default'
+USER_CACHE_TIMEOUT = 60 * 60
+# 每個人參加的球團 (permissions.MembershipResolver)
+MEMBERSHIP_CACHE_TIMEOUT = 60 * 60
+# 背景工作 (volleyball.jobs, manage.py run_worker)
+JOB_WORKERS = 4
+JOB_BATCH_SIZE = 20
+# 一批要在這幾秒內跑完，不然會被當成worker掛了、交給別人
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 5
+# 失敗後等這麼久重試，每次加倍，最多等到MAX
+JOB_RETRY_BACKOFF = 10
+JOB_RETRY_BACKOFF_MAX = 60 * 60
+JOB_POLL_INTERVAL = 1
+JOB_DELETE_BATCH_SIZE = 200
\ No newline at end of file
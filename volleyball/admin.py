@@ -1,9 +1,52 @@
-from django.contrib import admin
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from django.core.paginator import Paginator
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Max
+from django.http import HttpResponseRedirect
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from .forms import PlayerChangeForm, PlayerCreationForm
-from .models import Player, Court, Group, Event
+from .models import Player, Court, Group, Event, Membership, Participation, Job
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Changelist paginator that never counts a whole large table: an unfiltered table is
+    estimated from planner statistics (PostgreSQL) or the id range, and a filtered one is
+    counted only up to ADMIN_COUNT_LIMIT rows.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        limit = settings.ADMIN_COUNT_LIMIT
+        if not queryset.query.where:
+            estimate = self.estimate(queryset)
+            if estimate > limit:
+                return estimate
+        return queryset.order_by()[:limit].count()
+
+    def estimate(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            return int(row[0]) if row else 0
+        # id是遞增的，刪掉的列不多時用最大id估計就夠了
+        return queryset.model._default_manager.aggregate(n=Max('pk'))['n'] or 0
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
 
 
 @admin.register(Player)
@@ -33,6 +76,141 @@ class PlayerAdmin(UserAdmin):
     ordering = ['email',]
 
 
-admin.site.register(Court)
-admin.site.register(Group)
-admin.site.register(Event)
\ No newline at end of file
+@admin.register(Court)
+class CourtAdmin(ScalableAdmin):
+    list_display = ('name', 'city', 'address')
+    list_filter = ('city',)
+    search_fields = ('name', 'address')
+    ordering = ['name']
+
+
+@admin.register(Group)
+class GroupAdmin(ScalableAdmin):
+    list_display = ('name', 'organizer', 'court', 'member_count', 'pending_count')
+    list_select_related = ('organizer', 'court')
+    autocomplete_fields = ('organizer', 'court')
+    search_fields = ('name',)
+    ordering = ['name']
+
+
+@admin.register(Event)
+class EventAdmin(ScalableAdmin):
+    list_display = ('__str__', 'initiator', 'group', 'is_public', 'is_expired', 'participant_count', 'player_quota')
+    list_filter = ('is_expired',)
+    date_hierarchy = 'play_date'
+    autocomplete_fields = ('initiator', 'court', 'group')
+    search_fields = ('court__name',)
+
+    def get_queryset(self, request):
+        # manager已經select_related了，changelist會略過list_select_related
+        return super().get_queryset(request).select_related('initiator')
+
+
+class CounterAdminMixin:
+    """Route adds and deletes through the model helpers so the denormalized counters stay in step."""
+
+    def get_readonly_fields(self, request, obj=None):
+        # 換活動/球團等於刪掉再新增，請直接那樣做
+        return self.owner_fields if obj else ()
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            self.delete_model(request, obj)
+
+
+class MembershipAdminForm(forms.ModelForm):
+    class Meta:
+        model = Membership
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        group, player = cleaned_data.get('group'), cleaned_data.get('player')
+        # Django 3.1的表單不會檢查UniqueConstraint
+        if (self.instance.pk is None and group is not None and player is not None
+                and Membership.objects.filter(group=group, player=player).exists()):
+            raise forms.ValidationError(_('This player is already in the group.'))
+        return cleaned_data
+
+
+@admin.register(Membership)
+class MembershipAdmin(CounterAdminMixin, ScalableAdmin):
+    owner_fields = ('group', 'player')
+    form = MembershipAdminForm
+    list_display = ('group', 'player', 'status')
+    list_select_related = ('group', 'player')
+    list_filter = ('status',)
+    autocomplete_fields = ('group', 'player')
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            obj.status, status = form.initial['status'], obj.status
+            obj.set_status(status)
+        else:
+            obj.pk = obj.group.add_member(obj.player, obj.status).pk
+
+    def delete_model(self, request, obj):
+        obj.remove()
+
+
+class ParticipationAdminForm(forms.ModelForm):
+    class Meta:
+        model = Participation
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        event = cleaned_data.get('event')
+        if self.instance.pk is None and event is not None:
+            if event.is_expired:
+                raise forms.ValidationError(_('This event has expired.'))
+            if event.is_full:
+                raise forms.ValidationError(_('This event is full.'))
+        return cleaned_data
+
+
+@admin.register(Participation)
+class ParticipationAdmin(CounterAdminMixin, ScalableAdmin):
+    owner_fields = ('event', 'player')
+    form = ParticipationAdminForm
+    list_display = ('id', 'event', 'player')
+    list_select_related = ('event__court', 'player')
+    autocomplete_fields = ('event', 'player')
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            # 表單檢查過之後可能剛好被別人報滿或過期
+            if not obj.event.add_participant(obj.player):
+                messages.error(request, _('This event is full or has expired.'))
+                return
+            obj.pk = Participation.objects.get(event=obj.event, player=obj.player).pk
+
+    def log_addition(self, request, obj, message):
+        if obj.pk is not None:
+            return super().log_addition(request, obj, message)
+
+    def response_add(self, request, obj, post_url_continue=None):
+        if obj.pk is None:
+            return HttpResponseRedirect(reverse('admin:volleyball_participation_add'))
+        return super().response_add(request, obj, post_url_continue)
+
+    def delete_model(self, request, obj):
+        obj.event.remove_participant(obj.player)
+
+
+@admin.register(Job)
+class JobAdmin(ScalableAdmin):
+    list_display = ('name', 'status', 'priority', 'run_at', 'attempts', 'max_attempts')
+    list_filter = ('status', 'name')
+    readonly_fields = ('claimed_by', 'locked_until', 'last_error', 'created_at')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        try:
+            with transaction.atomic():
+                queryset.filter(status=Job.FAILED).update(status=Job.QUEUED, run_at=timezone.now(), attempts=0,
+                                                          last_error='')
+        except IntegrityError:
+            self.message_user(request, _('The same job is already queued.'), messages.ERROR)
+
+    retry.short_description = _('Retry selected failed jobs')
@@ -0,0 +1,192 @@
+from datetime import datetime
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponseForbidden, JsonResponse
+from django.views.decorators.http import condition, require_safe
+
+from .caching import get_version, get_versions, make_key
+from .court_index import court_names
+from .models import Court, Event, Group, Participation
+from .pagination import InvalidCursor, KeysetPaginator
+from .routers import cache_timeout
+from .views import filter_events
+
+# 輸出的欄位名稱 -> values()的lookup；tuple代表組成全名
+COURT_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'city': 'city',
+    'address': 'address',
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+}
+GROUP_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'court': 'court_id',
+    'court_name': 'court__name',
+    'members': 'member_count',
+}
+GROUP_DETAIL_FIELDS = dict(
+    GROUP_FIELDS,
+    about='about',
+    organizer='organizer_id',
+    organizer_name=('organizer__first_name', 'organizer__last_name'),
+)
+EVENT_FIELDS = {
+    'id': 'id',
+    'date': 'play_date',
+    'time': 'play_start_time',
+    'court': 'court_id',
+    'court_name': 'court__name',
+    'group': 'group_id',
+    'quota': 'player_quota',
+    'participants': 'participant_count',
+}
+EVENT_DETAIL_FIELDS = dict(
+    EVENT_FIELDS,
+    is_public='is_public',
+    is_expired='is_expired',
+    initiator='initiator_id',
+    initiator_name=('initiator__first_name', 'initiator__last_name'),
+    court_detail='court_detail',
+    play_detail='play_detail',
+)
+
+
+def lookups(fields):
+    for source in fields.values():
+        yield from source if isinstance(source, tuple) else (source,)
+
+
+def serialize(row, fields):
+    return {
+        name: ('%s %s' % tuple(row[part] for part in source)).strip() if isinstance(source, tuple) else row[source]
+        for name, source in fields.items()
+    }
+
+
+def versioned(*stamps):
+    """
+    Conditional GET for an endpoint whose output only changes when one of `stamps` is bumped;
+    each stamp is formatted with the URL kwargs. The strong ETag and Last-Modified come from
+    the stamps alone, so answering 304 costs one cache read and no query.
+    """
+
+    def versions(request, **kwargs):
+        if not hasattr(request, '_api_versions'):
+            request._api_versions = get_versions(*[stamp % kwargs for stamp in stamps])
+        return request._api_versions
+
+    def etag(request, **kwargs):
+        return make_key('api', request.get_full_path(), *versions(request, **kwargs)).split(':', 1)[1]
+
+    def last_modified(request, **kwargs):
+        # stamp是毫秒時間
+        return datetime.utcfromtimestamp(max(versions(request, **kwargs)) / 1000)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+def paginated(request, queryset, fields, ordering):
+    paginator = KeysetPaginator(queryset.values(*lookups(fields)), settings.PAGINATE_BY, ordering)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor as e:
+        raise Http404(e)
+    return JsonResponse({
+        'results': [serialize(row, fields) for row in page.object_list],
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    })
+
+
+def detail(queryset, fields, pk):
+    row = queryset.filter(pk=pk).values(*lookups(fields)).first()
+    if row is None:
+        raise Http404
+    return serialize(row, fields)
+
+
+@require_safe
+@versioned('court-list')
+def court_list(request):
+    queryset = Court.objects.all()
+    if request.GET.get('city'):
+        try:
+            queryset = queryset.filter(city=int(request.GET['city']))
+        except ValueError:
+            raise Http404
+    return paginated(request, queryset, COURT_FIELDS, ['name'])
+
+
+@require_safe
+@versioned('court-list')
+def court_autocomplete(request):
+    results = court_names.search(request.GET.get('q', ''), settings.AUTOCOMPLETE_LIMIT)
+    return JsonResponse({'results': [{'id': pk, 'name': name, 'address': address} for pk, name, address in results]})
+
+
+@require_safe
+@versioned('court-list')
+def court_detail(request, pk):
+    return JsonResponse(detail(Court.objects.all(), COURT_FIELDS, pk))
+
+
+@require_safe
+@versioned('group-list', 'court-list')
+def group_list(request):
+    return paginated(request, Group.objects.all(), GROUP_FIELDS, ['name'])
+
+
+@require_safe
+@versioned('group:%(pk)d', 'court-list', 'player-names')
+def group_detail(request, pk):
+    return JsonResponse(detail(Group.objects.all(), GROUP_DETAIL_FIELDS, pk))
+
+
+@require_safe
+@versioned('event-list', 'event-expiry', 'court-list')
+def event_list(request):
+    queryset = filter_events(Event.objects.get_valid().get_public(), request.GET)
+    return paginated(request, queryset, EVENT_FIELDS, ['play_date', 'play_start_time'])
+
+
+def viewable_event(view):
+    """
+    Check the viewer may see event `pk` before the conditional GET, so a 304 is never an answer to
+    someone the event is hidden from. The fields the check needs are cached under the event's stamp,
+    which keeps a 304 free of queries.
+    """
+
+    @wraps(view)
+    def wrapper(request, pk):
+        key = make_key('event-visibility', pk, get_version('event:%d' % pk))
+        row = cache.get(key)
+        if row is None:
+            row = Event.objects.filter(pk=pk).values_list('is_public', 'initiator_id', 'group_id').first() or ()
+            # 跟權限資料一樣的期限
+            cache.set(key, row, cache_timeout(settings.MEMBERSHIP_CACHE_TIMEOUT))
+        if not row:
+            raise Http404
+        event = Event(id=pk, is_public=row[0], initiator_id=row[1], group_id=row[2])
+        if not event.is_viewable_by(request.user):
+            return HttpResponseForbidden()
+        return view(request, pk=pk)
+
+    return wrapper
+
+
+@require_safe
+@viewable_event
+@versioned('event:%(pk)d', 'event-expiry', 'court-list', 'player-names')
+def event_detail(request, pk):
+    data = detail(Event.objects.all(), EVENT_DETAIL_FIELDS, pk)
+    data['players'] = [
+        {'id': row['player_id'], 'name': ('%s %s' % (row['player__first_name'], row['player__last_name'])).strip()}
+        for row in Participation.objects.filter(event_id=pk).order_by('id')
+        .values('player_id', 'player__first_name', 'player__last_name')
+    ]
+    return JsonResponse(data)
@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_migrate
 
 
 class VolleyballConfig(AppConfig):
     name = 'volleyball'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .search import create_table
+        post_migrate.connect(create_table, sender=self)
+
+        if settings.EVENT_EXPIRY_SWEEP_INTERVAL:
+            from .expiry import start_sweeper
+            start_sweeper()
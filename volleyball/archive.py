@@ -0,0 +1,133 @@
+import logging
+import time
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import BooleanField, Value
+
+from . import search
+from .caching import bump_version
+from .models import Event, Participation, ArchivedEvent, ArchivedParticipation, Notification
+
+logger = logging.getLogger(__name__)
+
+EVENT_COLUMNS = ('id', 'initiator_id', 'group_id', 'is_public', 'court_id', 'court_detail', 'play_date',
+                 'play_start_time', 'player_quota', 'participant_count', 'play_detail')
+HISTORY_FIELDS = ('id', 'play_date', 'play_start_time', 'court__name', 'participant_count', 'player_quota', 'archived')
+
+
+def _delete(model, column, ids):
+    # 不經過Collector：不用逐筆送signal，已過期的活動也不在任何快取列表或即時頻道裡
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(column),
+            ', '.join(['%s'] * len(ids))), ids)
+
+
+def archive_events(horizon_days=None, batch_size=None, today=None):
+    """
+    Move expired events played more than `horizon_days` ago, with their participations, into
+    the archive tables. Each batch copies and deletes in one short transaction, so the write
+    lock is held briefly and an interrupted run can simply be started again.
+    Returns a list of (events, participations, seconds) per batch.
+    """
+    horizon_days = settings.ARCHIVE_HORIZON_DAYS if horizon_days is None else horizon_days
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    cutoff = (today or date.today()) - timedelta(days=horizon_days)
+    old = Event.objects.filter(is_expired=True, play_date__lt=cutoff).order_by().values(*EVENT_COLUMNS)
+    batches = []
+    while True:
+        started = time.monotonic()
+        with transaction.atomic():
+            events = list(old[:batch_size])
+            if not events:
+                break
+            ids = [event['id'] for event in events]
+            participations = list(Participation.objects.filter(event_id__in=ids).values('id', 'event_id', 'player_id'))
+            ArchivedEvent.objects.bulk_create([ArchivedEvent(**event) for event in events])
+            ArchivedParticipation.objects.bulk_create([ArchivedParticipation(**row) for row in participations])
+            _delete(Participation, 'event_id', ids)
+            _delete(Notification, 'event_id', ids)
+            _delete(Event, 'id', ids)
+            search.remove_ids('event', ids)
+        batches.append((len(events), len(participations), time.monotonic() - started))
+        logger.info('archived %d events and %d participations in %.3fs', *batches[-1])
+        # API的條件式GET還記著這些活動
+        bump_version(*['event:%d' % pk for pk in ids])
+        if len(events) < batch_size:
+            break
+    return batches
+
+
+def compact(using=DEFAULT_DB_ALIAS):
+    """
+    Give back the space archived rows left in the hot tables and refresh planner statistics.
+    Must run outside a transaction; SQLite rewrites the whole file, so run it off-peak.
+    """
+    connection = connections[using]
+    tables = [connection.ops.quote_name(model._meta.db_table)
+              for model in (Event, Participation, ArchivedEvent, ArchivedParticipation)]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('VACUUM')
+            cursor.execute('ANALYZE')
+        elif connection.vendor == 'postgresql':
+            for table in tables:
+                cursor.execute('VACUUM ANALYZE %s' % table)
+        else:
+            cursor.execute('ANALYZE TABLE %s' % ', '.join(tables))
+
+
+class UnionQuerySet:
+    """
+    The same values() query over several tables, read as one. filter() and order_by() are
+    applied to every part, so each still uses its own indexes, and the parts are combined
+    with UNION ALL only when sliced or iterated. Enough of the QuerySet API for KeysetPaginator.
+    """
+
+    def __init__(self, *parts, ordering=()):
+        self.parts = parts
+        self.ordering = ordering
+        self.model = parts[0].model
+
+    def filter(self, *args, **kwargs):
+        return UnionQuerySet(*[part.filter(*args, **kwargs) for part in self.parts], ordering=self.ordering)
+
+    def order_by(self, *fields):
+        return UnionQuerySet(*self.parts, ordering=fields)
+
+    def count(self):
+        return sum(part.count() for part in self.parts)
+
+    def union(self):
+        first, *rest = [part.order_by() for part in self.parts]
+        return first.union(*rest, all=True).order_by(*self.ordering)
+
+    def __getitem__(self, k):
+        return self.union()[k]
+
+    def __iter__(self):
+        return iter(self.union())
+
+
+def event_history(player=None, group=None, public_only=False):
+    """
+    Finished events, live or archived, as HISTORY_FIELDS dicts (`archived` tells which):
+    the ones `player` took part in, or those of `group`.
+    """
+    live = Event.objects.filter(is_expired=True)
+    archived = ArchivedEvent.objects.all()
+    if player is not None:
+        live = live.filter(participation__player=player)
+        archived = archived.filter(participations__player=player)
+    if group is not None:
+        live = live.filter(group=group)
+        archived = archived.filter(group=group)
+    if public_only:
+        live = live.filter(is_public=True)
+        archived = archived.filter(is_public=True)
+    return UnionQuerySet(
+        live.annotate(archived=Value(False, output_field=BooleanField())).values(*HISTORY_FIELDS),
+        archived.annotate(archived=Value(True, output_field=BooleanField())).values(*HISTORY_FIELDS),
+    )
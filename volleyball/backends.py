@@ -1,22 +1,41 @@
+from allauth.account.auth_backends import AuthenticationBackend
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from .caching import get_version, make_key
 
 UserModel = get_user_model()
 
 
-class EmailBackend(ModelBackend):
-    def authenticate(self, request, username=None, password=None):
-        print(username, password)
-        try:
-            player = UserModel.objects.get(email=username)
-            if player.check_password(password):
-                return player
-        except UserModel.DoesNotExist:
-            return None
-
-    # def get_user(self, user_id):
-    #     try:
-    #         user = UserModel.objects.get(pk=user_id)
-    #     except UserModel.DoesNotExist:
-    #         return None
-    #     return user if self.user_can_authenticate(user) else None
+def user_key(user_id):
+    return make_key('user', user_id, get_version('user:%s' % user_id))
+
+
+class CachedUserMixin:
+    """
+    Serve the session user from the cache instead of one Player query per request.
+    The entry is keyed by the 'user:<id>' stamp, bumped on every save of the player and on logout;
+    the cached row carries the password hash, so session verification still notices a password change.
+    """
+
+    def get_user(self, user_id):
+        key = user_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            try:
+                user = UserModel._default_manager.get(pk=user_id)
+            except UserModel.DoesNotExist:
+                return None
+            cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user if self.user_can_authenticate(user) else None
+
+
+class EmailBackend(CachedUserMixin, ModelBackend):
+    # ModelBackend.authenticate會用PlayerManager.get_by_natural_key，email不分大小寫
+    pass
+
+
+class AccountBackend(CachedUserMixin, AuthenticationBackend):
+    pass
@@ -0,0 +1,110 @@
+import math
+import statistics
+import time
+import tracemalloc
+from datetime import date, time as dtime, timedelta
+
+from django.db import connection, reset_queries
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import Player, Court, Group, Event
+
+# 每個情境: (名稱, 產生url的函式, 每次量測後要做的清理)
+SCENARIOS = [
+    ('index', lambda ctx: reverse('index'), None),
+    ('event_list', lambda ctx: reverse('event-list'), None),
+    ('event_detail', lambda ctx: reverse('event-detail', args=[ctx['event'].id]), None),
+    ('group_detail', lambda ctx: reverse('group-detail', args=[ctx['group'].id]), None),
+    ('group_roster', lambda ctx: reverse('group-roster', args=[ctx['group'].id, 'members']), None),
+    ('event_signup', lambda ctx: reverse('event-signup', args=[ctx['signup_event'].id]),
+     lambda ctx, client: client.get(reverse('event-quit', args=[ctx['signup_event'].id]))),
+]
+
+
+def percentile(values, pct):
+    # nearest-rank
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def prepare_context():
+    """Pick the heaviest objects in the current database to drive the scenarios."""
+    group = Group.objects.annotate(size=Count('membership')).order_by('-size').first()
+    player = Player.objects.get(pk=group.organizer_id)
+    event = (Event.objects.get_valid().get_public().annotate(size=Count('participation'))
+             .order_by('-size').first())
+    signup_event = Event.objects.create(
+        initiator=player, court=Court.objects.first(), player_quota=1000,
+        play_date=date.today() + timedelta(days=365), play_start_time=dtime(19, 0))
+    return {'player': player, 'group': group, 'event': event, 'signup_event': signup_event}
+
+
+def run_benchmarks(iterations=20, warmup=2, scenarios=None):
+    """
+    Drive each scenario through the test client as the organizer of the largest group.
+    Latency and query counts come from the measured iterations after warm-up; peak memory
+    from one extra request under tracemalloc, so tracing does not skew the timings.
+    """
+    ctx = prepare_context()
+    client = Client()
+    client.force_login(ctx['player'])
+    report = {}
+    for name, url, cleanup in SCENARIOS:
+        if scenarios and name not in scenarios:
+            continue
+        latencies, queries = [], []
+        for i in range(warmup + iterations):
+            # queries_log最多9000筆，滿了之後CaptureQueriesContext會算成0
+            reset_queries()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = client.get(url(ctx))
+                elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                raise RuntimeError('%s returned %d' % (name, response.status_code))
+            if i >= warmup:
+                latencies.append(elapsed * 1000)
+                queries.append(len(captured))
+            if cleanup:
+                cleanup(ctx, client)
+
+        tracemalloc.start()
+        client.get(url(ctx))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if cleanup:
+            cleanup(ctx, client)
+
+        report[name] = {
+            'queries': max(queries),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p90_ms': round(percentile(latencies, 90), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'peak_kb': round(peak / 1024, 1),
+        }
+    return report
+
+
+def compare(report, baseline, tolerance=0.5, timing=False):
+    """
+    Regressions of `report` against `baseline`: any extra query fails. With `timing`, p90
+    latency and peak memory may also grow by `tolerance` (a fraction) before failing; those
+    depend on the machine, so only compare them with a baseline recorded on the same one.
+    """
+    regressions = []
+    for name, result in report.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['queries'] > base['queries']:
+            regressions.append('%s: %d queries, baseline %d' % (name, result['queries'], base['queries']))
+        if not timing:
+            continue
+        for metric in ('p90_ms', 'peak_kb'):
+            if metric in base and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append('%s: %s %.1f, baseline %.1f' % (name, metric, result[metric], base[metric]))
+    return regressions
@@ -0,0 +1,106 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from .pagination import KeysetPaginationMixin, KeysetPage
+from .routers import cache_timeout
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def _version_key(name):
+    return 'version:%s' % name
+
+
+def get_version(name):
+    """
+    Version stamps live in the cache itself so every worker sharing the backend sees the same value.
+    They start from the current time in ms, so a stamp lost to eviction never comes back
+    with a value that old cache entries were keyed on.
+    """
+    return get_versions(name)[0]
+
+
+def get_versions(*names):
+    found = cache.get_many([_version_key(name) for name in names])
+    versions = []
+    for name in names:
+        key = _version_key(name)
+        if key not in found:
+            cache.add(key, _now(), None)
+            found[key] = cache.get(key, _now())
+        versions.append(found[key])
+    return versions
+
+
+def bump_version(*names):
+    def bump():
+        now = _now()
+        current = cache.get_many([_version_key(name) for name in names])
+        cache.set_many({
+            _version_key(name): max(now, current.get(_version_key(name), 0) + 1) for name in names
+        }, None)
+
+    # 先bump一次讓其他人馬上失效，commit後再bump一次，避免commit前被讀回舊資料
+    bump()
+    if connection.in_atomic_block:
+        transaction.on_commit(bump)
+
+
+def make_key(prefix, *parts):
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+    return '%s:%s' % (prefix, digest)
+
+
+def fragment_context(*names):
+    """
+    Context for `{% cache fragment_timeout '<name>' <id> fragment_version %}` blocks:
+    the fragment is re-rendered as soon as any of the named stamps is bumped.
+    """
+    return {
+        'fragment_version': '.'.join(str(version) for version in get_versions(*names)),
+        'fragment_timeout': cache_timeout(settings.FRAGMENT_CACHE_TIMEOUT),
+    }
+
+
+class CachedListingMixin(KeysetPaginationMixin):
+    """
+    Cache each keyset page of a ListView as plain tuples of `listing_fields`,
+    keyed by the listing's version stamp (or stamps). Rows reach the template as dicts.
+    """
+    listing_version = None
+    listing_fields = ('id', 'name')
+    listing_params = ()
+
+    def get_listing_version(self):
+        return self.listing_version
+
+    def get_listing_key(self, page_size):
+        # 可以是一個stamp或一組stamp
+        names = self.get_listing_version()
+        names = (names,) if isinstance(names, str) else tuple(names)
+        params = [self.request.GET.get(name, '') for name in (self.cursor_kwarg,) + tuple(self.listing_params)]
+        params += ['%s=%s' % item for item in sorted(self.kwargs.items())]
+        return make_key('listing', *names, *get_versions(*names), page_size, *params)
+
+    def paginate_queryset(self, queryset, page_size):
+        key = self.get_listing_key(page_size)
+        cached = cache.get(key)
+        if cached is None:
+            paginator, page, object_list, is_paginated = super().paginate_queryset(
+                queryset.values(*self.listing_fields), page_size)
+            cached = (
+                [tuple(row[field] for field in self.listing_fields) for row in object_list],
+                page.next_cursor, page.previous_cursor, paginator.count,
+            )
+            cache.set(key, cached, cache_timeout(settings.LISTING_CACHE_TIMEOUT))
+        else:
+            paginator = self.get_keyset_paginator(queryset, page_size)
+        rows, next_cursor, previous_cursor, paginator.count = cached
+        page = KeysetPage([dict(zip(self.listing_fields, row)) for row in rows], paginator, next_cursor, previous_cursor)
+        return paginator, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,42 @@
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .caching import bump_version
+from .models import Event, Group, Membership, Participation
+
+
+def _count(queryset, field):
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('id')).values('n')
+    ), 0)
+
+
+def recount_events():
+    """Repair Event.participant_count where it drifted from the participations. Returns rows fixed."""
+    actual = _count(Participation.objects.all(), 'event')
+    drifted = list(Event.objects.annotate(actual_count=actual).exclude(participant_count=F('actual_count'))
+                   .values_list('pk', 'initiator_id', 'group_id'))
+    if not drifted:
+        return 0
+    fixed = Event.objects.filter(pk__in=[pk for pk, _, _ in drifted]).update(participant_count=actual)
+    # 和signals.event_changed一樣的stamp，快取的頁面和API才會拿到修好的人數
+    names = {'event-list'}
+    for pk, initiator_id, group_id in drifted:
+        names.update(['event:%d' % pk, 'player:%d' % initiator_id])
+        if group_id:
+            names.add('group:%d' % group_id)
+    bump_version(*names)
+    return fixed
+
+
+def recount_groups():
+    """Repair Group.member_count / pending_count. Returns rows fixed."""
+    members = _count(Membership.objects.exclude(status=Membership.PENDING), 'group')
+    pending = _count(Membership.objects.filter(status=Membership.PENDING), 'group')
+    drifted = list(Group.objects.annotate(actual_members=members, actual_pending=pending).exclude(
+        Q(member_count=F('actual_members')) & Q(pending_count=F('actual_pending'))).values_list('pk', flat=True))
+    if not drifted:
+        return 0
+    fixed = Group.objects.filter(pk__in=drifted).update(member_count=members, pending_count=pending)
+    bump_version('group-list', *['group:%d' % pk for pk in drifted])
+    return fixed
@@ -0,0 +1,229 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+
+from .models import Court
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+WORD = re.compile(r'\w+')
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class CourtIndex:
+    """
+    In-process index over courts. Courts saved or deleted in this process are applied
+    incrementally by signals; the whole index is reloaded every COURT_INDEX_TTL seconds
+    to pick up changes made by other workers.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded_at = None
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > settings.COURT_INDEX_TTL:
+                self.clear()
+                for court in self.get_queryset():
+                    self.add(court)
+                self.loaded_at = time.monotonic()
+
+    def get_queryset(self):
+        return Court.objects.all()
+
+    def update(self, court):
+        with self.lock:
+            if self.loaded_at is not None:
+                self.remove(court.pk)
+                self.add(court)
+
+    def delete(self, pk):
+        with self.lock:
+            if self.loaded_at is not None:
+                self.remove(pk)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def clear(self):
+        raise NotImplementedError
+
+    def add(self, court):
+        raise NotImplementedError
+
+    def remove(self, pk):
+        raise NotImplementedError
+
+
+class GeoIndex(CourtIndex):
+    """Courts bucketed into a lat/lng grid, answering radius and city queries without touching the database."""
+    cell_size = 0.1  # 度，約11km
+
+    def get_queryset(self):
+        return Court.objects.values_list('pk', 'city', 'latitude', 'longitude').iterator()
+
+    def clear(self):
+        self.points = {}
+        self.cells = defaultdict(set)
+        self.cities = defaultdict(set)
+        # 有球場的格子範圍 (min_i, min_j, max_i, max_j)；查詢的格子不會超出這裡
+        self.bounds = None
+
+    def add(self, court):
+        if isinstance(court, Court):
+            court = (court.pk, court.city, court.latitude, court.longitude)
+        pk, city, latitude, longitude = court
+        if city is not None:
+            self.cities[city].add(pk)
+        if latitude is not None and longitude is not None:
+            self.points[pk] = (latitude, longitude)
+            i, j = self.cell(latitude, longitude)
+            self.cells[i, j].add(pk)
+            if self.bounds is None:
+                self.bounds = (i, j, i, j)
+            else:
+                min_i, min_j, max_i, max_j = self.bounds
+                self.bounds = (min(min_i, i), min(min_j, j), max(max_i, i), max(max_j, j))
+
+    def remove(self, pk):
+        for ids in self.cities.values():
+            ids.discard(pk)
+        point = self.points.pop(pk, None)
+        if point:
+            self.cells[self.cell(*point)].discard(pk)
+
+    def cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size))
+
+    def within(self, latitude, longitude, km):
+        """[(court id, distance km)] of courts within `km` of the point, nearest first."""
+        self.ensure_loaded()
+        lat_span = km / KM_PER_DEGREE
+        lng_span = km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        min_lat, min_lng = self.cell(latitude - lat_span, longitude - lng_span)
+        max_lat, max_lng = self.cell(latitude + lat_span, longitude + lng_span)
+        hits = []
+        with self.lock:
+            if self.bounds is None:
+                return hits
+            min_lat, min_lng = max(min_lat, self.bounds[0]), max(min_lng, self.bounds[1])
+            max_lat, max_lng = min(max_lat, self.bounds[2]), min(max_lng, self.bounds[3])
+            for i in range(min_lat, max_lat + 1):
+                for j in range(min_lng, max_lng + 1):
+                    for pk in self.cells.get((i, j), ()):
+                        distance = haversine(latitude, longitude, *self.points[pk])
+                        if distance <= km:
+                            hits.append((pk, distance))
+        hits.sort(key=lambda hit: hit[1])
+        return hits
+
+    def nearest(self, latitude, longitude, limit=1, max_km=50):
+        return self.within(latitude, longitude, max_km)[:limit]
+
+    def in_city(self, city):
+        self.ensure_loaded()
+        with self.lock:
+            return sorted(self.cities.get(city, ()))
+
+
+def normalize(text):
+    """Case- and width-folded words of `text` joined by single spaces."""
+    return ' '.join(WORD.findall(unicodedata.normalize('NFKC', text or '').casefold()))
+
+
+def grams(word):
+    # 單一字元的查詢用unigram，其他用bigram；中文沒有空白分詞，bigram才找得到中間的字
+    if len(word) == 1:
+        return [word]
+    return [word[i:i + 2] for i in range(len(word) - 1)]
+
+
+class NameIndex(CourtIndex):
+    """
+    Court names and addresses for autocomplete. A sorted list of names answers prefix queries;
+    a unigram/bigram index finds matches anywhere in the name or address. Candidates are
+    confirmed with a substring check, so results are exact and no query hits the database.
+    """
+
+    def get_queryset(self):
+        return Court.objects.values_list('pk', 'name', 'address').iterator()
+
+    def clear(self):
+        self.courts = {}
+        self.names = []
+        self.grams = defaultdict(set)
+
+    def add(self, court):
+        if isinstance(court, Court):
+            court = (court.pk, court.name, court.address)
+        pk, name, address = court
+        key = normalize(name)
+        text = ('%s %s' % (key, normalize(address))).strip()
+        self.courts[pk] = (name, address, key, text)
+        bisect.insort(self.names, (key, pk))
+        for word in text.split():
+            for gram in set(word) | set(grams(word)):
+                self.grams[gram].add(pk)
+
+    def remove(self, pk):
+        court = self.courts.pop(pk, None)
+        if court is None:
+            return
+        name, address, key, text = court
+        del self.names[bisect.bisect_left(self.names, (key, pk))]
+        for word in text.split():
+            for gram in set(word) | set(grams(word)):
+                ids = self.grams.get(gram)
+                if ids is not None:
+                    ids.discard(pk)
+                    if not ids:
+                        del self.grams[gram]
+
+    def get(self, pk):
+        """(name, address) of a court, or None."""
+        self.ensure_loaded()
+        with self.lock:
+            court = self.courts.get(pk)
+            return court[:2] if court else None
+
+    def search(self, query, limit=10):
+        """[(court id, name, address)] containing every word of `query`; names starting with it come first."""
+        query = normalize(query)
+        if not query:
+            return []
+        self.ensure_loaded()
+        with self.lock:
+            hits = []
+            start = bisect.bisect_left(self.names, (query,))
+            for key, pk in self.names[start:start + limit]:
+                if not key.startswith(query):
+                    break
+                hits.append(pk)
+
+            words = query.split()
+            candidates = set.intersection(*[self.grams.get(gram, set()) for word in words for gram in grams(word)])
+            candidates.difference_update(hits)
+            matches = (pk for pk in candidates if all(word in self.courts[pk][3] for word in words))
+            # 名稱裡有的排在只有地址有的前面
+            hits += heapq.nsmallest(limit - len(hits), matches,
+                                    key=lambda pk: (query not in self.courts[pk][2], self.courts[pk][2], pk))
+            return [(pk,) + self.courts[pk][:2] for pk in hits]
+
+
+court_index = GeoIndex()
+court_names = NameIndex()
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, Q
+
+from .caching import get_versions, make_key
+from .models import Event, Membership, Participation
+
+
+def get_dashboard(player):
+    """
+    "My events", "my groups" and "my group events" for the home page, cached per player.
+    The key carries the player's version stamp (bumped on their Participation/Membership
+    changes), the stamps of their groups (bumped on group events) and the expiry stamp.
+    """
+    group_ids = cache.get(make_key('dashboard-groups', player.id, *get_versions('player:%d' % player.id)))
+    if group_ids is not None:
+        dashboard = cache.get(make_key('dashboard', player.id, *_get_dashboard_versions(player, group_ids)))
+        if dashboard is not None:
+            return dashboard
+
+    dashboard = build_dashboard(player)
+    group_ids = [group['id'] for group in dashboard['groups']]
+    versions = _get_dashboard_versions(player, group_ids)
+    cache.set_many({
+        make_key('dashboard-groups', player.id, versions[0]): group_ids,
+        make_key('dashboard', player.id, *versions): dashboard,
+    }, settings.DASHBOARD_CACHE_TIMEOUT)
+    return dashboard
+
+
+def _get_dashboard_versions(player, group_ids):
+    return get_versions('player:%d' % player.id, 'event-expiry', 'court-list', *['group:%d' % pk for pk in group_ids])
+
+
+def build_dashboard(player):
+    # 1: 有加入的球團
+    memberships = Membership.objects.filter(player=player).exclude(status=Membership.PENDING).select_related('group')
+    groups = [m.group for m in memberships]
+    group_ids = {group.id for group in groups}
+
+    # 2: 自己發起、有報名、或是球團的活動，用EXISTS取代JOIN + DISTINCT
+    joined = Participation.objects.filter(event=OuterRef('pk'), player=player)
+    events = Event.objects.get_valid().annotate(joined=Exists(joined)).filter(
+        Q(joined=True) | Q(initiator=player) | Q(group__in=group_ids)
+    )
+
+    dashboard = {'events': [], 'groups': [{'id': group.id, 'name': group.name} for group in groups], 'group_events': []}
+    for event in events:
+        if event.joined or event.initiator_id == player.id:
+            dashboard['events'].append({'id': event.id, 'label': str(event)})
+        if event.group_id in group_ids:
+            dashboard['group_events'].append({'id': event.id, 'label': str(event), 'group': event.group.name})
+    return dashboard
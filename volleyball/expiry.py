@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from . import search
+from .caching import bump_version
+from .models import Event
+
+logger = logging.getLogger(__name__)
+
+
+def expire_past_events(batch_size=None, now=None):
+    """
+    Set is_expired on events whose start time has passed.
+    Each batch is a single bounded UPDATE so the SQLite write lock is only held briefly.
+    Returns a list of (rows expired, seconds) per batch.
+    """
+    batch_size = batch_size or settings.EVENT_EXPIRY_BATCH_SIZE
+    now = now or datetime.now()
+    past = Event.objects.get_valid().filter(
+        Q(play_date__lt=now.date()) | Q(play_date=now.date(), play_start_time__lte=now.time())
+    )
+    batches = []
+    while True:
+        started = time.monotonic()
+        ids = list(past.values_list('pk', flat=True)[:batch_size])
+        count = Event.objects.filter(pk__in=ids).update(is_expired=True) if ids else 0
+        if not count:
+            break
+        # update()不會觸發signal，過期的活動自己從搜尋索引拿掉
+        search.remove_ids('event', ids)
+        batches.append((count, time.monotonic() - started))
+        logger.info('expired %d events in %.3fs', count, batches[-1][1])
+        if count < batch_size:
+            break
+    if batches:
+        bump_version('event-expiry')
+    return batches
+
+
+class ExpirySweeper(threading.Thread):
+    """Run expire_past_events every `interval` seconds in a daemon thread."""
+
+    def __init__(self, interval):
+        super().__init__(name='event-expiry-sweeper', daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                expire_past_events()
+            except Exception:
+                logger.exception('event expiry sweep failed')
+            finally:
+                connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper(interval=None):
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _sweeper = ExpirySweeper(interval or settings.EVENT_EXPIRY_SWEEP_INTERVAL)
+            _sweeper.start()
+    return _sweeper
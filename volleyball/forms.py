@@ -4,8 +4,10 @@ from django.conf import settings
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django import forms
 from django.forms import DateInput
+from django.urls import reverse_lazy
 
-from .models import Player, Event
+from .court_index import court_names
+from .models import Player, Group, Event
 
 
 class PlayerCreationForm(UserCreationForm):
@@ -26,11 +28,44 @@ class PlayerChangeForm(UserChangeForm):
         }
 
 
+class CourtAutocomplete(forms.Widget):
+    """
+    Text box suggesting courts from the autocomplete endpoint instead of a <select> of every
+    court; submits the chosen court id, which ModelChoiceField checks with one pk lookup.
+    """
+    template_name = 'volleyball/widgets/court_autocomplete.html'
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        try:
+            court = court_names.get(int(value))
+        except (TypeError, ValueError):
+            court = None
+        context['widget'].update({
+            'label': '%s (%s)' % court if court else '',
+            'url': reverse_lazy('api-court-autocomplete'),
+        })
+        return context
+
+    def id_for_label(self, id_):
+        return '%s_text' % id_ if id_ else id_
+
+
+class GroupCreateForm(forms.ModelForm):
+    class Meta:
+        model = Group
+        fields = ['name', 'court', 'about']
+        widgets = {
+            'court': CourtAutocomplete(),
+        }
+
+
 class EventCreateForm(forms.ModelForm):
     class Meta:
         model = Event
         fields = ['court', 'court_detail', 'play_date', 'play_start_time', 'player_quota', 'play_detail']
         widgets = {
+            'court': CourtAutocomplete(),
             'play_date': DateInput(format=settings.DATE_FORMAT, attrs={'type': 'date', 'value': datetime.today().strftime(settings.DATE_FORMAT)},),
             'play_start_time': DateInput(format=settings.TIME_FORMAT, attrs={'type': 'time', 'value': datetime.now().strftime(settings.TIME_FORMAT)},),
         }
@@ -41,6 +76,7 @@ class GroupEventCreateForm(forms.ModelForm):
         model = Event
         fields = ['court', 'court_detail', 'play_date', 'play_start_time', 'player_quota', 'is_public', 'play_detail']
         widgets = {
+            'court': CourtAutocomplete(),
             'play_date': DateInput(format=settings.DATE_FORMAT, attrs={'type': 'date', 'value': datetime.today().strftime(settings.DATE_FORMAT)},),
             'play_start_time': DateInput(format=settings.TIME_FORMAT, attrs={'type': 'time', 'value': datetime.now().strftime(settings.TIME_FORMAT)},),
         }
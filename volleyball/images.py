@@ -0,0 +1,156 @@
+import hashlib
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# 格式 -> (副檔名, Pillow的格式名稱, 存檔參數)
+FORMATS = {
+    'jpeg': ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+}
+EXTENSIONS = {extension: fmt for fmt, (extension, _, _) in FORMATS.items()}
+
+_executor = None
+_executor_lock = threading.Lock()
+_locks = {}
+_locks_lock = threading.Lock()
+# 這個process已經確認存在的衍生圖，不用每次都問storage
+_generated = set()
+
+
+def photo_hash(photo):
+    """Hex digest of an uploaded photo's content, read in chunks."""
+    digest = hashlib.sha1()
+    for chunk in photo.chunks():
+        digest.update(chunk)
+    photo.seek(0)
+    return digest.hexdigest()
+
+
+def derivative_name(digest, width, fmt):
+    # 名稱由原圖內容和尺寸決定，內容不變網址就不變，可以永久快取
+    return 'derivatives/%s/%s-%dw.%s' % (digest[:2], digest, width, FORMATS[fmt][0])
+
+
+def _load(source):
+    with default_storage.open(source) as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        image.load()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _render(image, name, width, fmt):
+    image = image.copy()
+    # 等比例縮到寬度width，比原圖大就不放大
+    image.thumbnail((width, width * 10), Image.LANCZOS)
+    buffer = io.BytesIO()
+    extension, format_name, options = FORMATS[fmt]
+    image.save(buffer, format_name, **options)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+class _DerivativeLock:
+    """
+    One generator per derivative: a lock per name within the process, and a cache key
+    across workers (waiters poll until the file shows up or the holder gives up).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = 'image-lock:%s' % name
+        with _locks_lock:
+            self.lock = _locks.setdefault(name, threading.Lock())
+
+    def __enter__(self):
+        self.lock.acquire()
+        deadline = time.monotonic() + settings.IMAGE_LOCK_TIMEOUT
+        while True:
+            self.acquired = cache.add(self.key, True, settings.IMAGE_LOCK_TIMEOUT)
+            if self.acquired or default_storage.exists(self.name) or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc_info):
+        # 沒拿到的話那個key是別的worker的，不能刪
+        if self.acquired:
+            cache.delete(self.key)
+        with _locks_lock:
+            _locks.pop(self.name, None)
+        self.lock.release()
+
+
+def ensure_derivative(source, digest, width, fmt, image=None):
+    """Storage name of one derivative of `source`, rendering it first if it does not exist yet."""
+    name = derivative_name(digest, width, fmt)
+    if name in _generated:
+        return name
+    with _DerivativeLock(name):
+        if not default_storage.exists(name):
+            _render(_load(source) if image is None else image, name, width, fmt)
+            logger.info('rendered %s', name)
+    _generated.add(name)
+    return name
+
+
+def derivative_url(source, digest, size, fmt='jpeg'):
+    """
+    URL of a derivative for templates: the media file when it exists, otherwise the view
+    that renders it on first request. Photos from before hashing fall back to the original.
+    """
+    if not digest:
+        return default_storage.url(str(source))
+    width = settings.IMAGE_SIZES[size]
+    name = derivative_name(digest, width, fmt)
+    if name in _generated or default_storage.exists(name):
+        _generated.add(name)
+        return default_storage.url(name)
+    return reverse('court-photo', args=[digest, width, FORMATS[fmt][0]])
+
+
+def generate_derivatives(source, digest):
+    """Render every size in every format, decoding the original once."""
+    image = None
+    for width in sorted(set(settings.IMAGE_SIZES.values())):
+        for fmt in FORMATS:
+            if derivative_name(digest, width, fmt) not in _generated:
+                if image is None:
+                    image = _load(source)
+                ensure_derivative(source, digest, width, fmt, image)
+
+
+def _generate(source, digest):
+    try:
+        generate_derivatives(source, digest)
+    except Exception:
+        logger.exception('rendering derivatives of %s failed', source)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix='images')
+    return _executor
+
+
+def schedule_derivatives(source, digest):
+    """Render derivatives in the background once the upload is committed."""
+    transaction.on_commit(lambda: get_executor().submit(_generate, source, digest))
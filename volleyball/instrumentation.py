@@ -0,0 +1,244 @@
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\bIN \((?:\s*(?:%s|\?)\s*,?)+\)', re.IGNORECASE)
+SPACES = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """Normalize a statement so the same query with different values compares equal."""
+    sql = STRING.sub('?', sql)
+    sql = NUMBER.sub('?', sql)
+    sql = IN_LIST.sub('IN (...)', sql)
+    return SPACES.sub(' ', sql).strip()
+
+
+def call_site():
+    """First frame of project code (outside site-packages and this module) on the current stack."""
+    here = os.path.abspath(__file__)
+    base = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(base) and filename != here and 'site-packages' not in filename:
+            return '%s:%d in %s' % (os.path.relpath(filename, base), frame.lineno, frame.name)
+    return None
+
+
+class Histogram:
+    """Fixed-bucket histogram; percentiles are the upper bound of the bucket they fall in."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        rank = pct / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 3) if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': round(self.max, 3),
+            'buckets': dict(zip([str(b) for b in self.bounds] + ['inf'], self.counts)),
+        }
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.latency_ms = Histogram(LATENCY_BUCKETS)
+        self.sql_ms = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.errors = 0
+
+
+class DatabaseMetrics:
+    """Per-request query count and SQL time on one database alias, plus failed statements."""
+
+    def __init__(self):
+        self.sql_ms = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.errors = 0
+
+
+class Registry:
+    """Process-wide aggregates, keyed by view name. Each worker keeps its own."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.databases = {}
+            self.suspects = {}
+            self.started_at = time.time()
+            self.logged_at = time.monotonic()
+
+    def record(self, view, latency_ms, sql_ms, queries, status_code, suspects, databases=None):
+        with self.lock:
+            for alias, (count, duration_ms, errors) in (databases or {}).items():
+                database = self.databases.get(alias)
+                if database is None:
+                    database = self.databases[alias] = DatabaseMetrics()
+                database.queries.observe(count)
+                database.sql_ms.observe(duration_ms)
+                database.errors += errors
+            metrics = self.views.get(view)
+            if metrics is None:
+                metrics = self.views[view] = ViewMetrics()
+            metrics.latency_ms.observe(latency_ms)
+            metrics.sql_ms.observe(sql_ms)
+            metrics.queries.observe(queries)
+            if status_code >= 500:
+                metrics.errors += 1
+            for sql, (count, site) in suspects.items():
+                suspect = self.suspects.setdefault((view, sql), {'requests': 0, 'max_repeats': 0, 'call_site': site})
+                suspect['requests'] += 1
+                suspect['max_repeats'] = max(suspect['max_repeats'], count)
+                suspect['call_site'] = site or suspect['call_site']
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'since': self.started_at,
+                'views': {
+                    view: {
+                        'latency_ms': metrics.latency_ms.snapshot(),
+                        'sql_ms': metrics.sql_ms.snapshot(),
+                        'queries': metrics.queries.snapshot(),
+                        'errors': metrics.errors,
+                    } for view, metrics in sorted(self.views.items())
+                },
+                'databases': {
+                    alias: {
+                        'sql_ms': metrics.sql_ms.snapshot(),
+                        'queries': metrics.queries.snapshot(),
+                        'errors': metrics.errors,
+                    } for alias, metrics in sorted(self.databases.items())
+                },
+                'n_plus_one': [
+                    dict(suspect, view=view, sql=sql)
+                    for (view, sql), suspect in sorted(self.suspects.items(), key=lambda item: -item[1]['requests'])
+                ],
+            }
+
+    def maybe_log(self):
+        interval = settings.METRICS_LOG_INTERVAL
+        if not interval or time.monotonic() - self.logged_at < interval:
+            return
+        with self.lock:
+            if time.monotonic() - self.logged_at < interval:
+                return
+            self.logged_at = time.monotonic()
+            lines = [
+                (view, metrics.latency_ms.count, metrics.latency_ms.percentile(50), metrics.latency_ms.percentile(99),
+                 metrics.queries.percentile(90), metrics.sql_ms.percentile(90), metrics.errors)
+                for view, metrics in sorted(self.views.items())
+            ]
+        for line in lines:
+            logger.info('%s requests=%d p50=%sms p99=%sms queries_p90=%s sql_p90=%sms errors=%d', *line)
+
+
+registry = Registry()
+
+
+class QueryRecorder:
+    """execute_wrapper counting statements and SQL time for one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+        self.call_sites = {}
+        # alias -> [查詢數, 秒數, 失敗數]
+        self.databases = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        database = self.databases.setdefault(context['connection'].alias, [0, 0.0, 0])
+        try:
+            return execute(sql, params, many, context)
+        except Exception:
+            database[2] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.duration += elapsed
+            self.count += 1
+            database[0] += 1
+            database[1] += elapsed
+            key = fingerprint(sql)
+            self.fingerprints[key] += 1
+            # 只在剛達到門檻時抓一次stack，平常不付這個成本
+            if self.fingerprints[key] == settings.SQL_N_PLUS_ONE_THRESHOLD:
+                self.call_sites[key] = call_site()
+
+    def suspects(self):
+        return {sql: (count, self.call_sites.get(sql)) for sql, count in self.fingerprints.items()
+                if count >= settings.SQL_N_PLUS_ONE_THRESHOLD}
+
+
+class InstrumentationMiddleware:
+    """Record latency, query count and SQL time per view, and flag repeated statements as N+1 suspects."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        status_code = 500
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(recorder))
+                response = self.get_response(request)
+            status_code = response.status_code
+            return response
+        finally:
+            latency = (time.perf_counter() - started) * 1000
+            match = getattr(request, 'resolver_match', None)
+            view = match.view_name if match else '<unresolved>'
+            suspects = recorder.suspects()
+            for sql, (count, site) in suspects.items():
+                logger.warning('possible N+1 in %s: %d x %s (%s)', view, count, sql, site)
+            databases = {alias: (count, duration * 1000, errors)
+                         for alias, (count, duration, errors) in recorder.databases.items()}
+            registry.record(view, latency, recorder.duration * 1000, recorder.count, status_code, suspects, databases)
+            registry.maybe_log()
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .caching import make_key
+from .models import ArchivedEvent, Event, Group, Job, Membership, Notification
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'jobs:stats'
+DONE, RETRY, FAILED = 'done', 'retry', 'failed'
+# enqueue()撞到unique又找不到排隊中的那筆時，最多重試幾次
+ENQUEUE_ATTEMPTS = 3
+
+
+def job(priority=0, max_attempts=None, unique=False):
+    """
+    Register a function as a background job: `func.enqueue(*args, **kwargs)` queues a call
+    instead of running it, `func.schedule(run_at, *args, **kwargs)` queues it for later.
+    Arguments must be JSON-serializable. With `unique`, a call with the same arguments that is
+    still waiting absorbs the new one.
+    """
+
+    def decorator(func):
+        name = '%s.%s' % (func.__module__, func.__name__)
+
+        def schedule(run_at, *args, **kwargs):
+            dedup_key = make_key('job', name, json.dumps([args, kwargs], sort_keys=True)) if unique else None
+            return enqueue(name, args, kwargs, priority=priority, run_at=run_at, max_attempts=max_attempts,
+                           dedup_key=dedup_key)
+
+        func.job_name = name
+        func.schedule = schedule
+        func.enqueue = lambda *args, **kwargs: schedule(None, *args, **kwargs)
+        return func
+
+    return decorator
+
+
+def enqueue(name, args=(), kwargs=None, priority=0, run_at=None, max_attempts=None, dedup_key=None):
+    """
+    Queue a call of the job `name` (dotted path). Inside a transaction the row commits with it,
+    so a worker never sees a job for data that was rolled back. Returns the queued Job, or the
+    one already waiting under `dedup_key`.
+    """
+    job = Job(name=name, args=list(args), kwargs=kwargs or {}, priority=priority, run_at=run_at or timezone.now(),
+              max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS, dedup_key=dedup_key)
+    if dedup_key is None:
+        job.save()
+        return job
+    for attempt in range(ENQUEUE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                job.save()
+            return job
+        except IntegrityError:
+            existing = Job.objects.filter(dedup_key=dedup_key, status=Job.QUEUED).first()
+            if existing is not None:
+                return existing
+            # 一樣的那個剛好被領走了就再排一次；一直找不到就不是重複，是別的錯
+            if attempt == ENQUEUE_ATTEMPTS - 1:
+                raise
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def claim(limit, lease=None, worker=None):
+    """
+    Take up to `limit` jobs that are due, highest priority first, together with RUNNING ones
+    whose lease ran out (their worker died). The conditional UPDATE decides which jobs are
+    ours, so two workers reading the same ids never both run one.
+    """
+    lease = lease or settings.JOB_LEASE_SECONDS
+    now = timezone.now()
+    # 一直把worker弄掛的工作不要再領
+    Job.objects.filter(status=Job.RUNNING, locked_until__lt=now, attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, locked_until=None, last_error='lease expired')
+    ready = Q(status=Job.QUEUED, run_at__lte=now) | Q(status=Job.RUNNING, locked_until__lt=now)
+    ids = list(Job.objects.filter(ready).order_by('-priority', 'run_at', 'id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    token = ('%s:%s' % (worker or worker_name(), uuid.uuid4().hex[:8]))[-64:]
+    Job.objects.filter(ready, pk__in=ids).update(status=Job.RUNNING, claimed_by=token, attempts=F('attempts') + 1,
+                                                 locked_until=now + timedelta(seconds=lease))
+    return list(Job.objects.filter(pk__in=ids, claimed_by=token))
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(settings.JOB_RETRY_BACKOFF * 2 ** (attempts - 1), settings.JOB_RETRY_BACKOFF_MAX))
+
+
+def run_job(job):
+    """
+    Run a claimed job. It is deleted on success; a failure is queued again after backoff()
+    or, out of attempts, kept as FAILED. Returns DONE, RETRY or FAILED.
+    """
+    try:
+        func = import_string(job.name)
+        if not hasattr(func, 'enqueue'):
+            raise ValueError('%s is not a job' % job.name)
+        func(*job.args, **job.kwargs)
+    except Exception:
+        logger.exception('job %s failed (attempt %d of %d)', job, job.attempts, job.max_attempts)
+        return _fail(job, traceback.format_exc())
+    else:
+        # lease過期被別人領走的話那一筆不是我們的，留給對方
+        Job.objects.filter(pk=job.pk, claimed_by=job.claimed_by).delete()
+        return DONE
+
+
+def _fail(job, error):
+    mine = Job.objects.filter(pk=job.pk, claimed_by=job.claimed_by)
+    if job.attempts >= job.max_attempts:
+        mine.update(status=Job.FAILED, locked_until=None, last_error=error)
+        return FAILED
+    try:
+        with transaction.atomic():
+            mine.update(status=Job.QUEUED, run_at=timezone.now() + backoff(job.attempts), locked_until=None,
+                        last_error=error)
+    except IntegrityError:
+        # 失敗的期間又排了一樣的工作，交給那一個
+        mine.delete()
+    return RETRY
+
+
+class Worker:
+    """
+    Claim jobs in batches of `batch_size` and run each batch on a pool of `workers` threads.
+    A batch has to finish within the lease, or its jobs are handed to another worker.
+    """
+
+    def __init__(self, workers=None, batch_size=None, lease=None):
+        self.workers = workers or settings.JOB_WORKERS
+        self.batch_size = batch_size or settings.JOB_BATCH_SIZE
+        self.lease = lease or settings.JOB_LEASE_SECONDS
+        self.name = worker_name()
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+
+    def run_batch(self):
+        """
+        Claim and run one batch. Returns (results, seconds, latency) where results counts DONE,
+        RETRY and FAILED and latency is the longest wait past run_at; None if nothing was due.
+        """
+        jobs = claim(self.batch_size, self.lease, self.name)
+        if not jobs:
+            return None
+        started = time.monotonic()
+        latency = max((timezone.now() - job.run_at).total_seconds() for job in jobs)
+        results = Counter(self.pool.map(self.run_in_thread, jobs))
+        batch = (results, time.monotonic() - started, latency)
+        _record_batch(*batch)
+        logger.info('ran %d jobs (%d failed) in %.3fs, waited up to %.1fs',
+                    sum(results.values()), results[FAILED], batch[1], latency)
+        return batch
+
+    @staticmethod
+    def run_in_thread(job):
+        # pool裡每個thread有自己的連線，跑完就關，不要留著過期的連線
+        close_old_connections()
+        try:
+            return run_job(job)
+        finally:
+            close_old_connections()
+
+    def run(self, once=False, interval=None):
+        """Keep running batches, sleeping `interval` seconds when idle; with `once`, stop when nothing is due."""
+        interval = settings.JOB_POLL_INTERVAL if interval is None else interval
+        try:
+            while True:
+                batch = self.run_batch()
+                if batch is not None:
+                    yield batch
+                elif once:
+                    break
+                else:
+                    close_old_connections()
+                    time.sleep(interval)
+        finally:
+            self.pool.shutdown()
+
+
+def _record_batch(results, seconds, latency):
+    jobs = sum(results.values())
+    stats = cache.get(STATS_KEY) or {DONE: 0, RETRY: 0, FAILED: 0}
+    for result in (DONE, RETRY, FAILED):
+        stats[result] += results[result]
+    stats.update({
+        'last_batch_at': time.time(),
+        'last_rate': round(jobs / seconds, 1) if seconds else None,
+        'last_latency_s': round(latency, 3),
+    })
+    cache.set(STATS_KEY, stats, None)
+
+
+def job_stats():
+    """Jobs per status, age of the oldest due job, and totals, rate (per second) and queue latency of the batches so far."""
+    now = timezone.now()
+    counts = dict(Job.objects.order_by().values_list('status').annotate(Count('id')))
+    oldest = (Job.objects.filter(status=Job.QUEUED, run_at__lte=now).order_by('run_at')
+              .values_list('run_at', flat=True).first())
+    stats = {label: counts.get(status, 0) for status, label in Job.STATUS_CHOICES}
+    stats['oldest_due_age_s'] = round((now - oldest).total_seconds(), 1) if oldest else None
+    stats.update(cache.get(STATS_KEY) or {})
+    return stats
+
+
+def delete_in_batches(queryset, batch_size):
+    """Delete the rows of `queryset` (with their cascades) `batch_size` at a time, one transaction per batch."""
+    model = queryset.model
+    while True:
+        with transaction.atomic():
+            ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return
+            model.objects.filter(pk__in=ids).delete()
+
+
+@job(priority=10, unique=True)
+def delete_group(group_id, batch_size=None):
+    """
+    Disband a group: everything hanging off it goes a batch per transaction, so no single
+    delete holds the tables long, and the group row itself is deleted last with nothing left to cascade.
+    """
+    batch_size = batch_size or settings.JOB_DELETE_BATCH_SIZE
+    for model in (Notification, Event, ArchivedEvent, Membership):
+        delete_in_batches(model.objects.filter(group_id=group_id), batch_size)
+    Group.objects.filter(pk=group_id).delete()
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, topic, loop):
+        self.topic = topic
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=settings.LIVE_QUEUE_SIZE)
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # 太慢的client直接丟訊息；參加者訊息帶著目前人數，下一則就會對上
+            pass
+
+
+class Hub:
+    """
+    In-process fan-out: every subscriber of a topic gets its own queue on its own event loop.
+    dispatch() is thread-safe, so it can be called from sync views, signals and backend threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def subscribe(self, topic):
+        subscription = Subscription(topic, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.topic)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.topic]
+
+    def dispatch(self, topic, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(topic, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, message)
+            except RuntimeError:
+                # event loop已經關了
+                self.unsubscribe(subscription)
+        return len(subscriptions)
+
+
+class LocalBackend:
+    """Deliver to subscribers in this process only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, topic, message):
+        self.hub.dispatch(topic, message)
+
+    def start(self):
+        pass
+
+
+class FileSpoolBackend(LocalBackend):
+    """
+    Stand-in for a shared broker (e.g. Redis pub/sub) between workers on one host: messages are
+    appended as JSON lines to LIVE_SPOOL_PATH and every worker serving streams tails the file.
+    """
+
+    def __init__(self, hub, path=None, poll_interval=None):
+        super().__init__(hub)
+        self.path = str(path or settings.LIVE_SPOOL_PATH)
+        self.poll_interval = poll_interval or settings.LIVE_SPOOL_POLL_INTERVAL
+        self.position = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def publish(self, topic, message):
+        line = (json.dumps({'topic': topic, 'message': message}) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > settings.LIVE_SPOOL_MAX_BYTES:
+                os.ftruncate(fd, 0)
+            # O_APPEND下一次write一整行，多個worker同時寫也不會交錯
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def poll(self):
+        """Dispatch lines appended since the last poll. Returns how many were read."""
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+        if self.position is None or size < self.position:
+            # 第一次從檔尾開始；檔案被截斷過就從頭讀
+            self.position = size if self.position is None else 0
+        if size == self.position:
+            return 0
+        with open(self.path, 'rb') as f:
+            f.seek(self.position)
+            data = f.read(size - self.position)
+        # 只處理完整的行，寫到一半的留到下次
+        data = data[:data.rfind(b'\n') + 1]
+        self.position += len(data)
+        lines = data.splitlines()
+        for line in lines:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            self.hub.dispatch(item['topic'], item['message'])
+        return len(lines)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.poll()
+                self.thread = threading.Thread(target=self.run, name='live-spool-tail', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('live spool poll failed')
+            time.sleep(self.poll_interval)
+
+
+hub = Hub()
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(settings.LIVE_BACKEND)(hub)
+    return _backend
+
+
+def publish(topic, kind, data):
+    """
+    Send `data` as an SSE event named `kind` to everyone watching `topic` ('event:<id>', 'group:<id>'
+    or moderators_topic(<id>)).
+    """
+    get_backend().publish(topic, {'kind': kind, 'data': data})
+
+
+def live_url(kind, pk):
+    return '%s%s/%d' % (settings.LIVE_URL_PREFIX, kind, pk)
+
+
+def format_event(message):
+    return ('event: %s\ndata: %s\n\n' % (message['kind'], json.dumps(message['data']))).encode()
+
+
+def _cookies(scope):
+    cookie = SimpleCookie()
+    for name, value in scope.get('headers', ()):
+        if name == b'cookie':
+            cookie.load(value.decode('latin-1'))
+    return {key: morsel.value for key, morsel in cookie.items()}
+
+
+def watch_topic(scope, kind, pk):
+    """
+    Resolve the session user the way AuthenticationMiddleware does, apply the page's own permission
+    check and return the topic to stream, or None if the user may not watch. Group moderators get
+    the roster with its pending section, like the pending roster page; everyone else the public one.
+    """
+    from .models import Event, Group
+    from .permissions import MembershipResolver
+
+    close_old_connections()
+    try:
+        session_key = _cookies(scope).get(settings.SESSION_COOKIE_NAME)
+        store = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        user = get_user(SimpleNamespace(session=store))
+        if kind == 'event':
+            event = Event.objects.select_related(None).only('id', 'is_public', 'initiator', 'group').filter(pk=pk).first()
+            return 'event:%d' % pk if event is not None and event.is_viewable_by(user) else None
+        if not Group.objects.filter(pk=pk).exists():
+            return None
+        return moderators_topic(pk) if MembershipResolver.for_user(user).is_admin(pk) else 'group:%d' % pk
+    finally:
+        close_old_connections()
+
+
+def moderators_topic(group_id):
+    return 'group:%d:moderators' % group_id
+
+
+async def stream(scope, receive, send, topic):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    get_backend().start()
+    subscription = hub.subscribe(topic)
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    disconnected = asyncio.ensure_future(wait_disconnect())
+    try:
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while True:
+            message = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait({message, disconnected}, timeout=settings.LIVE_KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if message in done:
+                body = format_event(message.result())
+            else:
+                message.cancel()
+                if disconnected in done:
+                    break
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        hub.unsubscribe(subscription)
+        disconnected.cancel()
+
+
+async def respond(send, status):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+LIVE_PATH = re.compile(r'^(event|group)/(\d+)/?$')
+
+
+def live_application(application):
+    """
+    Wrap the Django ASGI application: GET <LIVE_URL_PREFIX>event/<id> and .../group/<id> are served
+    as server-sent event streams here, everything else goes to Django. Django 3.1 cannot stream an
+    async response, so the endpoint speaks ASGI directly.
+    """
+    prefix = settings.LIVE_URL_PREFIX
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(prefix):
+            return await application(scope, receive, send)
+        match = LIVE_PATH.match(scope['path'][len(prefix):])
+        if match is None:
+            return await respond(send, 404)
+        if scope['method'] != 'GET':
+            return await respond(send, 405)
+        kind, pk = match.group(1), int(match.group(2))
+        topic = await sync_to_async(watch_topic)(scope, kind, pk)
+        if topic is None:
+            return await respond(send, 403)
+        await stream(scope, receive, send, topic)
+
+    return app
+
@@ -0,0 +1,120 @@
+import random
+from datetime import date, time, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from . import search
+from .caching import bump_version
+from .counters import recount_groups
+from .court_index import court_index, court_names
+from .models import Player, Court, Group, Membership, Event, Participation
+
+# 各縣市大概的中心點，產生的球場散在附近
+CITY_CENTERS = {
+    1: (25.04, 121.53), 2: (25.01, 121.46), 4: (24.99, 121.30), 5: (24.80, 120.97), 8: (24.15, 120.67),
+    9: (24.07, 120.54), 12: (23.48, 120.45), 14: (22.99, 120.21), 15: (22.63, 120.30), 18: (23.98, 121.60),
+}
+
+
+def skewed_index(rng, n, skew=1.2):
+    """Pick 0..n-1 with a Zipf-like skew so a few rows get most of the traffic."""
+    return min(int(rng.paretovariate(skew)) - 1, n - 1)
+
+
+def generate_load_data(players=1000, courts=100, groups=50, events=2000, max_group_size=300,
+                       seed=0, batch_size=500, today=None):
+    """
+    Bulk-create a realistic, skewed dataset: a few huge groups and popular courts,
+    events spread over the past and next two months, popular events filled up.
+    Returns a dict of row counts per model.
+    """
+    rng = random.Random(seed)
+    today = today or date.today()
+    prefix = 'load%d-' % seed
+    password = make_password('password')
+
+    with transaction.atomic():
+        Player.objects.bulk_create([
+            Player(email='%s%06d@example.com' % (prefix, n), password=password, first_name='Player',
+                   last_name='%06d' % n, gender=rng.choice([Player.MALE, Player.FEMALE]))
+            for n in range(players)
+        ], batch_size=batch_size)
+        player_ids = list(Player.objects.filter(email__startswith=prefix).values_list('id', flat=True))
+
+        court_rows = []
+        for n in range(courts):
+            city = rng.choice(list(CITY_CENTERS))
+            latitude, longitude = CITY_CENTERS[city]
+            court_rows.append(Court(name='%scourt-%06d' % (prefix, n), address='Address %d' % n, city=city,
+                                    latitude=latitude + rng.uniform(-0.1, 0.1),
+                                    longitude=longitude + rng.uniform(-0.1, 0.1)))
+        Court.objects.bulk_create(court_rows, batch_size=batch_size)
+        court_ids = list(Court.objects.filter(name__startswith=prefix).values_list('id', flat=True))
+
+        Group.objects.bulk_create([
+            Group(name='%sgroup-%06d' % (prefix, n), organizer_id=player_ids[n % len(player_ids)],
+                  court_id=court_ids[skewed_index(rng, len(court_ids))], about='Load test group %d' % n)
+            for n in range(groups)
+        ], batch_size=batch_size)
+        group_rows = list(Group.objects.filter(name__startswith=prefix).values_list('id', 'organizer_id', 'court_id'))
+
+        memberships = []
+        group_members = {}
+        for rank, (group_id, organizer_id, court_id) in enumerate(group_rows):
+            # 第一個球團最大，之後越來越小
+            size = max(2, int(max_group_size / (rank + 1) ** 0.8))
+            members = {organizer_id} | set(rng.sample(player_ids, min(size, len(player_ids))))
+            group_members[group_id] = [organizer_id] + sorted(members - {organizer_id})
+            for player_id in group_members[group_id]:
+                if player_id == organizer_id:
+                    status = Membership.ORGANIZER
+                else:
+                    status = rng.choices([Membership.ADMIN, Membership.MEMBER, Membership.PENDING], [1, 16, 3])[0]
+                memberships.append(Membership(group_id=group_id, player_id=player_id, status=status))
+        Membership.objects.bulk_create(memberships, batch_size=batch_size)
+        recount_groups()
+
+        event_rows = []
+        participants = []
+        for n in range(events):
+            quota = rng.choice([6, 6, 12, 12, 18])
+            play_date = today + timedelta(days=rng.randint(-60, 60))
+            if rng.random() < 0.5:
+                group_id, organizer_id, court_id = rng.choice(group_rows)
+                pool = group_members[group_id]
+                is_public = rng.random() < 0.3
+            else:
+                group_id, court_id, pool, is_public = None, court_ids[skewed_index(rng, len(court_ids))], player_ids, True
+            initiator_id = pool[0] if group_id else rng.choice(player_ids)
+            # 熱門活動報滿，其他的隨機
+            count = quota if rng.random() < 0.3 else rng.randint(0, quota)
+            joined = rng.sample(pool, min(count, len(pool)))
+            participants.append(joined)
+            event_rows.append(Event(initiator_id=initiator_id, group_id=group_id, is_public=is_public, court_id=court_id,
+                                    play_date=play_date, play_start_time=time(rng.randint(8, 21), rng.choice([0, 30])),
+                                    is_expired=play_date < today, player_quota=quota, participant_count=len(joined),
+                                    court_detail='Court detail %d' % n, play_detail='Play detail %d' % n))
+        first_id = (Event.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        Event.objects.bulk_create(event_rows, batch_size=batch_size)
+        event_ids = list(Event.objects.filter(id__gte=first_id).order_by('id').values_list('id', flat=True))
+        Participation.objects.bulk_create([
+            Participation(event_id=event_id, player_id=player_id)
+            for event_id, joined in zip(event_ids, participants) for player_id in joined
+        ], batch_size=batch_size)
+
+    # bulk_create不會觸發signal
+    bump_version('court-list', 'group-list', 'event-expiry', *['group:%d' % row[0] for row in group_rows])
+    court_index.invalidate()
+    court_names.invalidate()
+    if search.is_available():
+        search.rebuild()
+
+    return {
+        'players': len(player_ids),
+        'courts': len(court_ids),
+        'groups': len(group_rows),
+        'memberships': len(memberships),
+        'events': len(event_ids),
+        'participations': sum(len(joined) for joined in participants),
+    }
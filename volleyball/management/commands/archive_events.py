@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from volleyball.archive import archive_events, compact
+
+
+class Command(BaseCommand):
+    help = 'Move expired events older than the archive horizon, with their participations, into the archive tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive events played more than this many days ago.')
+        parser.add_argument('--batch-size', type=int, help='Events moved per transaction.')
+        parser.add_argument('--compact', action='store_true',
+                            help='Only reclaim space and refresh statistics (VACUUM/ANALYZE); run off-peak.')
+
+    def handle(self, *args, **options):
+        if options['compact']:
+            compact()
+            self.stdout.write(self.style.SUCCESS('Compacted event and archive tables.'))
+            return
+        batches = archive_events(horizon_days=options['days'], batch_size=options['batch_size'])
+        for i, (events, participations, seconds) in enumerate(batches, 1):
+            self.stdout.write('batch %d: %d events, %d participations in %.3fs' % (i, events, participations, seconds))
+        self.stdout.write(self.style.SUCCESS('Archived %d events and %d participations in %d batches.' % (
+            sum(batch[0] for batch in batches), sum(batch[1] for batch in batches), len(batches))))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from volleyball.caching import bump_version
+from volleyball.images import generate_derivatives, photo_hash
+from volleyball.models import Court
+
+
+class Command(BaseCommand):
+    help = 'Hash court photos uploaded before derivatives existed and render any missing photo sizes.'
+
+    def handle(self, *args, **options):
+        courts = Court.objects.exclude(photo='').exclude(photo=None)
+        for court in courts.only('id', 'photo', 'photo_hash').iterator():
+            if not court.photo_hash:
+                with court.photo.open('rb') as photo:
+                    court.photo_hash = photo_hash(photo)
+                Court.objects.filter(pk=court.pk).update(photo_hash=court.photo_hash)
+            generate_derivatives(court.photo.name, court.photo_hash)
+            self.stdout.write('%s: %s' % (court.photo.name, court.photo_hash))
+        # update()不會觸發signal，列表快取裡還是舊的hash
+        bump_version('court-list')
+        self.stdout.write(self.style.SUCCESS('Rendered derivatives for %d photos.' % courts.count()))
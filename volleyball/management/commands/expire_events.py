@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from volleyball.expiry import expire_past_events
+
+
+class Command(BaseCommand):
+    help = 'Mark events whose play time has passed as expired.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Rows updated per batch.')
+
+    def handle(self, *args, **options):
+        batches = expire_past_events(batch_size=options['batch_size'])
+        for i, (count, seconds) in enumerate(batches, 1):
+            self.stdout.write('batch %d: %d events in %.3fs' % (i, count, seconds))
+        total = sum(count for count, _ in batches)
+        self.stdout.write(self.style.SUCCESS('Expired %d events in %d batches.' % (total, len(batches))))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from volleyball.loadgen import generate_load_data
+
+
+class Command(BaseCommand):
+    help = 'Bulk-create skewed players, courts, groups, memberships, events and participations for load testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=1000)
+        parser.add_argument('--courts', type=int, default=100)
+        parser.add_argument('--groups', type=int, default=50)
+        parser.add_argument('--events', type=int, default=2000)
+        parser.add_argument('--max-group-size', type=int, default=300)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed; also namespaces the generated emails and names.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        counts = generate_load_data(
+            players=options['players'], courts=options['courts'], groups=options['groups'],
+            events=options['events'], max_group_size=options['max_group_size'], seed=options['seed'],
+        )
+        for model, count in counts.items():
+            self.stdout.write('%s: %d' % (model, count))
+        self.stdout.write(self.style.SUCCESS('Done in %.1fs.' % (time.monotonic() - started)))
@@ -0,0 +1,242 @@
+import csv
+import json
+import os
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from volleyball import search
+from volleyball.caching import bump_version
+from volleyball.court_index import court_index, court_names
+from volleyball.models import Court
+
+CITY_NAMES = {
+    '臺北市': 1, '新北市': 2, '基隆市': 3, '桃園市': 4, '新竹市': 5, '新竹縣': 6, '苗栗縣': 7, '臺中市': 8,
+    '彰化縣': 9, '南投縣': 10, '雲林縣': 11, '嘉義市': 12, '嘉義縣': 13, '臺南市': 14, '高雄市': 15, '屏東縣': 16,
+    '宜蘭縣': 17, '花蓮縣': 18, '臺東縣': 19, '澎湖縣': 20, '金門縣': 21, '連江縣': 22,
+}
+CITY_NAMES.update({str(label).lower(): value for value, label in Court.CITY_CHOICES})
+FORMATS = {'.csv': 'csv', '.geojson': 'geojson', '.json': 'geojson', '.geojsonl': 'geojsonl', '.jsonl': 'geojsonl'}
+UPDATE_FIELDS = ['address', 'city', 'latitude', 'longitude']
+
+
+class Reject(Exception):
+    pass
+
+
+def parse_city(value, address=''):
+    """City code from a code, an English or Chinese name, or failing that the start of the address."""
+    value = str(value or '').strip().replace('台', '臺')
+    if value.isdigit():
+        return int(value) if int(value) in dict(Court.CITY_CHOICES) else None
+    if value:
+        return CITY_NAMES.get(value.lower())
+    return CITY_NAMES.get(address.strip().replace('台', '臺')[:3])
+
+
+def parse_coordinate(value, limit):
+    if value in (None, ''):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise Reject('invalid coordinate %r' % value)
+    if not -limit <= value <= limit:
+        raise Reject('coordinate out of range %r' % value)
+    return value
+
+
+def text(row, field):
+    value = row.get(field)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise Reject('invalid %s' % field)
+    return value.strip()
+
+
+def clean_row(row):
+    name = text(row, 'name')
+    address = text(row, 'address')
+    if not name or len(name) > Court._meta.get_field('name').max_length:
+        raise Reject('invalid name')
+    if not address or len(address) > Court._meta.get_field('address').max_length:
+        raise Reject('invalid address')
+    city = parse_city(row.get('city'), address)
+    if row.get('city') and city is None:
+        raise Reject('unknown city %r' % row['city'])
+    return {
+        'name': name,
+        'address': address,
+        'city': city,
+        'latitude': parse_coordinate(row.get('latitude', row.get('lat')), 90),
+        'longitude': parse_coordinate(row.get('longitude', row.get('lng', row.get('lon'))), 180),
+    }
+
+
+def feature_row(feature):
+    if isinstance(feature, str):
+        try:
+            feature = json.loads(feature)
+        except ValueError:
+            raise Reject('invalid JSON')
+    if not isinstance(feature, dict) or not isinstance(feature.get('properties') or {}, dict):
+        raise Reject('invalid feature')
+    row = dict(feature.get('properties') or {})
+    geometry = feature.get('geometry') or {}
+    if not isinstance(geometry, dict):
+        raise Reject('invalid geometry')
+    if geometry.get('type') == 'Point':
+        coordinates = geometry.get('coordinates')
+        if not isinstance(coordinates, list) or len(coordinates) < 2:
+            raise Reject('invalid coordinates')
+        row['longitude'], row['latitude'] = coordinates[:2]
+    return row
+
+
+def iter_csv(fp):
+    yield from csv.DictReader(fp)
+
+
+def iter_geojsonl(fp):
+    # GeoJSON Text Sequence / newline-delimited features；每行在feature_row才解析，壞掉的行算reject
+    for line in fp:
+        line = line.strip('\x1e \t\r\n')
+        if line:
+            yield line
+
+
+# 一個feature最多幾個字元；超過還解析不出來就當檔案壞了，不要一直讀到檔尾
+MAX_FEATURE_SIZE = 1 << 20
+
+
+def iter_geojson(fp, chunk_size=1 << 16):
+    """Yield the features of a FeatureCollection one at a time without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buf = ''
+    match = None
+    while match is None:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            raise CommandError('No "features" array found.')
+        buf += chunk
+        match = re.search(r'"features"\s*:\s*\[', buf)
+    buf = buf[match.end():]
+    while True:
+        buf = buf.lstrip(' \t\r\n,')
+        if buf.startswith(']'):
+            return
+        try:
+            feature, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError as e:
+            if len(buf) > MAX_FEATURE_SIZE:
+                raise CommandError('Malformed GeoJSON feature: %s' % e)
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                raise CommandError('Unexpected end of GeoJSON.')
+            buf += chunk
+            continue
+        yield feature
+        buf = buf[end:]
+
+
+# 格式 -> (讀出一筆筆原始資料, 轉成欄位的dict)；轉換失敗的丟Reject
+READERS = {'csv': (iter_csv, dict), 'geojson': (iter_geojson, feature_row), 'geojsonl': (iter_geojsonl, feature_row)}
+
+
+def upsert(rows):
+    """Create or update a batch of cleaned rows keyed on Court.name. Returns (created, updated)."""
+    rows = {row['name']: row for row in rows}
+    existing = Court.objects.filter(name__in=rows).only('id', 'name', *UPDATE_FIELDS).in_bulk(field_name='name')
+    created = [Court(**row) for name, row in rows.items() if name not in existing]
+    updated = []
+    for name, court in existing.items():
+        row = rows[name]
+        if any(getattr(court, field) != row[field] for field in UPDATE_FIELDS):
+            for field in UPDATE_FIELDS:
+                setattr(court, field, row[field])
+            updated.append(court)
+    with transaction.atomic():
+        Court.objects.bulk_create(created)
+        Court.objects.bulk_update(updated, UPDATE_FIELDS)
+        # SQLite的bulk_create拿不到pk，重新查一次再更新搜尋索引
+        search.index_objects(Court.objects.filter(name__in=rows))
+    return len(created), len(updated)
+
+
+class Command(BaseCommand):
+    help = 'Stream courts from a CSV, GeoJSON or GeoJSON-lines file and upsert them by name.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=sorted(READERS),
+                            help='Input format; guessed from the file extension by default.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip the rows committed by a previous interrupted run.')
+        parser.add_argument('--rejects', help='Write rejected rows to this CSV file.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or FORMATS.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise CommandError('Cannot guess the format of %s, use --format.' % path)
+        checkpoint = path + '.progress'
+        skip = 0
+        if options['resume'] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                skip = json.load(f)['rows']
+            self.stdout.write('Resuming after row %d.' % skip)
+
+        # 續跑時前面跳過的列已經記過了，接在後面寫
+        rejects = open(options['rejects'], 'a' if skip else 'w', newline='', encoding='utf-8') \
+            if options['rejects'] else None
+        reject_writer = csv.writer(rejects) if rejects else None
+        started = reported = time.monotonic()
+        seen = created = updated = rejected = 0
+        batch = []
+
+        def flush():
+            nonlocal created, updated, reported
+            c, u = upsert(batch)
+            created += c
+            updated += u
+            batch.clear()
+            with open(checkpoint, 'w') as f:
+                json.dump({'rows': seen}, f)
+            now = time.monotonic()
+            if now - reported >= 1:
+                reported = now
+                self.stdout.write('%d rows, %d created, %d updated, %d rejected, %.0f rows/s' % (
+                    seen, created, updated, rejected, (seen - skip) / (now - started)))
+
+        try:
+            reader, to_row = READERS[fmt]
+            with open(path, newline='', encoding='utf-8-sig') as fp:
+                for seen, row in enumerate(reader(fp), 1):
+                    if seen <= skip:
+                        continue
+                    try:
+                        batch.append(clean_row(to_row(row)))
+                    except Reject as e:
+                        rejected += 1
+                        if reject_writer:
+                            reject_writer.writerow([seen, str(e), json.dumps(row, ensure_ascii=False)])
+                    if len(batch) >= options['batch_size']:
+                        flush()
+                flush()
+        finally:
+            if rejects:
+                rejects.close()
+            # bulk_create/bulk_update不會觸發signal，手動讓快取和索引失效
+            bump_version('court-list')
+            court_index.invalidate()
+            court_names.invalidate()
+
+        os.remove(checkpoint)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            'Imported %d rows in %.1fs (%.0f rows/s): %d created, %d updated, %d rejected.' % (
+                seen - skip, elapsed, (seen - skip) / elapsed if elapsed else 0, created, updated, rejected)))
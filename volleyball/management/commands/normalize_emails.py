@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.db.models.functions import Lower, Trim
+
+from volleyball.models import Player
+
+
+class Command(BaseCommand):
+    help = ('Lowercase the emails of accounts created before logins became case-insensitive. '
+            'Addresses that only differ in case are left alone and listed, to be merged by hand.')
+
+    def handle(self, *args, **options):
+        normalized = Lower(Trim('email'))
+        clashes = list(Player.objects.order_by().annotate(normalized=normalized).values('normalized')
+                       .annotate(count=Count('id')).filter(count__gt=1).values_list('normalized', flat=True))
+        stale = Player.objects.annotate(normalized=normalized).exclude(email=normalized)
+        fixed = stale.exclude(normalized__in=clashes).update(email=normalized)
+        for email in clashes:
+            self.stderr.write('Several accounts use %s: %s' % (email, ', '.join(
+                Player.objects.filter(email__iexact=email).order_by('id').values_list('email', flat=True))))
+        self.stdout.write(self.style.SUCCESS('Lowercased %d emails, %d left to merge.' % (fixed, len(clashes))))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from volleyball import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for courts, groups and events.'
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('Full-text search needs the SQLite FTS5 extension.')
+        total = search.rebuild()
+        self.stdout.write(self.style.SUCCESS('Indexed %d objects.' % total))
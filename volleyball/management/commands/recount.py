@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from volleyball.counters import recount_events, recount_groups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized participant and member counters from the underlying rows.'
+
+    def handle(self, *args, **options):
+        events = recount_events()
+        groups = recount_groups()
+        self.stdout.write(self.style.SUCCESS('Fixed %d events and %d groups.' % (events, groups)))
@@ -0,0 +1,68 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment, override_settings
+
+from volleyball.benchmark import SCENARIOS, compare, run_benchmarks
+from volleyball.loadgen import generate_load_data
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), '..', '..', 'benchmark_baseline.json')
+
+
+class Command(BaseCommand):
+    help = ('Generate load data in a throwaway test database, drive the hot views through the test client '
+            'and compare query counts (and optionally latency and memory) with a stored baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=2000)
+        parser.add_argument('--courts', type=int, default=200)
+        parser.add_argument('--groups', type=int, default=100)
+        parser.add_argument('--events', type=int, default=5000)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--scenario', action='append', choices=[name for name, url, cleanup in SCENARIOS],
+                            help='Only run this scenario; may be repeated.')
+        parser.add_argument('--report', help='Write the JSON report to this file.')
+        parser.add_argument('--baseline', default=os.path.normpath(DEFAULT_BASELINE))
+        parser.add_argument('--timing', action='store_true',
+                            help='Also gate on p90 latency and peak memory; only meaningful against a baseline '
+                                 'recorded on this machine (--update-baseline). By default only query counts are gated.')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed relative growth of p90 latency and peak memory with --timing.')
+        parser.add_argument('--update-baseline', action='store_true', help='Overwrite the baseline with this run.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            # debug toolbar會大幅拖慢並多出查詢
+            with override_settings(DEBUG=False, INTERNAL_IPS=[]):
+                counts = generate_load_data(players=options['players'], courts=options['courts'],
+                                            groups=options['groups'], events=options['events'])
+                self.stdout.write('Data: %s' % ', '.join('%d %s' % (n, model) for model, n in counts.items()))
+                report = run_benchmarks(iterations=options['iterations'], scenarios=options['scenario'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in report.items():
+            self.stdout.write('%-14s %3d queries  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  peak %8.1fKB' % (
+                name, result['queries'], result['p50_ms'], result['p90_ms'], result['p99_ms'], result['peak_kb']))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['update_baseline']:
+            with open(options['baseline'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS('Baseline updated.'))
+            return
+
+        if not os.path.exists(options['baseline']):
+            self.stdout.write(self.style.WARNING('No baseline at %s, nothing to compare.' % options['baseline']))
+            return
+        with open(options['baseline']) as f:
+            regressions = compare(report, json.load(f), options['tolerance'], options['timing'])
+        if regressions:
+            raise CommandError('Regressions against baseline:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against baseline.'))
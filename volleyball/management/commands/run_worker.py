@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from volleyball.jobs import DONE, FAILED, RETRY, Worker, job_stats
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs: claim them in batches under a lease and run each batch on a thread pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Threads running jobs.')
+        parser.add_argument('--batch-size', type=int, help='Jobs claimed at a time.')
+        parser.add_argument('--lease', type=int, help='Seconds a batch may take before its jobs are handed out again.')
+        parser.add_argument('--interval', type=float, help='Seconds to sleep when no job is due.')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is due instead of polling.')
+
+    def handle(self, *args, **options):
+        worker = Worker(workers=options['workers'], batch_size=options['batch_size'], lease=options['lease'])
+        try:
+            for results, seconds, latency in worker.run(once=options['once'], interval=options['interval']):
+                self.stdout.write('batch: %d done, %d retried, %d failed in %.3fs, waited up to %.1fs' % (
+                    results[DONE], results[RETRY], results[FAILED], seconds, latency))
+        except KeyboardInterrupt:
+            pass
+        stats = job_stats()
+        self.stdout.write(self.style.SUCCESS('%d jobs queued, %d running, %d failed.' % (
+            stats['queued'], stats['running'], stats['failed'])))
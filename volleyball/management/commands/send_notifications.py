@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from volleyball.notifications import queue_stats, send_notifications
+
+
+class Command(BaseCommand):
+    help = 'Mail queued notifications as one digest per recipient, in batches over a single mail connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Recipients per batch.')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep draining every N seconds until interrupted (default: drain once).')
+
+    def handle(self, *args, **options):
+        while True:
+            batches = send_notifications(batch_size=options['batch_size'])
+            for i, (notifications, messages, seconds) in enumerate(batches, 1):
+                self.stdout.write('batch %d: %d notifications in %d messages, %.3fs' % (i, notifications, messages, seconds))
+            stats = queue_stats()
+            self.stdout.write(self.style.SUCCESS('Sent %d notifications; %d still queued.' % (
+                sum(batch[0] for batch in batches), stats['depth'])))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,41 @@
+import sqlite3
+import time
+from contextlib import closing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def copy_database(source, target):
+    """Online copy of one SQLite file onto another with the backup API; readers of `target` keep working."""
+    with closing(sqlite3.connect(str(source))) as src, closing(sqlite3.connect(str(target))) as dst:
+        src.backup(dst)
+
+
+class Command(BaseCommand):
+    help = ('Copy the primary SQLite database onto every DATABASE_REPLICAS file. Stands in for '
+            'replication when trying read replicas locally; --interval keeps copying to simulate lag.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Copy again every N seconds until interrupted (default: copy once).')
+
+    def handle(self, *args, **options):
+        aliases = settings.DATABASE_REPLICAS
+        if not aliases:
+            raise CommandError('No DATABASE_REPLICAS configured (set PLAYONE_REPLICAS).')
+        for alias in [DEFAULT_DB_ALIAS] + list(aliases):
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('%s is not SQLite; use the database\'s own replication.' % alias)
+
+        source = connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+        while True:
+            started = time.monotonic()
+            for alias in aliases:
+                connections[alias].close()
+                copy_database(source, connections[alias].settings_dict['NAME'])
+            self.stdout.write('Copied %s to %s in %.2fs.' % (source, ', '.join(aliases), time.monotonic() - started))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
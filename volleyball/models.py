@@ -3,18 +3,45 @@ from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser
 )
 from django.core import validators
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Exists, F, OuterRef, Q
 from django.utils import timezone
 from datetime import datetime
 from django.urls import reverse
 
 from allauth.account.signals import user_signed_up
+from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from django.utils.translation import gettext_lazy as _
 
+from .caching import bump_version
+
+
+class PlayerQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        """
+        update() sends no post_save, so bump the 'user:<id>' stamps of the rows it touches here;
+        otherwise e.g. a bulk deactivation would keep serving the cached session users.
+        """
+        ids = list(self.values_list('pk', flat=True))
+        rows = super().update(**kwargs)
+        if ids:
+            bump_version(*['user:%d' % pk for pk in ids])
+        if {'first_name', 'last_name'} & set(kwargs):
+            bump_version('player-names')
+        return rows
+
 
 class PlayerManager(BaseUserManager):
+    @classmethod
+    def normalize_email(cls, email):
+        # 整個email都轉小寫，登入時才能直接用unique index比對 (舊資料用normalize_emails轉過)
+        return (email or '').strip().lower()
+
+    def get_by_natural_key(self, email):
+        return self.get(email=self.normalize_email(email))
+
     def create_user(self, email, password=None, **extra_fields):
         if not email:
             raise ValueError('Users must have an email address')
@@ -67,13 +94,17 @@ class Player(AbstractBaseUser):
     is_staff = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
 
-    objects = PlayerManager()
+    objects = PlayerManager.from_queryset(PlayerQuerySet)()
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name', 'gender', 'date_of_birth']
 
     def __str__(self):
         return self.get_full_name()
 
+    def save(self, *args, **kwargs):
+        self.email = Player.objects.normalize_email(self.email)
+        super().save(*args, **kwargs)
+
     def get_full_name(self):
         full_name = '%s %s' % (self.first_name, self.last_name)
         return full_name.strip()
@@ -105,15 +136,41 @@ def signup_facebook_extra_fields(sociallogin, user, **kwargs):
 
 
 class Court(models.Model):
+    CITY_CHOICES = [
+        (1, _('Taipei City')),
+        (2, _('New Taipei City')),
+        (3, _('Keelung City')),
+        (4, _('Taoyuan City')),
+        (5, _('Hsinchu City')),
+        (6, _('Hsinchu County')),
+        (7, _('Miaoli County')),
+        (8, _('Taichung City')),
+        (9, _('Changhua County')),
+        (10, _('Nantou County')),
+        (11, _('Yunlin County')),
+        (12, _('Chiayi City')),
+        (13, _('Chiayi County')),
+        (14, _('Tainan City')),
+        (15, _('Kaohsiung City')),
+        (16, _('Pingtung County')),
+        (17, _('Yilan County')),
+        (18, _('Hualien County')),
+        (19, _('Taitung County')),
+        (20, _('Penghu County')),
+        (21, _('Kinmen County')),
+        (22, _('Lienchiang County')),
+    ]
+
     name = models.CharField(_('name'), max_length=80, unique=True)
     address = models.CharField(_("address"), max_length=256)
     photo = models.ImageField(_('photo'), upload_to='images/', null=True, blank=True)
-
-    # CITY_CHOICES = [
-    #     (1, 'Male'),
-    #     (2, 'Female'),
-    # ]
-    # city = models.PositiveSmallIntegerField(_('city'), choices=CITY_CHOICES, default=1)
+    # 照片內容的hash，衍生圖的檔名由它決定
+    photo_hash = models.CharField(max_length=40, blank=True, editable=False, db_index=True)
+    city = models.PositiveSmallIntegerField(_('city'), choices=CITY_CHOICES, null=True, blank=True, db_index=True)
+    latitude = models.FloatField(_('latitude'), null=True, blank=True,
+                                 validators=[validators.MinValueValidator(-90), validators.MaxValueValidator(90)])
+    longitude = models.FloatField(_('longitude'), null=True, blank=True,
+                                  validators=[validators.MinValueValidator(-180), validators.MaxValueValidator(180)])
 
     def __str__(self):
         return self.name
@@ -121,13 +178,44 @@ class Court(models.Model):
     def get_absolute_url(self):
         return reverse('court-detail', args=[str(self.id)])
 
-
-class Group(models.Model):
+    def save(self, *args, **kwargs):
+        from .images import photo_hash, schedule_derivatives
+        uploaded = bool(self.photo) and not self.photo._committed
+        if uploaded:
+            self.photo_hash = photo_hash(self.photo)
+        elif not self.photo:
+            self.photo_hash = ''
+        super().save(*args, **kwargs)
+        if uploaded:
+            schedule_derivatives(self.photo.name, self.photo_hash)
+
+
+class CounterFieldsMixin:
+    """
+    Denormalized counters are only written by their F() helpers. A plain save() of a loaded row
+    leaves `counter_fields` out, so an edit cannot write back the counts it read and undo a signup
+    or join that committed in between.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and kwargs.get('update_fields') is None \
+                and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+
+class Group(CounterFieldsMixin, models.Model):
     name = models.CharField(_('name'), max_length=50, unique=True)
     organizer = models.ForeignKey(Player, verbose_name=_('organizer'), on_delete=models.CASCADE, related_name='+')
     court = models.ForeignKey(Court, verbose_name=_('court'), on_delete=models.CASCADE)
     about = models.TextField(_('about'), max_length=600, blank=True)
     members = models.ManyToManyField(Player, through='Membership')
+    # 不含申請中的成員；和Membership在同一個transaction裡用F()更新
+    member_count = models.PositiveIntegerField(_('members'), default=0, editable=False)
+    pending_count = models.PositiveIntegerField(_('pending'), default=0, editable=False)
+    counter_fields = ('member_count', 'pending_count')
 
     def __str__(self):
         return self.name
@@ -135,6 +223,28 @@ class Group(models.Model):
     def get_absolute_url(self):
         return reverse('group-detail', args=[str(self.id)])
 
+    @classmethod
+    def update_counts(cls, pk, removed=None, added=None):
+        """Move group `pk`'s counters for a membership leaving status `removed` and/or entering `added`."""
+        changes = {}
+        for status, delta in ((removed, -1), (added, 1)):
+            if status is not None:
+                field = 'pending_count' if status == Membership.PENDING else 'member_count'
+                changes[field] = changes.get(field, 0) + delta
+        changes = {field: F(field) + delta for field, delta in changes.items() if delta}
+        if changes:
+            cls.objects.filter(pk=pk).update(**changes)
+
+    def add_member(self, player, status):
+        with transaction.atomic():
+            membership = Membership.objects.create(group=self, player=player, status=status)
+            Group.update_counts(self.pk, added=status)
+        return membership
+
+    def remove_member(self, player):
+        membership = Membership.objects.filter(group=self, player=player).first()
+        return membership.remove() if membership else False
+
     @classmethod
     def get_joined_by_player_id(cls, player_id):
         return cls.objects.raw(
@@ -161,10 +271,31 @@ class Membership(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['group', 'player'], name='unique_membership')
         ]
+        indexes = [
+            # 球團名單依身分分頁
+            models.Index(fields=['group', 'status', 'id'], name='membership_roster_idx'),
+            # 一個人的所有球團 (MembershipResolver)
+            models.Index(fields=['player', 'status', 'group'], name='membership_player_idx'),
+        ]
+
+    MEMBER_STATUSES = (ORGANIZER, ADMIN, MEMBER)
+
+    # 球團名單分頁的區塊，網址裡用的名稱
+    ROSTER_SECTIONS = {
+        'admins': ADMIN,
+        'members': MEMBER,
+        'pending': PENDING,
+    }
+
+    @classmethod
+    def roster_counts(cls, group_id):
+        counts = dict(cls.objects.filter(group_id=group_id).order_by()
+                      .values_list('status').annotate(models.Count('id')))
+        return {name: counts.get(status, 0) for name, status in cls.ROSTER_SECTIONS.items()}
 
     @property
     def is_member(self):
-        return self.status in [self.ORGANIZER, self.ADMIN, self.MEMBER]
+        return self.status in self.MEMBER_STATUSES
 
     @property
     def is_admin(self):
@@ -174,6 +305,30 @@ class Membership(models.Model):
     def is_organizer(self):
         return self.status == self.ORGANIZER
 
+    def set_status(self, status):
+        """
+        Change status and the group's counters in one transaction. The UPDATE is
+        conditional on the status we read, so two admins approving the same
+        application at once only count it once. Returns False if it lost that race.
+        """
+        previous_status = self.status
+        with transaction.atomic():
+            if not Membership.objects.filter(pk=self.pk, status=previous_status).update(status=status):
+                return False
+            Group.update_counts(self.group_id, removed=previous_status, added=status)
+            self.status = status
+            # update()不會觸發signal，手動送讓快取失效、通知線上的人
+            post_save.send(sender=Membership, instance=self, created=False, update_fields={'status'},
+                           raw=False, using=self._state.db, previous_status=previous_status)
+        return True
+
+    def remove(self):
+        with transaction.atomic():
+            deleted = Membership.objects.filter(pk=self.pk, status=self.status).delete()[0]
+            if deleted:
+                Group.update_counts(self.group_id, removed=self.status)
+        return bool(deleted)
+
 
 class EventQuerySet(models.QuerySet):
     def get_public(self):
@@ -182,13 +337,32 @@ class EventQuerySet(models.QuerySet):
     def get_valid(self):
         return self.filter(is_expired=False)
 
+    def visible_to(self, user):
+        """
+        Events `user` may view (see MembershipResolver.can_view): public ones, their own,
+        and those of groups they are a member of, checked with one EXISTS in the same query.
+        """
+        if not user.is_authenticated:
+            return self.get_public()
+        member = Exists(Membership.objects.filter(group_id=OuterRef('group_id'), player_id=user.id,
+                                                  status__in=Membership.MEMBER_STATUSES))
+        return self.filter(Q(is_public=True) | Q(initiator_id=user.id) | Q(member))
+
+    def near(self, latitude, longitude, km):
+        from .court_index import court_index
+        return self.filter(court_id__in=[pk for pk, distance in court_index.within(latitude, longitude, km)])
+
+    def in_city(self, city):
+        from .court_index import court_index
+        return self.filter(court_id__in=court_index.in_city(city))
+
 
 class EventManager(models.Manager):
     def get_queryset(self):
         return super().get_queryset().select_related('group', 'court')
 
 
-class Event(models.Model):
+class Event(CounterFieldsMixin, models.Model):
     NET_TYPE_CHOICES = [
         (0, 'Middle'),
         (1, 'Male'),
@@ -204,6 +378,8 @@ class Event(models.Model):
     # play_end_time = models.TimeField(_('play end time'), )
     is_expired = models.BooleanField(_('is expired'), default=False)
     player_quota = models.PositiveSmallIntegerField(_('player quota'), blank=False, default=6)
+    participant_count = models.PositiveSmallIntegerField(_('participant count'), default=0, editable=False)
+    counter_fields = ('participant_count',)
     play_detail = models.TextField(_('play detail'), max_length=300, blank=True)
     participants = models.ManyToManyField(Player, through='Participation', related_name='participations')
     # net_type = models.PositiveSmallIntegerField(_('net type'), choices=NET_TYPE_CHOICES, default=1)
@@ -212,6 +388,15 @@ class Event(models.Model):
 
     class Meta:
         ordering = ['play_date', 'play_start_time']
+        indexes = [
+            models.Index(fields=['is_expired', 'play_date', 'play_start_time'], name='event_expiry_idx'),
+            # 預設排序和admin的date_hierarchy
+            models.Index(fields=['play_date', 'play_start_time'], name='event_play_date_idx'),
+            # visible_to()的三個條件
+            models.Index(fields=['is_expired', 'is_public', 'play_date', 'play_start_time'], name='event_public_idx'),
+            models.Index(fields=['initiator', 'is_expired', 'play_date'], name='event_initiator_idx'),
+            models.Index(fields=['group', 'is_expired', 'play_date'], name='event_group_idx'),
+        ]
 
     def __str__(self):
         return '{} {} {}'.format(self.play_date.strftime(settings.DATE_FORMAT), self.play_start_time.strftime(settings.TIME_FORMAT), self.court.name)
@@ -220,17 +405,10 @@ class Event(models.Model):
         return reverse('event-detail', args=[str(self.id)])
 
     def get_group_membership(self, user):
-        try:
-            return Membership.objects.get(group=self.group, player=user)
-        except:
-            return None
+        from .permissions import MembershipResolver
+        return MembershipResolver.for_user(user).get(self.group_id)
 
     def has_group_member(self, user):
-        # try:
-        #     membership = Membership.objects.get(group=self.group, player=user)
-        #     return membership.is_admin()
-        # except Membership.DoesNotExist:
-        #     return False
         membership = self.get_group_membership(user)
         if membership:
             return membership.is_member
@@ -245,10 +423,47 @@ class Event(models.Model):
             return False
 
     def is_viewable_by(self, user):
-        return self.is_public or self.initiator == user or self.has_group_member(user)
+        from .permissions import MembershipResolver
+        return MembershipResolver.for_user(user).can_view(self)
 
     def can_edit_by(self, user):
-        return not self.is_expired and user.is_authenticated and (self.initiator == user or self.has_group_admin(user))
+        from .permissions import MembershipResolver
+        return MembershipResolver.for_user(user).can_edit(self)
+
+    @property
+    def is_full(self):
+        return self.participant_count >= self.player_quota
+
+    def add_participant(self, player):
+        """
+        Reserve a seat with a conditional UPDATE on the counter, so concurrent
+        signups can never push participant_count past player_quota.
+        Returns False if the event is full, True once the player holds a seat.
+        """
+        if Participation.objects.filter(event_id=self.pk, player=player).exists():
+            return True
+        try:
+            with transaction.atomic():
+                reserved = Event.objects.filter(
+                    pk=self.pk, is_expired=False, participant_count__lt=F('player_quota')
+                ).update(participant_count=F('participant_count') + 1)
+                if not reserved:
+                    return False
+                Participation.objects.create(event_id=self.pk, player=player)
+        except IntegrityError:
+            # 同一個人同時按了兩次，另一個request已經報名成功
+            return True
+        self.participant_count += 1
+        return True
+
+    def remove_participant(self, player):
+        with transaction.atomic():
+            deleted = Participation.objects.filter(event_id=self.pk, player=player).delete()[0]
+            if deleted:
+                Event.objects.filter(pk=self.pk).update(participant_count=F('participant_count') - 1)
+        if deleted:
+            self.participant_count -= 1
+        return bool(deleted)
 
 
 class Participation(models.Model):
@@ -260,3 +475,109 @@ class Participation(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['event', 'player'], name='unique_participation')
         ]
+
+
+class ArchivedEvent(models.Model):
+    """
+    An expired event moved out of Event by archive_events, keeping its id.
+    Same columns minus the ones that only matter while an event is open.
+    """
+    id = models.PositiveIntegerField(primary_key=True)
+    initiator = models.ForeignKey(Player, verbose_name=_('initiator'), on_delete=models.CASCADE)
+    group = models.ForeignKey(Group, verbose_name=_('group'), on_delete=models.CASCADE, null=True)
+    is_public = models.BooleanField(_('is public'), default=True)
+    court = models.ForeignKey(Court, verbose_name=_('court'), on_delete=models.CASCADE)
+    court_detail = models.TextField(_('court detail'), max_length=300, blank=True)
+    play_date = models.DateField(_('play date'))
+    play_start_time = models.TimeField(_('play start time'), )
+    player_quota = models.PositiveSmallIntegerField(_('player quota'), default=6)
+    participant_count = models.PositiveSmallIntegerField(_('participant count'), default=0)
+    play_detail = models.TextField(_('play detail'), max_length=300, blank=True)
+    archived_at = models.DateTimeField(_('archived at'), auto_now_add=True)
+
+    class Meta:
+        ordering = ['play_date', 'play_start_time']
+        indexes = [
+            models.Index(fields=['group', 'play_date', 'play_start_time'], name='archived_event_group_idx'),
+        ]
+
+    def __str__(self):
+        return '{} {} {}'.format(self.play_date.strftime(settings.DATE_FORMAT), self.play_start_time.strftime(settings.TIME_FORMAT), self.court.name)
+
+
+class ArchivedParticipation(models.Model):
+    id = models.PositiveIntegerField(primary_key=True)
+    player = models.ForeignKey(Player, on_delete=models.CASCADE)
+    event = models.ForeignKey(ArchivedEvent, on_delete=models.CASCADE, related_name='participations')
+
+    class Meta:
+        ordering = ['id']
+
+
+class Notification(models.Model):
+    """
+    Outbox row: one thing to tell one player, written in the same transaction as the change
+    it reports. send_notifications mails them as per-recipient digests and deletes them.
+    """
+    GROUP_EVENT = 0
+    MEMBERSHIP_APPROVED = 1
+    KIND_CHOICES = [
+        (GROUP_EVENT, 'group event'),
+        (MEMBERSHIP_APPROVED, 'membership approved'),
+    ]
+    recipient = models.ForeignKey(Player, on_delete=models.CASCADE, related_name='+')
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='+')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # 每批挑最早在等的收件人，再一次取出他所有的通知
+            models.Index(fields=['recipient', 'id'], name='notification_recipient_idx'),
+        ]
+
+
+class Job(models.Model):
+    """
+    Background work queued in the database (see volleyball.jobs). run_worker claims ready rows
+    under a lease, runs them and deletes them; failures come back after a backoff until
+    max_attempts, then stay as FAILED for a look in the admin.
+    """
+    QUEUED = 0
+    RUNNING = 1
+    FAILED = 2
+    STATUS_CHOICES = [
+        (QUEUED, 'queued'),
+        (RUNNING, 'running'),
+        (FAILED, 'failed'),
+    ]
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=QUEUED)
+    # 大的先跑
+    priority = models.SmallIntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=1)
+    dedup_key = models.CharField(max_length=255, null=True, blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-priority', 'run_at', 'id']
+        constraints = [
+            # 同一個key只會有一個在排隊 (status=QUEUED)，跑的時候可以再排一個
+            models.UniqueConstraint(fields=['dedup_key'], condition=Q(status=0), name='unique_queued_job'),
+        ]
+        indexes = [
+            # worker領工作：排隊中、時間到了，依優先序
+            models.Index(fields=['status', 'priority', 'run_at'], name='job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return '%s #%s' % (self.name, self.pk)
@@ -0,0 +1,119 @@
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Min
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.translation import ngettext
+
+from .jobs import job
+from .models import Membership, Notification
+
+logger = logging.getLogger(__name__)
+
+DRAIN_STATS_KEY = 'notifications:drain'
+
+
+def notify_group_event(event):
+    """Queue a notification of a new group event for every other member. Call inside the event's transaction."""
+    recipients = (Membership.objects.filter(group_id=event.group_id)
+                  .exclude(status=Membership.PENDING).exclude(player_id=event.initiator_id)
+                  .values_list('player_id', flat=True))
+    Notification.objects.bulk_create([
+        Notification(recipient_id=player_id, kind=Notification.GROUP_EVENT, group_id=event.group_id, event=event)
+        for player_id in recipients
+    ], batch_size=500)
+    schedule_drain()
+
+
+def notify_membership_approved(membership):
+    Notification.objects.create(recipient_id=membership.player_id, kind=Notification.MEMBERSHIP_APPROVED,
+                                group_id=membership.group_id)
+    schedule_drain()
+
+
+def schedule_drain():
+    # 只會有一個drain在排隊；晚一點才送，這段期間的通知併成同一封digest
+    drain.schedule(timezone.now() + timedelta(seconds=settings.NOTIFICATION_DRAIN_DELAY))
+
+
+@job(unique=True)
+def drain():
+    send_notifications()
+
+
+def digest(recipient, notifications, site):
+    count = len(notifications)
+    subject = ngettext('[%(site)s] %(count)d new update', '[%(site)s] %(count)d new updates', count) % {
+        'site': site.name, 'count': count}
+    body = render_to_string('volleyball/email/digest.txt', {
+        'recipient': recipient, 'notifications': notifications, 'site': site,
+        'GROUP_EVENT': Notification.GROUP_EVENT, 'MEMBERSHIP_APPROVED': Notification.MEMBERSHIP_APPROVED,
+    })
+    return EmailMessage(subject, body, to=[recipient.email])
+
+
+def send_notifications(batch_size=None, connection=None):
+    """
+    Drain the outbox. Each batch takes the `batch_size` recipients waiting longest and all of
+    their notifications, so every recipient gets one digest however many rows piled up; the
+    batch goes out with one send_messages() on a single backend connection, and its rows are
+    deleted only after that. Returns a list of (notifications, messages, seconds) per batch.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    connection = connection or get_connection()
+    site = Site.objects.get_current()
+    batches = []
+    with connection:
+        while True:
+            started = time.monotonic()
+            recipient_ids = list(Notification.objects.order_by().values('recipient_id')
+                                 .annotate(first=Min('id')).order_by('first')
+                                 .values_list('recipient_id', flat=True)[:batch_size])
+            if not recipient_ids:
+                break
+            notifications = list(Notification.objects.filter(recipient_id__in=recipient_ids)
+                                 .select_related('recipient', 'group', 'event__court'))
+            by_recipient = defaultdict(list)
+            for notification in notifications:
+                by_recipient[notification.recipient].append(notification)
+            messages = [digest(recipient, items, site) for recipient, items in by_recipient.items()]
+            connection.send_messages(messages)
+            Notification.objects.filter(pk__in=[notification.pk for notification in notifications]).delete()
+            batches.append((len(notifications), len(messages), time.monotonic() - started))
+            logger.info('sent %d notifications as %d messages in %.3fs', *batches[-1])
+            if len(recipient_ids) < batch_size:
+                break
+    if batches:
+        _record_drain(batches)
+    return batches
+
+
+def _record_drain(batches):
+    notifications = sum(batch[0] for batch in batches)
+    seconds = sum(batch[2] for batch in batches)
+    stats = cache.get(DRAIN_STATS_KEY) or {'notifications': 0, 'messages': 0}
+    stats.update({
+        'notifications': stats['notifications'] + notifications,
+        'messages': stats['messages'] + sum(batch[1] for batch in batches),
+        'last_drained_at': time.time(),
+        'last_rate': round(notifications / seconds, 1) if seconds else None,
+    })
+    cache.set(DRAIN_STATS_KEY, stats, None)
+
+
+def queue_stats():
+    """Outbox depth and age of the oldest row, plus totals and rate (per second) of the drains so far."""
+    oldest = Notification.objects.order_by('id').values_list('created_at', flat=True).first()
+    stats = {
+        'depth': Notification.objects.count(),
+        'oldest_age_s': round(time.time() - oldest.timestamp(), 1) if oldest else None,
+    }
+    stats.update(cache.get(DRAIN_STATS_KEY) or {})
+    return stats
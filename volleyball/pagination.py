@@ -0,0 +1,149 @@
+import json
+
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorSerializer:
+    # signing預設的JSONSerializer不能處理date/time
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'), cls=DjangoJSONEncoder).encode('latin-1')
+
+    def loads(self, data):
+        return json.loads(data.decode('latin-1'))
+
+
+class KeysetPage:
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<KeysetPage of %d>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Cursor paginator that seeks on the ordering key instead of using OFFSET,
+    so every page costs the same single LIMIT query however deep it is.
+    `ordering` must end in a unique field; 'id' is appended if missing.
+    Rows may be model instances or dicts from values().
+    """
+    salt = 'volleyball.pagination'
+
+    def __init__(self, object_list, per_page, ordering, with_count=False):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.ordering = list(ordering)
+        if not {'id', 'pk', '-id', '-pk'} & set(self.ordering):
+            self.ordering.append('id')
+        self.with_count = with_count
+        opts = object_list.model._meta
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in self.ordering]
+        self.model_fields = [opts.pk if name == 'pk' else opts.get_field(name) for name, _ in self.fields]
+
+    @cached_property
+    def count(self):
+        """Total number of rows, or None when the count query is skipped."""
+        if not self.with_count:
+            return None
+        return self.object_list.count()
+
+    def encode_cursor(self, row, backwards=False):
+        return signing.dumps([self._key(row), backwards], salt=self.salt, serializer=CursorSerializer)
+
+    def decode_cursor(self, cursor):
+        try:
+            values, backwards = signing.loads(cursor, salt=self.salt, serializer=CursorSerializer)
+            if len(values) != len(self.fields):
+                raise ValueError
+            values = [field.to_python(value) for field, value in zip(self.model_fields, values)]
+        except (signing.BadSignature, ValidationError, ValueError, TypeError) as e:
+            raise InvalidCursor(_('Invalid cursor.')) from e
+        return values, bool(backwards)
+
+    def page(self, cursor=None):
+        values, backwards = self.decode_cursor(cursor) if cursor else (None, False)
+        queryset = self.object_list.order_by(*self._ordering(backwards))
+        if values is not None:
+            queryset = queryset.filter(self._seek(values, backwards))
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+        has_next = has_more if not backwards else True
+        has_previous = values is not None if not backwards else has_more
+        return KeysetPage(
+            rows, self,
+            next_cursor=self.encode_cursor(rows[-1]) if rows and has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], backwards=True) if rows and has_previous else None,
+        )
+
+    def _key(self, row):
+        if isinstance(row, dict):
+            return [row[name] for name, _ in self.fields]
+        return [getattr(row, field.attname) for field in self.model_fields]
+
+    def _ordering(self, backwards):
+        return ['%s%s' % ('-' if desc != backwards else '', name) for name, desc in self.fields]
+
+    def _seek(self, values, backwards):
+        # (a, b, c) > (x, y, z)  =>  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q()
+        equal = {}
+        for (name, desc), value in zip(self.fields, values):
+            lookup = 'lt' if desc != backwards else 'gt'
+            condition |= Q(**equal, **{'%s__%s' % (name, lookup): value})
+            equal[name] = value
+        return condition
+
+
+class KeysetPaginationMixin:
+    """ListView mixin replacing the OFFSET paginator with KeysetPaginator."""
+    cursor_kwarg = 'cursor'
+    paginate_with_count = False
+
+    def get_keyset_ordering(self, queryset):
+        return self.get_ordering() or queryset.model._meta.ordering
+
+    def get_keyset_paginator(self, queryset, page_size):
+        return KeysetPaginator(queryset, page_size, self.get_keyset_ordering(queryset),
+                               with_count=self.paginate_with_count)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor as e:
+            raise Http404(e)
+        return paginator, page, page.object_list, page.has_other_pages()
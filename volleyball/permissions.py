@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import cached_property
+
+from .caching import get_versions, make_key
+from .models import Event, Membership
+from .routers import cache_timeout
+
+
+class MembershipResolver:
+    """
+    All of a user's memberships keyed by group_id, loaded with one query and cached across
+    requests until the player or one of their memberships changes.
+    Use for_user() so the map is shared by every check made during a request.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    @classmethod
+    def for_user(cls, user):
+        # request.user只活在一個request裡，掛在上面就是per-request
+        resolver = getattr(user, '_membership_resolver', None)
+        if resolver is None:
+            resolver = cls(user)
+            user._membership_resolver = resolver
+        return resolver
+
+    @cached_property
+    def memberships(self):
+        if not self.user.is_authenticated:
+            return {}
+        user_id = self.user.id
+        key = make_key('memberships', user_id, *get_versions('user:%d' % user_id, 'memberships:%d' % user_id))
+        memberships = cache.get(key)
+        if memberships is None:
+            memberships = {m.group_id: m for m in Membership.objects.filter(player_id=user_id)}
+            cache.set(key, memberships, cache_timeout(settings.MEMBERSHIP_CACHE_TIMEOUT))
+        return memberships
+
+    def get(self, group_id):
+        if group_id is None:
+            return None
+        return self.memberships.get(group_id)
+
+    def is_member(self, group_id):
+        membership = self.get(group_id)
+        return membership is not None and membership.is_member
+
+    def is_admin(self, group_id):
+        membership = self.get(group_id)
+        return membership is not None and membership.is_admin
+
+    def can_view(self, event):
+        return event.is_public or event.initiator_id == self.user.id or self.is_member(event.group_id)
+
+    def can_edit(self, event):
+        return (not event.is_expired and self.user.is_authenticated
+                and (event.initiator_id == self.user.id or self.is_admin(event.group_id)))
+
+    def viewable(self, events):
+        """Ids of the given events (instances, a queryset or ids) the user can view."""
+        return {event.id for event in self._rows(events) if self.can_view(event)}
+
+    def editable(self, events):
+        """Ids of the given events (instances, a queryset or ids) the user can edit."""
+        return {event.id for event in self._rows(events) if self.can_edit(event)}
+
+    def _rows(self, events):
+        if not hasattr(events, 'model'):
+            events = list(events)
+            if not events or isinstance(events[0], Event):
+                return events
+            events = Event.objects.filter(pk__in=events)
+        return events.select_related(None).only('id', 'is_public', 'is_expired', 'initiator', 'group')
@@ -0,0 +1,153 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+# 目前這個request (thread/context) 的讀取alias，以及是否已經寫過
+_state = Local()
+
+
+def _pin_key(user_id):
+    return 'primary-pin:%d' % user_id
+
+
+class ReplicaHealth:
+    """Replicas that failed to connect or answer are left out for REPLICA_RETRY_AFTER seconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.down_until = {}
+
+    def healthy(self, aliases):
+        now = time.monotonic()
+        with self.lock:
+            return [alias for alias in aliases if self.down_until.get(alias, 0) <= now]
+
+    def mark_down(self, alias):
+        logger.warning('replica %s marked down for %ss', alias, settings.REPLICA_RETRY_AFTER)
+        with self.lock:
+            self.down_until[alias] = time.monotonic() + settings.REPLICA_RETRY_AFTER
+
+    def reset(self):
+        with self.lock:
+            self.down_until.clear()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                alias: {'healthy': self.down_until.get(alias, 0) <= now,
+                        'retry_in': max(0, round(self.down_until.get(alias, 0) - now, 1))}
+                for alias in settings.DATABASE_REPLICAS
+            }
+
+
+health = ReplicaHealth()
+
+
+def choose_replica():
+    """A healthy replica that accepts a connection, or None to stay on the primary."""
+    aliases = health.healthy(settings.DATABASE_REPLICAS)
+    random.shuffle(aliases)
+    for alias in aliases:
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError:
+            health.mark_down(alias)
+            continue
+        return alias
+    return None
+
+
+def reading_from_replica():
+    return getattr(_state, 'alias', None) not in (None, DEFAULT_DB_ALIAS)
+
+
+def cache_timeout(timeout):
+    """Cap `timeout` while reading from a replica: the data may lag the version stamp it gets cached under."""
+    if reading_from_replica():
+        return min(timeout, settings.REPLICA_CACHE_TIMEOUT)
+    return timeout
+
+
+@contextmanager
+def read_from(alias):
+    previous = getattr(_state, 'alias', None)
+    _state.alias = alias
+    try:
+        yield
+    finally:
+        _state.alias = previous
+
+
+def recently_wrote(user):
+    return user.is_authenticated and cache.get(_pin_key(user.pk)) is not None
+
+
+class ReplicaRouter:
+    """
+    Reads go to the alias picked by read_from() (a replica inside ReplicaReadMixin views) and
+    to the primary everywhere else; once the current request has written, it reads the primary too.
+    Writes always go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'wrote', False):
+            return DEFAULT_DB_ALIAS
+        return getattr(_state, 'alias', None) or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 副本和primary是同一份資料
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaMiddleware:
+    """Pin a user to the primary for REPLICA_STICKY_SECONDS after any request of theirs that wrote."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.wrote = False
+        response = self.get_response(request)
+        if _state.wrote and request.user.is_authenticated:
+            cache.set(_pin_key(request.user.pk), True, settings.REPLICA_STICKY_SECONDS)
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    Serve a read-only view from a replica, unless the user wrote recently or no replica is
+    healthy. A replica failing mid-request is marked down and the view is re-run on the primary.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        alias = None if recently_wrote(request.user) else choose_replica()
+        if alias is None:
+            return super().dispatch(request, *args, **kwargs)
+        try:
+            with read_from(alias):
+                response = super().dispatch(request, *args, **kwargs)
+                # TemplateResponse在view外面才render，要在這裡render才會用到副本
+                if callable(getattr(response, 'render', None)):
+                    response.render()
+                return response
+        except DatabaseError:
+            logger.exception('read from replica %s failed, retrying on the primary', alias)
+            health.mark_down(alias)
+            return super().dispatch(request, *args, **kwargs)
@@ -0,0 +1,164 @@
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from .caching import bump_version, get_versions, make_key
+from .models import Court, Group, Event
+
+TABLE = 'volleyball_search'
+KINDS = {'court': (1, Court), 'group': (2, Group), 'event': (3, Event)}
+KIND_CODES = {code: kind for kind, (code, model) in KINDS.items()}
+
+# 中日韓字的範圍；第二組要排除，NTU排球場才會切成 ntu 和 排球場
+CJK = r'\u3400-\u9fff\uf900-\ufaff'
+CJK_RUN = re.compile(r'([%s]+)|([^\W%s]+)' % (CJK, CJK))
+
+
+def tokenize(text):
+    """
+    Latin words stay whole; runs of CJK characters become overlapping bigrams plus the
+    final character, so 排球場 -> 排球 球場 場. Every character then starts a token,
+    which lets a single-character query match as a prefix.
+    """
+    tokens = []
+    for cjk, word in CJK_RUN.findall((text or '').lower()):
+        if cjk:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            tokens.append(cjk[-1])
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def build_match(query):
+    tokens = []
+    for cjk, word in CJK_RUN.findall(query.lower()):
+        if cjk and len(cjk) == 1:
+            tokens.append('"%s"*' % cjk)
+        elif cjk:
+            tokens.extend('"%s"' % cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append('"%s"' % word)
+    if tokens and not tokens[-1].endswith('*') and query.rstrip() == query:
+        # 最後一個字可能還沒打完
+        tokens[-1] += '*'
+    return ' '.join(tokens)
+
+
+def is_available():
+    return connection.vendor == 'sqlite'
+
+
+def create_table(using=None, **kwargs):
+    if is_available():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, body, tokenize='unicode61')" % TABLE)
+
+
+def document(instance):
+    """(rowid, title, body) for an indexed object, or None if it should not be searchable."""
+    if isinstance(instance, Court):
+        title, body = instance.name, '%s %s' % (instance.address, instance.get_city_display() or '')
+    elif isinstance(instance, Group):
+        title, body = instance.name, instance.about
+    elif isinstance(instance, Event):
+        if not instance.is_public or instance.is_expired:
+            return None
+        title, body = str(instance), '%s %s' % (instance.court_detail, instance.play_detail)
+    else:
+        return None
+    return rowid(instance), ' '.join(tokenize(title)), ' '.join(tokenize(body))
+
+
+def rowid(instance):
+    # kind code放在低位，rowid同時決定了種類和id
+    return instance.pk * 4 + KINDS[instance._meta.model_name][0]
+
+
+def index_objects(instances):
+    if not is_available():
+        return
+    instances = list(instances)
+    docs = [doc for doc in map(document, instances) if doc]
+    with connection.cursor() as cursor:
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % TABLE, [(rowid(i),) for i in instances])
+        cursor.executemany('INSERT INTO %s (rowid, title, body) VALUES (%%s, %%s, %%s)' % TABLE, docs)
+    bump_version(*{version_name(instance._meta.model_name) for instance in instances})
+
+
+def remove_object(instance):
+    remove_ids(instance._meta.model_name, [instance.pk])
+
+
+def remove_ids(kind, ids):
+    """Drop objects of `kind` from the index without loading them (bulk updates and deletes skip the signals)."""
+    if not is_available() or not ids:
+        return
+    code = KINDS[kind][0]
+    with connection.cursor() as cursor:
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % TABLE, [(pk * 4 + code,) for pk in ids])
+    bump_version(version_name(kind))
+
+
+def version_name(kind):
+    # 每種各自一個stamp，改一個球場不會讓只搜活動的快取失效
+    return 'search:%s' % kind
+
+
+def rebuild(batch_size=1000):
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS %s' % TABLE)
+    create_table()
+    total = 0
+    for kind, (code, model) in KINDS.items():
+        queryset = model.objects.all()
+        if model is Event:
+            queryset = queryset.get_valid().get_public()
+        batch = []
+        for instance in queryset.iterator(chunk_size=batch_size):
+            batch.append(instance)
+            if len(batch) >= batch_size:
+                index_objects(batch)
+                total += len(batch)
+                batch = []
+        index_objects(batch)
+        total += len(batch)
+    return total
+
+
+def search_ids(query, kind=None):
+    """Ranked [(kind, id)] for a query, cached per query until the index changes."""
+    match = build_match(query)
+    if not match or not is_available():
+        return []
+    key = make_key('search', match, kind or '', *get_versions(*map(version_name, [kind] if kind else KINDS)))
+    hits = cache.get(key)
+    if hits is None:
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH %%s' % (TABLE, TABLE)
+        params = [match]
+        if kind:
+            sql += ' AND rowid %% 4 = %s'
+            params.append(KINDS[kind][0])
+        sql += ' ORDER BY bm25(%s, 10.0, 1.0) LIMIT %%s' % TABLE
+        params.append(settings.SEARCH_MAX_RESULTS)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            hits = [(KIND_CODES[row % 4], row // 4) for row, in cursor.fetchall()]
+        cache.set(key, hits, settings.SEARCH_CACHE_TIMEOUT)
+    return hits
+
+
+def hydrate(hits):
+    """Load the objects for a page of hits, one query per kind, keeping the ranking order."""
+    objects = {}
+    for kind, (code, model) in KINDS.items():
+        ids = [pk for hit_kind, pk in hits if hit_kind == kind]
+        if ids:
+            queryset = model.objects.all()
+            if model is Event:
+                queryset = queryset.get_valid().get_public()
+            objects.update({(kind, pk): obj for pk, obj in queryset.in_bulk(ids).items()})
+    return [(kind, objects[kind, pk]) for kind, pk in hits if (kind, pk) in objects]
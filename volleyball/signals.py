@@ -0,0 +1,144 @@
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import live, search
+from .caching import bump_version
+from .court_index import court_index, court_names
+from .models import Player, Court, Group, Event, Membership, Participation
+from .notifications import notify_membership_approved
+
+
+@receiver([post_save, post_delete], sender=Player)
+def player_changed(sender, instance, update_fields=None, **kwargs):
+    # 快取的登入使用者 (backends.CachedUserMixin)，連改密碼、更新last_login都要失效
+    bump_version('user:%d' % instance.pk)
+    # 登入只會更新last_login，不影響顯示的名字
+    if update_fields is None or {'first_name', 'last_name'} & set(update_fields):
+        bump_version('player-names')
+
+
+@receiver(user_logged_out)
+def player_logged_out(sender, request, user, **kwargs):
+    if user is not None:
+        bump_version('user:%d' % user.pk)
+
+
+@receiver([post_save, post_delete], sender=Court)
+def court_changed(sender, instance, **kwargs):
+    bump_version('court-list')
+
+
+@receiver(post_save, sender=Court)
+def court_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: court_index.update(instance))
+    transaction.on_commit(lambda: court_names.update(instance))
+
+
+@receiver(post_delete, sender=Court)
+def court_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: court_index.delete(pk))
+    transaction.on_commit(lambda: court_names.delete(pk))
+
+
+@receiver([post_save, post_delete], sender=Group)
+def group_changed(sender, instance, **kwargs):
+    bump_version('group-list', 'group:%d' % instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Participation)
+def participation_changed(sender, instance, **kwargs):
+    bump_version('player:%d' % instance.player_id, 'event:%d' % instance.event_id, 'event-list')
+
+
+@receiver([post_save, post_delete], sender=Membership)
+def membership_changed(sender, instance, **kwargs):
+    # 球團列表會顯示人數
+    bump_version('player:%d' % instance.player_id, 'memberships:%d' % instance.player_id,
+                 'group:%d' % instance.group_id, 'group-list')
+
+
+@receiver([post_save, post_delete], sender=Event)
+def event_changed(sender, instance, **kwargs):
+    names = ['player:%d' % instance.initiator_id, 'event:%d' % instance.pk, 'event-list']
+    if instance.group_id:
+        names.append('group:%d' % instance.group_id)
+    bump_version(*names)
+
+
+@receiver(post_save, sender=Court)
+@receiver(post_save, sender=Group)
+@receiver(post_save, sender=Event)
+def update_search_index(sender, instance, **kwargs):
+    search.index_objects([instance])
+
+
+@receiver(post_delete, sender=Court)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Event)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.remove_object(instance)
+
+
+def publish_participants(event_id, change):
+    # commit之後才通知，人數直接從counter讀，一次寫入只查一次
+    def send():
+        row = Event.objects.filter(pk=event_id).values('participant_count', 'player_quota').first()
+        if row is not None:
+            live.publish('event:%d' % event_id, 'participants', dict(change, **row))
+    transaction.on_commit(send)
+
+
+@receiver(post_save, sender=Participation)
+def participation_saved(sender, instance, created, **kwargs):
+    if created:
+        publish_participants(instance.event_id, {'action': 'joined', 'player': instance.player_id,
+                                                 'name': str(instance.player)})
+
+
+@receiver(post_delete, sender=Participation)
+def participation_deleted(sender, instance, **kwargs):
+    publish_participants(instance.event_id, {'action': 'left', 'player': instance.player_id})
+
+
+ROSTER_SECTION_NAMES = {status: name for name, status in Membership.ROSTER_SECTIONS.items()}
+
+
+def publish_roster(instance, action, previous_status=None, status=None):
+    """
+    Roster changes go out as section deltas, so sending them needs no query. Moderators get every
+    change; the public stream leaves out the pending section, and changes only it saw.
+    """
+    change = {
+        'action': action,
+        'player': instance.player_id,
+        # 申請中的人只有管理員看得到名字
+        'name': str(instance.player) if status not in (None, Membership.PENDING) else None,
+        'from': ROSTER_SECTION_NAMES.get(previous_status),
+        'to': ROSTER_SECTION_NAMES.get(status),
+    }
+    public = dict(change, **{end: None for end in ('from', 'to') if change[end] == 'pending'})
+
+    def send():
+        live.publish(live.moderators_topic(instance.group_id), 'roster', change)
+        if public['from'] or public['to']:
+            live.publish('group:%d' % instance.group_id, 'roster', public)
+    transaction.on_commit(send)
+
+
+@receiver(post_save, sender=Membership)
+def membership_saved(sender, instance, created, previous_status=None, **kwargs):
+    if created:
+        publish_roster(instance, 'joined', status=instance.status)
+    elif previous_status is not None:
+        publish_roster(instance, 'moved', previous_status, instance.status)
+        if previous_status == Membership.PENDING and instance.is_member:
+            # set_status還在transaction裡，和狀態變更一起commit
+            notify_membership_approved(instance)
+
+
+@receiver(post_delete, sender=Membership)
+def membership_deleted(sender, instance, **kwargs):
+    publish_roster(instance, 'left', previous_status=instance.status)
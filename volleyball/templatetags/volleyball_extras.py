@@ -0,0 +1,33 @@
+from django import template
+from django.conf import settings
+
+from ..images import derivative_url
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def query_replace(context, **kwargs):
+    """Current query string with the given parameters replaced, e.g. for pagination links."""
+    query = context['request'].GET.copy()
+    for key, value in kwargs.items():
+        if value is None:
+            query.pop(key, None)
+        else:
+            query[key] = value
+    return query.urlencode()
+
+
+@register.simple_tag
+def photo_url(photo, digest, size, fmt='jpeg'):
+    """URL of one size of a court photo, e.g. {% photo_url court.photo court.photo_hash 'thumb' %}."""
+    return derivative_url(photo, digest, size, fmt)
+
+
+@register.simple_tag
+def photo_srcset(photo, digest, fmt='jpeg'):
+    """`srcset` value listing every size of a court photo in one format, with width descriptors."""
+    if not digest:
+        return ''
+    return ', '.join('%s %dw' % (derivative_url(photo, digest, size, fmt), width)
+                     for size, width in sorted(settings.IMAGE_SIZES.items(), key=lambda item: item[1]))
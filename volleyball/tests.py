@@ -1,3 +1,1230 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
+from datetime import date, datetime, time
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
+from django.urls import path, reverse
+
+from .archive import archive_events, event_history
+from .benchmark import compare, run_benchmarks
+from .caching import get_versions
+from .court_index import court_index, court_names
+from .dashboard import get_dashboard
+from .expiry import expire_past_events
+from . import images
+from .instrumentation import fingerprint, registry
+from .jobs import DONE, FAILED, RETRY, Worker, claim, delete_group, job, job_stats, run_job
+from .live import FileSpoolBackend, Hub, live_application
+from .loadgen import generate_load_data
+from .models import (Player, Court, Event, Group, Membership, Participation, ArchivedEvent, ArchivedParticipation, Job,
+                     Notification)
+from .notifications import queue_stats, send_notifications
+from .pagination import KeysetPaginator
+from .permissions import MembershipResolver
+from .routers import health
+from . import search
+from .search import search_ids, tokenize
+
+
+def create_player(n):
+    return Player.objects.create_user('p%02d@example.com' % n, password='pw', first_name='P%02d' % n, last_name='Test')
+
+
+@job(max_attempts=2, unique=True)
+def flaky(n):
+    if n == 0:
+        raise ValueError(n)
+
+
+def whoami_view(request):
+    return HttpResponse(request.user.email if request.user.is_authenticated else '')
+
+
+def n_plus_one_view(request):
+    emails = [event.initiator.email for event in Event.objects.all()]
+    return HttpResponse(len(emails))
+
+
+urlpatterns = [
+    path('n-plus-one/', n_plus_one_view, name='n-plus-one'),
+    path('whoami/', whoami_view, name='whoami'),
+]
+
+
+class EventSignupTest(TestCase):
+    def setUp(self):
+        self.initiator = create_player(0)
+        self.court = Court.objects.create(name='court', address='address')
+        self.event = Event.objects.create(initiator=self.initiator, court=self.court, player_quota=2,
+                                          play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+
+    def test_signup_and_quit_keep_counter(self):
+        player = create_player(1)
+        self.client.force_login(player)
+        self.client.get(reverse('event-signup', args=[self.event.pk]))
+        self.client.get(reverse('event-signup', args=[self.event.pk]))
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.participant_count, 1)
+
+        self.client.get(reverse('event-quit', args=[self.event.pk]))
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.participant_count, 0)
+        self.assertFalse(Participation.objects.filter(event=self.event).exists())
+
+    def test_full_event_redirects_with_message(self):
+        for n in (1, 2):
+            self.event.add_participant(create_player(n))
+        self.client.force_login(create_player(3))
+        response = self.client.get(reverse('event-signup', args=[self.event.pk]), follow=True)
+        self.assertContains(response, 'This event is full.')
+        self.assertEqual(Participation.objects.filter(event=self.event).count(), 2)
+
+
+class EventSignupConcurrencyTest(TransactionTestCase):
+    def test_parallel_signups_never_exceed_quota(self):
+        initiator = create_player(0)
+        court = Court.objects.create(name='court', address='address')
+        event = Event.objects.create(initiator=initiator, court=court, player_quota=6,
+                                     play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+        players = [create_player(n) for n in range(1, 21)]
+        results = []
+        barrier = threading.Barrier(len(players))
+
+        def signup(player):
+            try:
+                barrier.wait()
+                results.append(Event.objects.get(pk=event.pk).add_participant(player))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=signup, args=[p]) for p in players]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        event.refresh_from_db()
+        self.assertEqual(results.count(True), 6)
+        self.assertEqual(event.participant_count, 6)
+        self.assertEqual(Participation.objects.filter(event=event).count(), 6)
+
+
+class GroupCounterTest(TestCase):
+    def setUp(self):
+        self.organizer = create_player(0)
+        self.player = create_player(1)
+        court = Court.objects.create(name='court', address='address')
+        self.client.force_login(self.organizer)
+        self.client.post(reverse('group-create'), {'name': 'group', 'court': court.id, 'about': ''})
+        self.group = Group.objects.get()
+
+    def assertCounts(self, members, pending):
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.member_count, self.group.pending_count), (members, pending))
+
+    def test_membership_views_keep_counts(self):
+        self.assertCounts(1, 0)
+        self.client.force_login(self.player)
+        self.client.get(reverse('group-join', args=[self.group.id]))
+        self.assertCounts(1, 1)
+        membership = Membership.objects.get(player=self.player)
+
+        self.client.force_login(self.organizer)
+        self.client.get(reverse('membership-member', args=[membership.id]))
+        self.client.get(reverse('membership-member', args=[membership.id]))
+        self.assertCounts(2, 0)
+        self.client.get(reverse('membership-admin', args=[membership.id]))
+        self.assertCounts(2, 0)
+        self.client.get(reverse('membership-delete', args=[membership.id]))
+        self.assertCounts(1, 0)
+
+        self.client.force_login(self.player)
+        self.client.get(reverse('group-join', args=[self.group.id]))
+        self.client.get(reverse('group-quit', args=[self.group.id]))
+        self.assertCounts(1, 0)
+        self.assertContains(self.client.get(reverse('group-list')), '1 member')
+
+    def test_stale_edit_keeps_counters(self):
+        stale_group = Group.objects.get()
+        event = Event.objects.create(initiator=self.organizer, court=self.group.court, play_date=date(2099, 1, 1),
+                                     play_start_time=time(19, 0))
+        stale_event = Event.objects.get(pk=event.pk)
+        self.group.add_member(self.player, Membership.MEMBER)
+        self.assertTrue(event.add_participant(self.player))
+        # 報名前讀出來的資料，編輯存檔不能把人數寫回去
+        stale_group.about = 'about'
+        stale_group.save()
+        stale_event.play_detail = 'detail'
+        stale_event.save()
+        self.assertCounts(2, 0)
+        self.assertEqual(self.group.about, 'about')
+        event.refresh_from_db()
+        self.assertEqual((event.participant_count, event.play_detail), (1, 'detail'))
+        self.assertTrue(event.remove_participant(self.player))
+        event.refresh_from_db()
+        self.assertEqual(event.participant_count, 0)
+
+    def test_recount_repairs_drift(self):
+        Membership.objects.create(group=self.group, player=self.player, status=Membership.PENDING)
+        event = Event.objects.create(initiator=self.organizer, court=self.group.court, play_date=date(2099, 1, 1),
+                                     play_start_time=time(19, 0))
+        Participation.objects.create(event=event, player=self.player)
+        stamps = ('event:%d' % event.id, 'event-list', 'group:%d' % self.group.id, 'group-list')
+        before = get_versions(*stamps)
+        call_command('recount', stdout=io.StringIO())
+        self.assertCounts(1, 1)
+        event.refresh_from_db()
+        self.assertEqual(event.participant_count, 1)
+        # 快取的頁面跟著失效
+        for old, new in zip(before, get_versions(*stamps)):
+            self.assertGreater(new, old)
+
+
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        self.initiator = create_player(0)
+        court = Court.objects.create(name='court', address='address')
+        self.event = Event.objects.create(initiator=self.initiator, court=court, player_quota=6,
+                                          play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+        self.event.add_participant(create_player(1))
+
+    def test_participants_cached_until_signup(self):
+        url = reverse('event-detail', args=[self.event.pk])
+        player = create_player(2)
+        self.client.force_login(player)
+        # 先讓登入的使用者進快取，只比較參加者名單
+        self.client.get(reverse('court-list'))
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as warm:
+            response = self.client.get(url)
+        self.assertEqual(len(warm), len(cold) - 1)
+        self.assertContains(response, 'P01 Test')
+        self.assertContains(response, reverse('event-signup', args=[self.event.pk]))
+
+        self.client.get(reverse('event-signup', args=[self.event.pk]))
+        response = self.client.get(url)
+        self.assertContains(response, 'P02 Test')
+        self.assertContains(response, '<span id="participant-count">2</span>/6')
+        self.assertContains(response, reverse('event-quit', args=[self.event.pk]))
+
+    def test_participants_follow_renames(self):
+        url = reverse('event-detail', args=[self.event.pk])
+        self.client.force_login(create_player(2))
+        self.assertContains(self.client.get(url), 'P01 Test')
+        participant = Player.objects.get(first_name='P01')
+        participant.first_name = 'Renamed'
+        participant.save()
+        self.assertContains(self.client.get(url), 'Renamed Test')
+
+
+class ListingCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(create_player(0))
+
+    def assert_listing_refreshed_on_change(self):
+        Court.objects.create(name='court a', address='address')
+        self.client.get(reverse('court-list'))
+        # session和使用者都從快取拿
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('court-list'))
+        self.assertEqual([c['name'] for c in response.context['court_list']], ['court a'])
+
+        Court.objects.create(name='court b', address='address')
+        response = self.client.get(reverse('court-list'))
+        self.assertEqual([c['name'] for c in response.context['court_list']], ['court a', 'court b'])
+
+    def test_locmem(self):
+        self.assert_listing_refreshed_on_change()
+
+    def test_file_based(self):
+        with tempfile.TemporaryDirectory() as location:
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location,
+            }}):
+                self.assert_listing_refreshed_on_change()
+
+    def test_city_filter(self):
+        Court.objects.create(name='court a', address='address', city=1)
+        Court.objects.create(name='court b', address='address', city=2)
+        response = self.client.get(reverse('court-list'), {'city': 2})
+        self.assertEqual([c['name'] for c in response.context['court_list']], ['court b'])
+        self.assertEqual(self.client.get(reverse('court-list'), {'city': 'abc'}).status_code, 404)
+
+
+class UserCacheTest(TestCase):
+    def setUp(self):
+        self.player = create_player(1)
+
+    def test_warm_request_skips_session_and_player_queries(self):
+        self.client.force_login(self.player)
+        with self.settings(ROOT_URLCONF='volleyball.tests'):
+            self.client.get('/whoami/')
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get('/whoami/')
+        self.assertEqual(response.content, b'p01@example.com')
+        self.assertEqual(len(captured), 0)
+
+    def test_password_change_and_logout_invalidate(self):
+        self.client.force_login(self.player)
+        with self.settings(ROOT_URLCONF='volleyball.tests'):
+            self.client.get('/whoami/')
+            self.player.set_password('new')
+            self.player.save()
+            self.assertEqual(self.client.get('/whoami/').content, b'')
+            self.client.force_login(self.player)
+            self.assertEqual(self.client.get('/whoami/').content, b'p01@example.com')
+            self.client.logout()
+            self.assertEqual(self.client.get('/whoami/').content, b'')
+
+    def test_email_login_is_case_insensitive(self):
+        self.assertEqual(Player.objects.create_user('Mixed@Example.COM', password='pw').email, 'mixed@example.com')
+        self.assertTrue(self.client.login(username='P01@Example.com', password='pw'))
+        self.assertFalse(self.client.login(username='p01@example.com', password='wrong'))
+
+    def test_bulk_update_invalidates(self):
+        self.client.force_login(self.player)
+        with self.settings(ROOT_URLCONF='volleyball.tests'):
+            self.client.get('/whoami/')
+            Player.objects.filter(pk=self.player.pk).update(is_active=False)
+            self.assertEqual(self.client.get('/whoami/').content, b'')
+
+    def test_normalize_emails(self):
+        # 改成存小寫之前的資料，update()不經過save
+        Player.objects.filter(pk=self.player.pk).update(email='P01@Example.com')
+        first, second = create_player(2), create_player(3)
+        Player.objects.filter(pk=first.pk).update(email='Dup@Example.com')
+        Player.objects.filter(pk=second.pk).update(email='dup@example.COM')
+        with self.assertRaises(Player.DoesNotExist):
+            Player.objects.get_by_natural_key('p01@example.com')
+        out, err = io.StringIO(), io.StringIO()
+        call_command('normalize_emails', stdout=out, stderr=err)
+        self.assertIn('Lowercased 1 emails, 1 left to merge.', out.getvalue())
+        self.assertIn('dup@example.com', err.getvalue())
+        self.assertEqual(Player.objects.get_by_natural_key('P01@example.com'), self.player)
+        self.assertEqual(set(Player.objects.filter(pk__in=[first.pk, second.pk]).values_list('email', flat=True)),
+                         {'Dup@Example.com', 'dup@example.COM'})
+        with self.assertRaises(Player.DoesNotExist):
+            Player.objects.get_by_natural_key('dup@example.com')
+
+
+class ExpirySweepTest(TestCase):
+    def test_expires_past_events_in_batches(self):
+        initiator = create_player(0)
+        court = Court.objects.create(name='court', address='address')
+        for day in range(1, 6):
+            Event.objects.create(initiator=initiator, court=court, play_date=date(2021, 1, day), play_start_time=time(19, 0))
+        today = Event.objects.create(initiator=initiator, court=court, play_date=date(2021, 1, 6), play_start_time=time(21, 0))
+
+        batches = expire_past_events(batch_size=2, now=datetime(2021, 1, 6, 20, 0))
+
+        self.assertEqual([count for count, _ in batches], [2, 2, 1])
+        self.assertEqual(Event.objects.get_valid().get(), today)
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.player = create_player(0)
+        self.court = Court.objects.create(name='court', address='address')
+        self.group = Group.objects.create(name='group', organizer=self.player, court=self.court)
+        self.group.add_member(self.player, Membership.ORGANIZER)
+        self.events = []
+        for day in range(1, 6):
+            event = Event.objects.create(initiator=self.player, court=self.court, group=self.group, is_public=day % 2 == 0,
+                                         play_date=date(2021, 1, day), play_start_time=time(19, 0))
+            event.add_participant(self.player)
+            self.events.append(event)
+        Event.objects.update(is_expired=True)
+
+    def test_moves_old_events_in_batches(self):
+        batches = archive_events(horizon_days=2, batch_size=2, today=date(2021, 1, 6))
+
+        self.assertEqual([batch[:2] for batch in batches], [(2, 2), (1, 1)])
+        self.assertEqual(list(Event.objects.values_list('play_date__day', flat=True)), [4, 5])
+        self.assertEqual(list(ArchivedEvent.objects.values_list('id', flat=True)), [event.id for event in self.events[:3]])
+        self.assertEqual(ArchivedParticipation.objects.filter(player=self.player).count(), 3)
+        self.assertEqual(Participation.objects.count(), 2)
+        self.assertEqual(archive_events(horizon_days=2, today=date(2021, 1, 6)), [])
+
+    def test_history_reads_both_tables(self):
+        archive_events(horizon_days=2, today=date(2021, 1, 6))
+        history = event_history(player=self.player).order_by('-play_date', '-play_start_time', '-id')
+        self.assertEqual([(row['play_date'].day, row['archived']) for row in history],
+                         [(5, False), (4, False), (3, True), (2, True), (1, True)])
+        self.assertEqual(event_history(group=self.group, public_only=True).count(), 2)
+
+        paginator = KeysetPaginator(event_history(player=self.player), 2, ['-play_date', '-play_start_time', '-id'])
+        page = paginator.page()
+        days = [row['play_date'].day for row in page]
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            days += [row['play_date'].day for row in page]
+        self.assertEqual(days, [5, 4, 3, 2, 1])
+
+        self.client.force_login(self.player)
+        response = self.client.get(reverse('event-history'))
+        self.assertEqual(len(response.context['events']), 5)
+        self.assertContains(response, reverse('event-detail', args=[self.events[4].id]))
+        self.assertNotContains(response, reverse('event-detail', args=[self.events[0].id]))
+        self.client.force_login(create_player(1))
+        response = self.client.get(reverse('group-history', args=[self.group.id]))
+        self.assertEqual([row['play_date'].day for row in response.context['events']], [4, 2])
+
+
+class KeysetPaginatorTest(TestCase):
+    def test_walks_forward_and_back_on_ordering_key(self):
+        initiator = create_player(0)
+        court = Court.objects.create(name='court', address='address')
+        for day in (3, 1, 2):
+            for hour in (20, 18):
+                Event.objects.create(initiator=initiator, court=court, play_date=date(2099, 1, day), play_start_time=time(hour, 0))
+        expected = list(Event.objects.all())
+        paginator = KeysetPaginator(Event.objects.all(), 4, Event._meta.ordering)
+
+        first = paginator.page()
+        self.assertEqual(list(first), expected[:4])
+        self.assertFalse(first.has_previous())
+        second = paginator.page(first.next_cursor)
+        self.assertEqual(list(second), expected[4:])
+        self.assertFalse(second.has_next())
+        self.assertEqual(list(paginator.page(second.previous_cursor)), expected[:4])
+        self.assertIsNone(paginator.count)
+
+    def test_list_views_page_by_cursor(self):
+        initiator = create_player(0)
+        self.client.force_login(initiator)
+        for n in range(12):
+            court = Court.objects.create(name='court %02d' % n, address='address')
+            Event.objects.create(initiator=initiator, court=court, play_date=date(2099, 1, 1), play_start_time=time(n, 0))
+        for name in ('court-list', 'event-list', 'group-list'):
+            self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+
+        first = self.client.get(reverse('court-list'))
+        self.assertEqual([c['name'] for c in first.context['court_list']], ['court %02d' % n for n in range(10)])
+        second = self.client.get(reverse('court-list'), {'cursor': first.context['page_obj'].next_cursor})
+        self.assertEqual([c['name'] for c in second.context['court_list']], ['court 10', 'court 11'])
+        self.assertEqual(self.client.get(reverse('event-list'), {'cursor': 'bogus'}).status_code, 404)
+
+
+class MembershipResolverTest(TestCase):
+    def setUp(self):
+        self.organizer = create_player(0)
+        self.player = create_player(1)
+        court = Court.objects.create(name='court', address='address')
+        self.groups = [Group.objects.create(name='group %d' % n, organizer=self.organizer, court=court) for n in range(3)]
+        Membership.objects.create(group=self.groups[0], player=self.player, status=Membership.ADMIN)
+        Membership.objects.create(group=self.groups[1], player=self.player, status=Membership.PENDING)
+        self.events = [
+            Event.objects.create(initiator=self.organizer, court=court, group=group, is_public=False,
+                                 play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+            for group in self.groups
+        ]
+
+    def test_checks_share_one_query(self):
+        with self.assertNumQueries(1):
+            for event in self.events:
+                event.is_viewable_by(self.player)
+                event.can_edit_by(self.player)
+        self.assertTrue(self.events[0].can_edit_by(self.player))
+        self.assertFalse(self.events[1].is_viewable_by(self.player))
+
+    def test_batch_api(self):
+        resolver = MembershipResolver.for_user(self.player)
+        with self.assertNumQueries(3):  # memberships + one query per batch
+            self.assertEqual(resolver.viewable(Event.objects.all()), {self.events[0].id})
+            self.assertEqual(resolver.editable([e.id for e in self.events]), {self.events[0].id})
+
+    def test_visible_to_matches_can_view(self):
+        own = Event.objects.create(initiator=self.player, court=self.events[0].court, is_public=False,
+                                   play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+        visible = set(Event.objects.visible_to(self.player).values_list('id', flat=True))
+        self.assertEqual(visible, {self.events[0].id, own.id})
+        self.assertEqual(visible, MembershipResolver(self.player).viewable(Event.objects.all()))
+
+        self.client.force_login(self.player)
+        self.client.get(reverse('event-list'))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('event-list'))
+        self.assertEqual({e.id for e in response.context['event_list']}, visible)
+        self.assertEqual(self.client.get(reverse('event-detail', args=[self.events[1].id])).status_code, 403)
+        self.assertEqual(self.client.get(reverse('event-detail', args=[0])).status_code, 404)
+
+    def test_memberships_cached_until_changed(self):
+        MembershipResolver(self.player).memberships
+        with self.assertNumQueries(0):
+            self.assertTrue(MembershipResolver(self.player).is_member(self.groups[0].id))
+        Membership.objects.filter(group=self.groups[0], player=self.player).delete()
+        self.assertFalse(MembershipResolver(self.player).is_member(self.groups[0].id))
+
+
+class GroupRosterTest(TestCase):
+    def setUp(self):
+        self.organizer = create_player(0)
+        court = Court.objects.create(name='court', address='address')
+        self.group = Group.objects.create(name='group', organizer=self.organizer, court=court)
+        Membership.objects.create(group=self.group, player=self.organizer, status=Membership.ORGANIZER)
+        self.members = [create_player(n) for n in range(1, 13)]
+        for n, player in enumerate(self.members):
+            Membership.objects.create(group=self.group, player=player,
+                                      status=Membership.PENDING if n == 0 else Membership.MEMBER)
+
+    def test_detail_counts_only(self):
+        self.client.force_login(self.members[1])
+        response = self.client.get(reverse('group-detail', args=[self.group.id]))
+        self.assertEqual(response.context['roster_counts'], {'admins': 0, 'members': 11, 'pending': 1})
+        self.assertTrue(response.context['is_member'])
+        self.assertNotContains(response, str(self.members[2]))
+
+    def test_roster_pages(self):
+        self.client.force_login(self.members[1])
+        url = reverse('group-roster', args=[self.group.id, 'members'])
+        first = self.client.get(url)
+        second = self.client.get(url, {'cursor': first.context['page_obj'].next_cursor})
+        names = [m['player__first_name'] for m in first.context['memberships'] + second.context['memberships']]
+        self.assertEqual(names, [p.first_name for p in self.members[1:]])
+        self.assertEqual(self.client.get(reverse('group-roster', args=[self.group.id, 'pending'])).status_code, 403)
+        self.assertEqual(self.client.get(reverse('group-roster', args=[self.group.id, 'nobody'])).status_code, 404)
+
+        self.client.force_login(self.organizer)
+        response = self.client.get(reverse('group-roster', args=[self.group.id, 'pending']))
+        self.assertEqual([m['player__first_name'] for m in response.context['memberships']], [self.members[0].first_name])
+
+    def test_roster_follows_renames(self):
+        self.client.force_login(self.members[1])
+        url = reverse('group-roster', args=[self.group.id, 'members'])
+        self.client.get(url)
+        self.members[1].first_name = 'Renamed'
+        self.members[1].save()
+        self.assertEqual(self.client.get(url).context['memberships'][0]['player__first_name'], 'Renamed')
+
+
+class AdminTest(TestCase):
+    def setUp(self):
+        self.staff = Player.objects.create_superuser('staff@example.com', 'pw')
+        self.client.force_login(self.staff)
+        self.client.get('/admin/')
+        self.court = Court.objects.create(name='court', address='address')
+
+    def create_events(self, start, stop):
+        for n in range(start, stop):
+            player = create_player(n)
+            event = Event.objects.create(initiator=player, court=self.court, play_date=date(2099, 1, 1),
+                                         play_start_time=time(19, 0))
+            event.add_participant(player)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(captured)
+
+    def test_changelist_queries_do_not_grow(self):
+        urls = ['/admin/volleyball/event/', '/admin/volleyball/participation/']
+        self.create_events(0, 2)
+        few = [self.count_queries(url) for url in urls]
+        self.create_events(2, 12)
+        self.assertEqual([self.count_queries(url) for url in urls], few)
+
+    @override_settings(ADMIN_COUNT_LIMIT=3)
+    def test_filtered_count_is_capped(self):
+        self.create_events(0, 5)
+        response = self.client.get('/admin/volleyball/event/?is_expired__exact=0')
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_admin_keeps_counters(self):
+        organizer, player = create_player(0), create_player(1)
+        group = Group.objects.create(name='group', organizer=organizer, court=self.court)
+        group.add_member(organizer, Membership.ORGANIZER)
+        self.client.post('/admin/volleyball/membership/add/',
+                         {'group': group.id, 'player': player.id, 'status': Membership.PENDING})
+        membership = Membership.objects.get(player=player)
+        self.client.post('/admin/volleyball/membership/%d/change/' % membership.id, {'status': Membership.MEMBER})
+        group.refresh_from_db()
+        self.assertEqual((group.member_count, group.pending_count), (2, 0))
+        self.client.post('/admin/volleyball/membership/%d/delete/' % membership.id, {'post': 'yes'})
+        group.refresh_from_db()
+        self.assertEqual((group.member_count, group.pending_count), (1, 0))
+
+        event = Event.objects.create(initiator=organizer, court=self.court, play_date=date(2099, 1, 1),
+                                     play_start_time=time(19, 0), player_quota=1)
+        self.client.post('/admin/volleyball/participation/add/', {'event': event.id, 'player': organizer.id})
+        response = self.client.post('/admin/volleyball/participation/add/', {'event': event.id, 'player': player.id})
+        self.assertContains(response, 'This event is full.')
+        event.refresh_from_db()
+        self.assertEqual(event.participant_count, 1)
+
+    def test_admin_rejects_expired_event_and_lost_seat(self):
+        player = create_player(0)
+        url = '/admin/volleyball/participation/add/'
+        expired = Event.objects.create(initiator=player, court=self.court, play_date=date(2000, 1, 1),
+                                       play_start_time=time(19, 0), is_expired=True)
+        self.assertContains(self.client.post(url, {'event': expired.id, 'player': player.id}), 'This event has expired.')
+
+        event = Event.objects.create(initiator=player, court=self.court, play_date=date(2099, 1, 1),
+                                     play_start_time=time(19, 0))
+        # 表單檢查之後座位被別人搶走
+        with mock.patch.object(Event, 'add_participant', return_value=False):
+            response = self.client.post(url, {'event': event.id, 'player': player.id}, follow=True)
+        self.assertContains(response, 'This event is full or has expired.')
+        self.assertFalse(Participation.objects.exists())
+
+    def test_admin_rejects_duplicate_membership(self):
+        organizer = create_player(0)
+        group = Group.objects.create(name='group', organizer=organizer, court=self.court)
+        group.add_member(organizer, Membership.ORGANIZER)
+        response = self.client.post('/admin/volleyball/membership/add/',
+                                    {'group': group.id, 'player': organizer.id, 'status': Membership.MEMBER})
+        self.assertContains(response, 'This player is already in the group.')
+        self.assertEqual(Membership.objects.count(), 1)
+
+
+class NotificationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.organizer, self.member, self.applicant = create_player(0), create_player(1), create_player(2)
+        court = Court.objects.create(name='court', address='address')
+        self.group = Group.objects.create(name='group', organizer=self.organizer, court=court)
+        self.group.add_member(self.organizer, Membership.ORGANIZER)
+        self.group.add_member(self.member, Membership.MEMBER)
+        self.application = self.group.add_member(self.applicant, Membership.PENDING)
+        self.client.force_login(self.organizer)
+
+    def create_event(self, day):
+        self.client.post(reverse('group-event-create', args=[self.group.id]), {
+            'court': self.group.court_id, 'play_date': '2099-01-%02d' % day, 'play_start_time': '19:00',
+            'player_quota': 6, 'court_detail': '', 'play_detail': ''})
+
+    def test_outbox_is_drained_as_digests(self):
+        self.create_event(1)
+        self.assertEqual(list(Notification.objects.values_list('recipient', flat=True)), [self.member.id])
+        self.client.get(reverse('membership-member', args=[self.application.id]))
+        self.create_event(2)
+        self.assertEqual(queue_stats()['depth'], 4)
+        # 寄送交給背景工作，排隊中的只會有一個
+        self.assertEqual(Job.objects.filter(name='volleyball.notifications.drain').count(), 1)
+
+        batches = send_notifications(batch_size=1)
+
+        self.assertEqual([batch[:2] for batch in batches], [(2, 1), (2, 1)])
+        self.assertEqual([message.to for message in mail.outbox], [[self.member.email], [self.applicant.email]])
+        self.assertIn('2 new updates', mail.outbox[0].subject)
+        self.assertEqual(mail.outbox[0].body.count('group has a new event'), 2)
+        self.assertIn('You are now a member of group.', mail.outbox[1].body)
+        stats = queue_stats()
+        self.assertEqual((stats['depth'], stats['notifications'], stats['messages']), (0, 4, 2))
+
+    def test_console_backend(self):
+        self.create_event(1)
+        stream = io.StringIO()
+        send_notifications(connection=get_connection('django.core.mail.backends.console.EmailBackend', stream=stream))
+        self.assertIn('To: %s' % self.member.email, stream.getvalue())
+        self.assertFalse(Notification.objects.exists())
+
+
+class JobTest(TestCase):
+    def test_enqueue_dedups_and_claims_by_priority(self):
+        flaky.enqueue(1)
+        urgent = flaky.schedule(None, 2)
+        urgent.priority = 5
+        urgent.save()
+        self.assertEqual(flaky.enqueue(2), urgent)
+        flaky.schedule(datetime(2099, 1, 1), 3)
+
+        jobs = claim(10, worker='w1')
+        self.assertEqual([job.args for job in jobs], [[2], [1]])
+        self.assertEqual(claim(10, worker='w2'), [])
+        self.assertEqual(job_stats()['running'], 2)
+
+    def test_failures_back_off_then_stay_failed(self):
+        flaky.enqueue(0)
+        job, = claim(1)
+        with self.assertLogs('volleyball.jobs', 'ERROR'):
+            self.assertEqual(run_job(job), RETRY)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_at, datetime.now())
+        self.assertIn('ValueError', job.last_error)
+
+        Job.objects.update(run_at=datetime.now())
+        job, = claim(1)
+        with self.assertLogs('volleyball.jobs', 'ERROR'):
+            self.assertEqual(run_job(job), FAILED)
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+        self.assertEqual(claim(1), [])
+
+
+class JobWorkerTest(TransactionTestCase):
+    def test_group_is_disbanded_in_the_background(self):
+        organizer = create_player(0)
+        court = Court.objects.create(name='court', address='address')
+        group = Group.objects.create(name='group', organizer=organizer, court=court)
+        group.add_member(organizer, Membership.ORGANIZER)
+        for day in range(1, 6):
+            event = Event.objects.create(initiator=organizer, court=court, group=group, play_date=date(2099, 1, day),
+                                         play_start_time=time(19, 0))
+            event.add_participant(organizer)
+        for day in range(1, 4):
+            archived = ArchivedEvent.objects.create(id=100 + day, initiator=organizer, court=court, group=group,
+                                                    play_date=date(2000, 1, day), play_start_time=time(19, 0))
+            ArchivedParticipation.objects.create(id=100 + day, player=organizer, event=archived)
+            Notification.objects.create(recipient=organizer, kind=Notification.GROUP_EVENT, group=group)
+        self.client.force_login(organizer)
+        self.client.post(reverse('group-delete', args=[group.id]))
+        self.assertTrue(Group.objects.filter(pk=group.id).exists())
+
+        with self.settings(JOB_DELETE_BATCH_SIZE=2):
+            batches = list(Worker(workers=2).run(once=True))
+        self.assertEqual(batches[0][0][DONE], 1)
+        self.assertFalse(Group.objects.filter(pk=group.id).exists())
+        self.assertEqual((Event.objects.count(), Participation.objects.count(), Job.objects.count()), (0, 0, 0))
+        self.assertEqual((ArchivedEvent.objects.count(), ArchivedParticipation.objects.count(),
+                          Membership.objects.count(), Notification.objects.count()), (0, 0, 0, 0))
+        self.assertGreaterEqual(job_stats()[DONE], 1)
+
+    def test_enqueue_retries_when_the_waiting_duplicate_was_claimed(self):
+        first = delete_group.enqueue(1)
+        self.assertEqual(delete_group.enqueue(1).pk, first.pk)
+        claim(10)
+        # 排隊中的那筆被領走了，新排的要自己存進去
+        second = delete_group.enqueue(1)
+        self.assertNotEqual(second.pk, first.pk)
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+    def test_enqueue_gives_up_on_other_integrity_errors(self):
+        with mock.patch.object(Job, 'save', side_effect=IntegrityError('CHECK constraint failed')) as save:
+            with self.assertRaises(IntegrityError):
+                delete_group.enqueue(1)
+        self.assertEqual(save.call_count, 3)
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.initiator = create_player(0)
+        court = Court.objects.create(name='court', address='address', city=1)
+        self.event = Event.objects.create(initiator=self.initiator, court=court, play_date=date(2099, 1, 1),
+                                          play_start_time=time(19, 0))
+        group = Group.objects.create(name='group', organizer=self.initiator, court=court)
+        self.private_event = Event.objects.create(initiator=self.initiator, court=court, group=group, is_public=False,
+                                                  play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+
+    def test_not_modified_until_stamp_bumped(self):
+        url = reverse('api-event-detail', args=[self.event.id])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['court_name'], 'court')
+        self.assertEqual(response.json()['initiator_name'], 'P00 Test')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        self.event.add_participant(create_player(1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['players'], [{'id': self.event.participants.get().id, 'name': 'P01 Test'}])
+
+    def test_lists_and_permissions(self):
+        events = self.client.get(reverse('api-event-list')).json()
+        self.assertEqual([e['id'] for e in events['results']], [self.event.id])
+        self.assertIsNone(events['next'])
+        self.assertEqual(self.client.get(reverse('api-court-list'), {'city': 1}).json()['results'][0]['name'], 'court')
+        self.assertEqual(self.client.get(reverse('api-group-list')).json()['results'][0]['members'], 0)
+        self.assertEqual(self.client.get(reverse('api-event-detail', args=[self.private_event.id])).status_code, 403)
+        self.assertEqual(self.client.post(reverse('api-event-list')).status_code, 405)
+
+    def test_permission_is_checked_before_not_modified(self):
+        url = reverse('api-event-detail', args=[self.private_event.id])
+        member = create_player(1)
+        membership = self.private_event.group.add_member(member, Membership.MEMBER)
+        self.client.force_login(member)
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        membership.remove()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 403)
+        self.client.force_login(create_player(2))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 403)
+        self.assertEqual(self.client.get(reverse('api-event-detail', args=[0])).status_code, 404)
+
+
+class DashboardTest(TestCase):
+    def test_cached_until_player_or_group_changes(self):
+        cache.clear()
+        organizer, player = create_player(0), create_player(1)
+        court = Court.objects.create(name='court', address='address')
+        group = Group.objects.create(name='group', organizer=organizer, court=court)
+        Membership.objects.create(group=group, player=player, status=Membership.MEMBER)
+        public = Event.objects.create(initiator=organizer, court=court, play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+
+        with self.assertNumQueries(2):
+            dashboard = get_dashboard(player)
+        self.assertEqual(dashboard['groups'], [{'id': group.id, 'name': 'group'}])
+        self.assertEqual(dashboard['events'], [])
+        with self.assertNumQueries(0):
+            get_dashboard(player)
+
+        public.add_participant(player)
+        self.assertEqual([e['id'] for e in get_dashboard(player)['events']], [public.id])
+
+        group_event = Event.objects.create(initiator=organizer, court=court, group=group, is_public=False,
+                                           play_date=date(2099, 1, 2), play_start_time=time(19, 0))
+        self.assertEqual([e['id'] for e in get_dashboard(player)['group_events']], [group_event.id])
+
+        court.name = 'renamed'
+        court.save()
+        self.assertIn('renamed', get_dashboard(player)['group_events'][0]['label'])
+
+
+class CourtIndexTest(TestCase):
+    def setUp(self):
+        self.ntu = Court.objects.create(name='NTU', address='Taipei', city=1, latitude=25.0173, longitude=121.5397)
+        self.ntnu = Court.objects.create(name='NTNU', address='Taipei', city=1, latitude=25.0261, longitude=121.5276)
+        self.ncku = Court.objects.create(name='NCKU', address='Tainan', city=14, latitude=22.9969, longitude=120.2181)
+        court_index.invalidate()
+
+    def test_radius_and_city(self):
+        hits = court_index.within(25.0173, 121.5397, 5)
+        self.assertEqual([pk for pk, distance in hits], [self.ntu.pk, self.ntnu.pk])
+        self.assertLess(hits[1][1], 2)
+        self.assertEqual(court_index.in_city(14), [self.ncku.pk])
+
+    def test_events_near(self):
+        initiator = create_player(0)
+        near = Event.objects.create(initiator=initiator, court=self.ntnu, play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+        Event.objects.create(initiator=initiator, court=self.ncku, play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+        self.assertEqual(list(Event.objects.near(25.0173, 121.5397, 5)), [near])
+
+    def test_huge_or_invalid_radius(self):
+        # 格子只掃有球場的範圍，再大的km也馬上回來
+        self.assertEqual(len(court_index.within(25, 121, 100000)), 3)
+        self.client.force_login(create_player(0))
+        url = reverse('event-list')
+        self.assertEqual(self.client.get(url, {'lat': 25, 'lng': 121, 'km': 100000}).status_code, 200)
+        for km in ('nan', 'inf', '-1'):
+            self.assertEqual(self.client.get(url, {'lat': 25, 'lng': 121, 'km': km}).status_code, 404)
+
+    def test_name_search(self):
+        dajia = Court.objects.create(name='大佳河濱公園排球場', address='台北市中山區濱江街5號')
+        court_names.invalidate()
+        self.assertEqual([hit[0] for hit in court_names.search('nt')], [self.ntnu.pk, self.ntu.pk])
+        self.assertEqual([hit[0] for hit in court_names.search('ntu')], [self.ntu.pk])
+        self.assertEqual([hit[0] for hit in court_names.search('tainan')], [self.ncku.pk])
+        self.assertEqual(court_names.search('排球'), [(dajia.pk, dajia.name, dajia.address)])
+        self.assertEqual([hit[0] for hit in court_names.search('中山 公園')], [dajia.pk])
+        self.assertEqual(court_names.search('球公'), [])
+
+        court_names.update(Court(pk=self.ncku.pk, name='成大', address='台南市'))
+        self.assertEqual(court_names.search('ncku'), [])
+        self.assertEqual([hit[0] for hit in court_names.search('成')], [self.ncku.pk])
+        court_names.delete(dajia.pk)
+        self.assertEqual(court_names.search('排球'), [])
+
+    def test_create_forms_use_autocomplete(self):
+        court_names.invalidate()
+        self.client.force_login(create_player(0))
+        response = self.client.get(reverse('api-court-autocomplete'), {'q': 'tai'})
+        self.assertEqual([court['id'] for court in response.json()['results']],
+                         [self.ncku.pk, self.ntnu.pk, self.ntu.pk])
+
+        for url in (reverse('event-create'), reverse('group-create')):
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(url)
+            self.assertNotContains(response, '<option')
+            self.assertFalse([query for query in captured if 'volleyball_court' in query['sql']])
+
+        data = {'name': 'group', 'court': 0, 'about': ''}
+        self.assertFormError(self.client.post(reverse('group-create'), data), 'form', 'court',
+                             'Select a valid choice. That choice is not one of the available choices.')
+        data['court'] = self.ntu.pk
+        self.client.post(reverse('group-create'), data)
+        self.assertEqual(Group.objects.get().court, self.ntu)
+
+
+class CourtPhotoTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        media = self.settings(MEDIA_ROOT=self.directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        images._generated.clear()
+        buffer = io.BytesIO()
+        images.Image.effect_noise((2400, 1800), 64).convert('RGB').save(buffer, 'JPEG', quality=95)
+        self.original_size = buffer.tell()
+        self.court = Court.objects.create(name='court', address='address',
+                                          photo=SimpleUploadedFile('court.jpg', buffer.getvalue()))
+        self.client.force_login(create_player(0))
+
+    def test_derivatives_are_small_and_content_addressed(self):
+        self.assertEqual(len(self.court.photo_hash), 40)
+        images.generate_derivatives(self.court.photo.name, self.court.photo_hash)
+        for width in (160, 640, 1280):
+            for fmt in ('jpeg', 'webp'):
+                name = images.derivative_name(self.court.photo_hash, width, fmt)
+                with default_storage.open(name) as f:
+                    self.assertEqual(images.Image.open(f).size[0], width)
+        detail = default_storage.size(images.derivative_name(self.court.photo_hash, 640, 'jpeg'))
+        self.assertLess(detail * 10, self.original_size)
+
+        response = self.client.get(reverse('court-detail', args=[self.court.id]))
+        self.assertContains(response, '%s-640w.webp 640w' % self.court.photo_hash)
+        self.assertNotContains(response, self.court.photo.url)
+
+    def test_missing_size_is_rendered_once_on_request(self):
+        url = images.derivative_url(self.court.photo, self.court.photo_hash, 'thumb', 'webp')
+        self.assertEqual(url, reverse('court-photo', args=[self.court.photo_hash, 160, 'webp']))
+        args = (self.court.photo.name, self.court.photo_hash, 160, 'webp')
+        with mock.patch.object(images, '_render', wraps=images._render) as render:
+            # 其他thread看不到測試transaction裡的球場，直接呼叫
+            threads = [threading.Thread(target=images.ensure_derivative, args=args) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            images._generated.clear()
+            response = self.client.get(url)
+        self.assertEqual(render.call_count, 1)
+        self.assertRedirects(response, default_storage.url(images.derivative_name(self.court.photo_hash, 160, 'webp')),
+                             fetch_redirect_response=False)
+        self.assertEqual(self.client.get(reverse('court-photo', args=[self.court.photo_hash, 161, 'webp'])).status_code, 404)
+
+    def test_waiter_leaves_the_holders_lock_alone(self):
+        name = images.derivative_name(self.court.photo_hash, 160, 'webp')
+        lock = images._DerivativeLock(name)
+        # 別的worker拿著鎖
+        cache.set(lock.key, True)
+        with self.settings(IMAGE_LOCK_TIMEOUT=0):
+            with lock:
+                self.assertFalse(lock.acquired)
+        self.assertTrue(cache.get(lock.key))
+        cache.delete(lock.key)
+        with images._DerivativeLock(name) as lock:
+            self.assertTrue(lock.acquired)
+        self.assertIsNone(cache.get(lock.key))
+
+
+class ImportCourtsTest(TestCase):
+    def test_upserts_by_name_and_rejects_bad_rows(self):
+        Court.objects.create(name='NTU', address='old address')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'courts.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('name,address,city,latitude,longitude\n'
+                        'NTU,台北市大安區羅斯福路四段1號,,25.0173,121.5397\n'
+                        'NCKU,台南市東區大學路1號,臺南市,22.9969,120.2181\n'
+                        'Broken,somewhere,,north,121\n')
+            call_command('import_courts', path, batch_size=2, stdout=io.StringIO())
+            self.assertFalse(os.path.exists(path + '.progress'))
+
+        self.assertEqual(Court.objects.count(), 2)
+        ntu = Court.objects.get(name='NTU')
+        self.assertEqual((ntu.city, ntu.address), (1, '台北市大安區羅斯福路四段1號'))
+        self.assertEqual(Court.objects.get(name='NCKU').city, 14)
+
+    def test_resume_keeps_earlier_rejects(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, rejects = os.path.join(directory, 'courts.csv'), os.path.join(directory, 'rejects.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('name,address,city,latitude,longitude\n'
+                        'Broken,somewhere,,north,121\n'
+                        'NTU,台北市大安區羅斯福路四段1號,,25.0173,121.5397\n'
+                        'Also broken,somewhere,,25,east\n')
+            # 上一次跑到第2列就中斷了
+            with open(rejects, 'w', encoding='utf-8') as f:
+                f.write('1,bad latitude,{}\n')
+            with open(path + '.progress', 'w') as f:
+                json.dump({'rows': 2}, f)
+            call_command('import_courts', path, resume=True, rejects=rejects, stdout=io.StringIO())
+            with open(rejects, encoding='utf-8') as f:
+                self.assertEqual([line.split(',')[0] for line in f.read().splitlines()], ['1', '3'])
+
+    def test_malformed_features_are_rejected(self):
+        features = [
+            {'type': 'Feature', 'properties': {'name': 'NTU', 'address': 'Taipei'},
+             'geometry': {'type': 'Point', 'coordinates': [121.5397, 25.0173]}},
+            {'type': 'Feature', 'properties': {'name': 'No coordinates', 'address': 'A'}, 'geometry': {'type': 'Point'}},
+            {'type': 'Feature', 'properties': {'name': 'Bad coordinate', 'address': 'A'},
+             'geometry': {'type': 'Point', 'coordinates': ['east', 25]}},
+            {'type': 'Feature', 'properties': {'name': 42, 'address': 'A'}, 'geometry': None},
+            {'type': 'Feature', 'properties': 'oops'},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            geojson = os.path.join(directory, 'courts.geojson')
+            with open(geojson, 'w', encoding='utf-8') as f:
+                json.dump({'type': 'FeatureCollection', 'features': features}, f)
+            geojsonl = os.path.join(directory, 'courts.geojsonl')
+            with open(geojsonl, 'w', encoding='utf-8') as f:
+                f.write('{not json\n' + '\n'.join(json.dumps(feature) for feature in features[1:]) + '\n')
+            # geojsonl多一行不是JSON的
+            for path, rejected in ((geojson, 4), (geojsonl, 5)):
+                out = io.StringIO()
+                call_command('import_courts', path, stdout=out)
+                self.assertIn('%d rejected' % rejected, out.getvalue())
+            self.assertEqual(list(Court.objects.values_list('name', flat=True)), ['NTU'])
+
+            # 壞掉的feature不會讓buffer一直長到檔尾
+            with open(geojson, 'w', encoding='utf-8') as f:
+                f.write('{"features": [{"name": ' + 'x' * 1000 + ']}')
+            with mock.patch('volleyball.management.commands.import_courts.MAX_FEATURE_SIZE', 100):
+                with self.assertRaisesMessage(CommandError, 'Malformed GeoJSON feature'):
+                    call_command('import_courts', geojson, stdout=io.StringIO())
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.court = Court.objects.create(name='成功大學光復排球場', address='台南市東區大學路1號', city=14)
+        self.group = Group.objects.create(name='Friday Spikers', organizer=create_player(0), court=self.court,
+                                          about='每週五晚上在光復打球')
+
+    def test_tokenize_cjk_bigrams(self):
+        self.assertEqual(tokenize('排球場 Net'), ['排球', '球場', '場', 'net'])
+
+    def test_tokenize_mixed_scripts(self):
+        self.assertEqual(tokenize('NTU排球場'), ['ntu', '排球', '球場', '場'])
+        self.assertEqual(tokenize('第3號球場'), ['第', '3', '號球', '球場', '場'])
+        ntu = Court.objects.create(name='NTU排球場', address='台北')
+        self.assertIn(('court', ntu.id), search_ids('排球'))
+
+    def test_ranked_cjk_and_prefix_search(self):
+        self.assertEqual(search_ids('光復')[0], ('court', self.court.id))
+        self.assertIn(('group', self.group.id), search_ids('光復'))
+        self.assertEqual(search_ids('spik'), [('group', self.group.id)])
+        self.assertEqual(search_ids('光復', kind='group'), [('group', self.group.id)])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.group.about = 'moved'
+        self.group.save()
+        self.assertEqual(search_ids('光復'), [('court', self.court.id)])
+        self.court.delete()
+        self.assertEqual(search_ids('光復'), [])
+
+    def test_expired_and_archived_events_leave_index(self):
+        initiator = create_player(1)
+        events = [Event.objects.create(initiator=initiator, court=self.court, play_date=date(2000, 1, 1),
+                                       play_start_time=time(19, 0), play_detail='光復夜排') for _ in range(2)]
+        self.assertEqual(len(search_ids('夜排', kind='event')), 2)
+        expire_past_events()
+        self.assertEqual(search_ids('夜排', kind='event'), [])
+
+        # 之前就已經過期、還留在索引裡的活動，封存時也會拿掉
+        search.index_objects([Event(pk=events[0].pk, initiator=initiator, court=self.court, play_date=date(2000, 1, 1),
+                                    play_start_time=time(19, 0), play_detail='光復夜排')])
+        archive_events(horizon_days=0)
+        self.assertEqual(search_ids('夜排', kind='event'), [])
+
+
+class BenchmarkTest(TestCase):
+    def test_generate_and_benchmark(self):
+        counts = generate_load_data(players=60, courts=5, groups=4, events=40, max_group_size=30)
+        self.assertEqual(Event.objects.count(), counts['events'])
+        self.assertEqual(Participation.objects.count(), counts['participations'])
+
+        report = run_benchmarks(iterations=2, warmup=1)
+        self.assertEqual(set(report), {'index', 'event_list', 'event_detail', 'group_detail', 'group_roster', 'event_signup'})
+        self.assertEqual(compare(report, report), [])
+        baseline = {'index': dict(report['index'], queries=report['index']['queries'] - 1)}
+        self.assertEqual(len(compare(report, baseline)), 1)
+        # 時間和記憶體看機器，預設不比
+        slower = {name: dict(result, p90_ms=result['p90_ms'] * 10) for name, result in report.items()}
+        self.assertEqual(compare(slower, report), [])
+        self.assertEqual(len(compare(slower, report, timing=True)), len(report))
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        registry.reset()
+        self.player = create_player(1)
+        self.court = Court.objects.create(name='C', address='A')
+        for n in range(6):
+            Event.objects.create(initiator=self.player, court=self.court, play_date=date.today(),
+                                 play_start_time=time(19, 0))
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'it''s'"),
+                         'SELECT * FROM t WHERE id = ? AND name = ?')
+        self.assertEqual(fingerprint('SELECT * FROM t WHERE id IN (%s, %s, %s)'), 'SELECT * FROM t WHERE id IN (...)')
+
+    def test_records_views_and_flags_repeated_queries(self):
+        self.client.force_login(self.player)
+        self.client.get(reverse('event-list'))
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['views']['event-list']['latency_ms']['count'], 1)
+        self.assertEqual(snapshot['n_plus_one'], [])
+
+        with self.settings(ROOT_URLCONF='volleyball.tests'), self.assertLogs('volleyball.instrumentation', 'WARNING'):
+            self.client.get('/n-plus-one/')
+        suspect, = registry.snapshot()['n_plus_one']
+        self.assertEqual(suspect['view'], 'n-plus-one')
+        self.assertEqual(suspect['max_repeats'], 6)
+        self.assertIn('volleyball/tests.py', suspect['call_site'])
+
+    def test_metrics_is_staff_only(self):
+        self.client.force_login(self.player)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 302)
+        self.player.is_staff = True
+        self.player.save()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('views', response.json())
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 用另一個SQLite檔當副本，靠sync_replicas複製；在setUpClass之後才加，不會被當成禁止查詢的資料庫
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.databases['replica'] = dict(connections['default'].settings_dict,
+                                                NAME=os.path.join(cls.directory.name, 'replica.sqlite3'))
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        health.reset()
+        registry.reset()
+        self.organizer = create_player(0)
+        self.player = create_player(1)
+        self.court = Court.objects.create(name='old name', address='address')
+        self.group = Group.objects.create(name='group', organizer=self.organizer, court=self.court)
+        self.group.add_member(self.organizer, Membership.ORGANIZER)
+        call_command('sync_replicas', stdout=io.StringIO())
+        self.client.force_login(self.organizer)
+
+    def test_reads_lag_until_synced(self):
+        Court.objects.filter(pk=self.court.pk).update(name='new name')
+        self.assertContains(self.client.get(reverse('court-detail', args=[self.court.pk])), 'old name')
+        call_command('sync_replicas', stdout=io.StringIO())
+        self.assertContains(self.client.get(reverse('court-detail', args=[self.court.pk])), 'new name')
+        self.assertIn('replica', registry.snapshot()['databases'])
+
+    def test_writer_reads_own_writes(self):
+        self.client.force_login(self.player)
+        self.client.get(reverse('group-join', args=[self.group.pk]))
+        self.assertContains(self.client.get(reverse('group-detail', args=[self.group.pk])), 'cancel application')
+        # 其他人還是讀副本，看不到
+        self.client.force_login(self.organizer)
+        self.assertContains(self.client.get(reverse('group-detail', args=[self.group.pk])),
+                            '<span data-section="pending">0</span>')
+
+    def test_unhealthy_replica_falls_back(self):
+        connections['replica'].close()
+        settings_dict = connections['replica'].settings_dict
+        name, settings_dict['NAME'] = settings_dict['NAME'], os.path.join(self.directory.name, 'missing', 'db')
+        try:
+            Court.objects.filter(pk=self.court.pk).update(name='new name')
+            with self.assertLogs('volleyball.routers', 'WARNING'):
+                response = self.client.get(reverse('court-detail', args=[self.court.pk]))
+            self.assertContains(response, 'new name')
+            self.assertFalse(health.snapshot()['replica']['healthy'])
+        finally:
+            settings_dict['NAME'] = name
+
+
+class LiveTest(TransactionTestCase):
+    def setUp(self):
+        self.initiator = create_player(0)
+        self.player = create_player(1)
+        court = Court.objects.create(name='court', address='address')
+        self.event = Event.objects.create(initiator=self.initiator, court=court, player_quota=6,
+                                          play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+        self.group = group = Group.objects.create(name='group', organizer=self.initiator, court=court)
+        self.private_event = Event.objects.create(initiator=self.initiator, court=court, group=group, is_public=False,
+                                                  play_date=date(2099, 1, 1), play_start_time=time(19, 0))
+
+    def stream(self, path, write=None, user=None):
+        """Open an SSE stream as `user`; once subscribed run `write` in a thread and return after the first event."""
+        self.client.force_login(user or self.player)
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+        async def run():
+            sent, disconnect = [], asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                body = message.get('body', b'')
+                if body.startswith(b'retry') and write:
+                    asyncio.get_running_loop().run_in_executor(None, write)
+                elif body.startswith(b'event:'):
+                    disconnect.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': path, 'headers': [(b'cookie', cookie.encode())]}
+            await asyncio.wait_for(live_application(None)(scope, receive, send), 5)
+            return sent
+
+        return asyncio.run(run())
+
+    def test_signup_is_pushed_to_watchers(self):
+        sent = self.stream('/live/event/%d' % self.event.id, lambda: self.event.add_participant(self.player))
+        self.assertEqual(sent[0]['status'], 200)
+        name, data = sent[-1]['body'].decode().split('\n')[:2]
+        self.assertEqual(name, 'event: participants')
+        self.assertEqual(json.loads(data[len('data: '):]), {
+            'action': 'joined', 'player': self.player.id, 'name': 'P01 Test',
+            'participant_count': 1, 'player_quota': 6,
+        })
+
+    def test_private_event_is_forbidden(self):
+        sent = self.stream('/live/event/%d' % self.private_event.id)
+        self.assertEqual(sent[0]['status'], 403)
+
+    def roster_change(self, user):
+        def write():
+            self.group.add_member(create_player(2), Membership.PENDING)
+            self.group.add_member(create_player(3), Membership.MEMBER)
+
+        sent = self.stream('/live/group/%d' % self.group.id, write, user)
+        name, data = sent[-1]['body'].decode().split('\n')[:2]
+        self.assertEqual(name, 'event: roster')
+        return json.loads(data[len('data: '):])
+
+    def test_pending_applicants_go_only_to_moderators(self):
+        self.group.add_member(self.initiator, Membership.ORGANIZER)
+        change = self.roster_change(self.initiator)
+        self.assertEqual((change['to'], change['name']), ('pending', None))
+        Player.objects.filter(email__in=['p02@example.com', 'p03@example.com']).delete()
+        # 不是管理員的只收到正式成員加入
+        change = self.roster_change(self.player)
+        self.assertEqual((change['to'], change['name']), ('members', 'P03 Test'))
+
+    def test_file_spool_backend(self):
+        hub = Hub()
+        hub.dispatch = lambda topic, message: received.append((topic, message))
+        received = []
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'live.spool')
+            publisher, tail = FileSpoolBackend(hub, path), FileSpoolBackend(hub, path)
+            publisher.publish('event:1', {'kind': 'participants', 'data': {}})
+            self.assertEqual(tail.poll(), 0)
+            publisher.publish('event:1', {'kind': 'participants', 'data': {'n': 1}})
+            publisher.publish('group:2', {'kind': 'roster', 'data': {}})
+            self.assertEqual(tail.poll(), 2)
+        self.assertEqual(received, [('event:1', {'kind': 'participants', 'data': {'n': 1}}),
+                                    ('group:2', {'kind': 'roster', 'data': {}})])
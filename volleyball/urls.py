@@ -1,21 +1,36 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from . import views
+from . import api, views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('search/', views.search, name='search'),
+    path('metrics/', views.metrics, name='metrics'),
+]
+
+urlpatterns += [
+    path('api/courts/', api.court_list, name='api-court-list'),
+    path('api/courts/<int:pk>', api.court_detail, name='api-court-detail'),
+    path('api/courts/autocomplete', api.court_autocomplete, name='api-court-autocomplete'),
+    path('api/groups/', api.group_list, name='api-group-list'),
+    path('api/groups/<int:pk>', api.group_detail, name='api-group-detail'),
+    path('api/events/', api.event_list, name='api-event-list'),
+    path('api/events/<int:pk>', api.event_detail, name='api-event-detail'),
 ]
 
 urlpatterns += [
     path('courts/', views.CourtListView.as_view(), name='court-list'),
     path('court/create/', views.CourtCreateView.as_view(), name='court-create'),
     path('court/<int:pk>', views.CourtDetailView.as_view(), name='court-detail'),
+    path('court/photo/<str:digest>/<int:width>.<str:extension>', views.court_photo, name='court-photo'),
 ]
 
 urlpatterns += [
     path('groups/', views.GroupListView.as_view(), name='group-list'),
     path('group/create/', views.GroupCreateView.as_view(), name='group-create'),
     path('group/<int:pk>', views.GroupDetailView.as_view(), name='group-detail'),
+    path('group/<int:pk>/members/<str:status>', views.GroupRosterView.as_view(), name='group-roster'),
+    path('group/<int:pk>/history', views.GroupHistoryView.as_view(), name='group-history'),
     path('group/<int:pk>/update', views.GroupUpdateView.as_view(), name='group-update'),
     path('group/<int:pk>/delete', views.GroupDeleteView.as_view(), name='group-delete'),
     path('group/<int:pk>/join', views.group_join, name='group-join'),
@@ -28,6 +43,7 @@ urlpatterns += [
 
 urlpatterns += [
     path('events/', views.EventListView.as_view(), name='event-list'),
+    path('events/history/', views.EventHistoryView.as_view(), name='event-history'),
     path('event/create/', views.EventCreateView.as_view(), name='event-create'),
     path('event/<int:pk>', views.EventDetailView.as_view(), name='event-detail'),
     path('event/<int:pk>/update', views.EventUpdateView.as_view(), name='event-update'),
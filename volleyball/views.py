@@ -1,32 +1,66 @@
+import math
 from datetime import datetime
 
 from django.conf import settings
+from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.files.storage import default_storage
+from django.core.paginator import Paginator
 from django.db import transaction
-from django.db.models import Prefetch, Q
-from django.http import HttpResponseRedirect, HttpResponseForbidden
+from django.http import Http404, HttpResponseRedirect, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse_lazy
 from django.views import generic
 from django.views.generic import UpdateView, CreateView
-from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext_lazy as _
 
-from .forms import PlayerCreationForm, EventCreateForm, GroupEventCreateForm
+from . import images
+from .archive import event_history
+from .caching import CachedListingMixin, fragment_context
+from .dashboard import get_dashboard
+from .forms import PlayerCreationForm, GroupCreateForm, EventCreateForm, GroupEventCreateForm
+from .instrumentation import registry
+from .jobs import delete_group, job_stats
+from .live import live_url
 from .models import Player, Court, Event, Group, Membership, Participation
+from .notifications import notify_group_event, queue_stats
+from .pagination import KeysetPaginationMixin
+from .permissions import MembershipResolver
+from .routers import ReplicaReadMixin, health
+from .search import KINDS, search_ids, hydrate
 
 
 def index(request):
     context = {}
     if request.user.is_authenticated:
-        context['events'] = Event.objects.get_valid().filter(Q(participants=request.user) | Q(initiator=request.user)).distinct()
-        context['groups'] = Group.get_joined_by_player_id(request.user.id)
-        if len(context['groups']) > 0:
-            context['group_events'] = Event.objects.get_valid().filter(group__in=[g.id for g in context['groups']])
+        context.update(get_dashboard(request.user))
     return render(request, 'volleyball/index.html', context=context)
 
 
+def search(request):
+    query = request.GET.get('q', '').strip()
+    kind = request.GET.get('kind') if request.GET.get('kind') in KINDS else None
+    paginator = Paginator(search_ids(query, kind) if query else [], settings.PAGINATE_BY)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    context = {
+        'query': query,
+        'kind': kind,
+        'kinds': KINDS,
+        'search_page': page_obj,
+        'results': hydrate(page_obj.object_list),
+    }
+    return render(request, 'volleyball/search.html', context=context)
+
+
+@staff_member_required
+def metrics(request):
+    return JsonResponse(dict(registry.snapshot(), replicas=health.snapshot(), notifications=queue_stats(),
+                             jobs=job_stats()))
+
+
 class PlayerCreateView(CreateView):
     model = Player
     form_class = PlayerCreationForm
@@ -44,70 +78,143 @@ class PlayerUpdateView(LoginRequiredMixin, UpdateView):
         return self.request.user
 
 
-class CourtListView(generic.ListView):
+class CourtListView(ReplicaReadMixin, CachedListingMixin, generic.ListView):
     model = Court
+    ordering = ['name']
     paginate_by = settings.PAGINATE_BY
+    listing_version = 'court-list'
+    listing_params = ('city',)
+    listing_fields = ('id', 'name', 'photo', 'photo_hash')
 
     def get_queryset(self):
-        courts = cache.get('courts')
-        if courts is None:
-            courts = Court.objects.all()
-            cache.set('courts', courts)
-        return courts
+        queryset = super().get_queryset()
+        if self.request.GET.get('city'):
+            try:
+                queryset = queryset.filter(city=int(self.request.GET['city']))
+            except ValueError:
+                raise Http404
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['city_choices'] = Court.CITY_CHOICES
+        return context
 
 
 class CourtCreateView(LoginRequiredMixin, generic.CreateView):
     model = Court
-    fields = ['name', 'address']
+    fields = ['name', 'city', 'address', 'latitude', 'longitude', 'photo']
     # fields = '__all__'
 
 
-class CourtDetailView(generic.DetailView):
+class CourtDetailView(ReplicaReadMixin, generic.DetailView):
     model = Court
 
 
-class GroupListView(generic.ListView):
+def court_photo(request, digest, width, extension):
+    """Render a missing photo derivative on first request, then send the browser to the file."""
+    fmt = images.EXTENSIONS.get(extension)
+    if fmt is None or width not in settings.IMAGE_SIZES.values():
+        raise Http404
+    source = Court.objects.filter(photo_hash=digest).values_list('photo', flat=True).first()
+    if not source:
+        raise Http404
+    return HttpResponseRedirect(default_storage.url(images.ensure_derivative(source, digest, width, fmt)))
+
+
+class GroupListView(ReplicaReadMixin, CachedListingMixin, generic.ListView):
     model = Group
+    ordering = ['name']
     paginate_by = settings.PAGINATE_BY
+    listing_version = 'group-list'
+    listing_fields = ('id', 'name', 'member_count')
 
-    def get_queryset(self):
-        groups = cache.get('groups')
-        if groups is None:
-            groups = Group.objects.all()
-            cache.set('groups', groups)
-        return groups
 
+def membership_flags(membership):
+    """is_organizer / is_admin / is_member / is_pending template flags for the viewer's membership."""
+    if membership is None:
+        return {}
+    is_XXX = {
+        Membership.ORGANIZER: 'is_organizer',
+        Membership.ADMIN: 'is_admin',
+        Membership.MEMBER: 'is_member',
+        Membership.PENDING: 'is_pending',
+    }[membership.status]
+    return {is_XXX: True}
 
-class GroupDetailView(generic.DetailView):
-    queryset = Group.objects.select_related('organizer').select_related('court').prefetch_related(
-        Prefetch('members', queryset=Membership.objects.select_related('player'))
-    )
+
+class GroupDetailView(ReplicaReadMixin, generic.DetailView):
+    queryset = Group.objects.select_related('organizer').select_related('court')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        # 兩個都是lazy的，片段快取命中時不會查詢；名單另外分頁載入，這裡只算各身分人數
         context['events'] = Event.objects.get_valid().filter(group=self.object)
+        context['roster_counts'] = SimpleLazyObject(lambda: Membership.roster_counts(self.object.id))
+        membership = MembershipResolver.for_user(self.request.user).get(self.object.id)
+        context.update(membership_flags(membership))
+        context['can_moderate'] = membership is not None and membership.is_admin
+        context.update(fragment_context('group:%d' % self.object.id, 'court-list', 'event-expiry', 'player-names'))
+        context['live_url'] = live_url('group', self.object.id)
+        return context
+
 
-        memberships = self.object.members.all()
-        context['pending_memberships'] = [m for m in memberships if m.status == Membership.PENDING]
-        context['member_memberships'] = [m for m in memberships if m.status == Membership.MEMBER]
-        context['admin_memberships'] = [m for m in memberships if m.status == Membership.ADMIN]
-
-        status = next((m.status for m in memberships if m.player == self.request.user), None)
-        if status != None:
-            is_XXX = {
-                Membership.ORGANIZER: 'is_organizer',
-                Membership.ADMIN: 'is_admin',
-                Membership.MEMBER: 'is_member',
-                Membership.PENDING: 'is_pending',
-            }[status]
-            context[is_XXX] = True
+class GroupRosterView(ReplicaReadMixin, CachedListingMixin, generic.ListView):
+    """
+    One status section of a group's roster, keyset-paginated on the (group, status, id) index
+    and cached until the group's version stamp is bumped.
+    """
+    template_name = 'volleyball/group_roster.html'
+    context_object_name = 'memberships'
+    paginate_by = settings.PAGINATE_BY
+    ordering = ['id']
+    listing_fields = ('id', 'player__first_name', 'player__last_name')
+
+    def get(self, request, *args, **kwargs):
+        if kwargs['status'] not in Membership.ROSTER_SECTIONS:
+            raise Http404
+        self.group = get_object_or_404(Group.objects.only('id', 'name'), pk=kwargs['pk'])
+        self.membership = MembershipResolver.for_user(request.user).get(self.group.id)
+        if kwargs['status'] == 'pending' and not (self.membership and self.membership.is_admin):
+            return HttpResponseForbidden()
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return Membership.objects.filter(group=self.group, status=Membership.ROSTER_SECTIONS[self.kwargs['status']])
+
+    def get_listing_version(self):
+        # 名單上有名字，改名也要失效
+        return 'group:%d' % self.group.id, 'player-names'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['group'] = self.group
+        context['status'] = self.kwargs['status']
+        context.update(membership_flags(self.membership))
+        return context
+
+
+class GroupHistoryView(ReplicaReadMixin, KeysetPaginationMixin, generic.ListView):
+    """A group's finished events, archived ones included; non-members only see the public ones."""
+    template_name = 'volleyball/event_history.html'
+    context_object_name = 'events'
+    paginate_by = settings.PAGINATE_BY
+    ordering = ['-play_date', '-play_start_time', '-id']
+
+    def get_queryset(self):
+        self.group = get_object_or_404(Group.objects.only('id', 'name'), pk=self.kwargs['pk'])
+        membership = MembershipResolver.for_user(self.request.user).get(self.group.id)
+        return event_history(group=self.group, public_only=not (membership and membership.is_member))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['title'] = _('Past events of %s') % self.group.name
         return context
 
 
 class GroupCreateView(LoginRequiredMixin, generic.CreateView):
     model = Group
-    fields = ['name', 'court', 'about']
+    form_class = GroupCreateForm
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -120,7 +227,7 @@ class GroupCreateView(LoginRequiredMixin, generic.CreateView):
                 self.object = form.save(commit=False)
                 self.object.organizer = self.request.user
                 self.object.save()
-                self.object.members.add(self.request.user, through_defaults={'status': Membership.ORGANIZER})
+                self.object.add_member(self.request.user, Membership.ORGANIZER)
         except:
             return HttpResponseForbidden()
         return HttpResponseRedirect(self.get_success_url())
@@ -160,7 +267,9 @@ class GroupDeleteView(LoginRequiredMixin, generic.DeleteView):
         self.object = self.get_object()
         if self.object.organizer != self.request.user:
             return HttpResponseForbidden()
-        self.object.delete()
+        # 活動、名單可能很多，交給背景工作分批刪
+        delete_group.enqueue(self.object.pk)
+        messages.info(request, _('The group will be disbanded shortly.'))
         success_url = self.get_success_url()
         return HttpResponseRedirect(success_url)
 
@@ -168,8 +277,7 @@ class GroupDeleteView(LoginRequiredMixin, generic.DeleteView):
 @login_required
 def group_join(request, pk):
     group = get_object_or_404(Group, pk=pk)
-    membership = Membership.objects.create(player=request.user, group=group, status=Membership.PENDING)
-    membership.save()
+    group.add_member(request.user, Membership.PENDING)
     return HttpResponseRedirect(reverse_lazy('group-detail', args=[pk]))
 
 
@@ -178,7 +286,7 @@ def group_quit(request, pk):
     group = get_object_or_404(Group, pk=pk)
     if group.organizer == request.user:
         return HttpResponseForbidden()
-    group.members.remove(request.user)
+    group.remove_member(request.user)
     return HttpResponseRedirect(reverse_lazy('group-detail', args=[pk]))
 
 
@@ -198,10 +306,11 @@ class GroupEventCreateView(LoginRequiredMixin, generic.CreateView):
             self.object = form.save(commit=False)
             self.object.initiator = self.request.user
             group = get_object_or_404(Group, pk=self.kwargs['pk'])
-            membership = Membership.objects.get(group=group, player=self.request.user)
-            assert membership.is_member
+            assert MembershipResolver.for_user(self.request.user).is_member(group.id)
             self.object.group = group
-            self.object.save()
+            with transaction.atomic():
+                self.object.save()
+                notify_group_event(self.object)
             return HttpResponseRedirect(self.get_success_url())
         except:
             return HttpResponseForbidden()
@@ -211,14 +320,16 @@ class GroupEventCreateView(LoginRequiredMixin, generic.CreateView):
 def membership_delete(request, pk):
     target_membership = get_object_or_404(Membership, pk=pk)
     origin_status = target_membership.status
-    user_membership = get_object_or_404(Membership, group=target_membership.group, player=request.user)
+    user_membership = MembershipResolver.for_user(request.user).get(target_membership.group_id)
+    if user_membership is None:
+        raise Http404
     if any([
         origin_status in [Membership.PENDING, Membership.MEMBER] and not user_membership.is_admin,
         origin_status in [Membership.ADMIN] and not user_membership.is_organizer,
         origin_status in [Membership.ORGANIZER],
     ]): return HttpResponseForbidden()
 
-    target_membership.delete()
+    target_membership.remove()
     return HttpResponseRedirect(reverse_lazy('group-detail', args=[target_membership.group_id]))
 
 
@@ -226,15 +337,16 @@ def membership_delete(request, pk):
 def membership_to_member(request, pk):
     target_membership = get_object_or_404(Membership, pk=pk)
     origin_status = target_membership.status
-    user_membership = get_object_or_404(Membership, group=target_membership.group, player=request.user)
+    user_membership = MembershipResolver.for_user(request.user).get(target_membership.group_id)
+    if user_membership is None:
+        raise Http404
     if any([
         origin_status in [Membership.PENDING] and not user_membership.is_admin,
         origin_status in [Membership.ADMIN] and not user_membership.is_organizer,
         origin_status in [Membership.ORGANIZER],
     ]): return HttpResponseForbidden()
 
-    target_membership.status = Membership.MEMBER
-    target_membership.save()
+    target_membership.set_status(Membership.MEMBER)
     return HttpResponseRedirect(reverse_lazy('group-detail', args=[target_membership.group_id]))
 
 
@@ -242,35 +354,85 @@ def membership_to_member(request, pk):
 def membership_to_admin(request, pk):
     target_membership = get_object_or_404(Membership, pk=pk)
     origin_status = target_membership.status
-    user_membership = get_object_or_404(Membership, group=target_membership.group, player=request.user)
+    user_membership = MembershipResolver.for_user(request.user).get(target_membership.group_id)
+    if user_membership is None:
+        raise Http404
     if any([
         origin_status in [Membership.ORGANIZER],
         not user_membership.is_organizer,
     ]): return HttpResponseForbidden()
 
-    target_membership.status = Membership.ADMIN
-    target_membership.save()
+    target_membership.set_status(Membership.ADMIN)
     return HttpResponseRedirect(reverse_lazy('group-detail', args=[target_membership.group_id]))
 
 
-class EventListView(generic.ListView):
-    queryset = Event.objects.get_valid().get_public()
+def filter_events(queryset, params):
+    """Apply the lat/lng/km and city filters of the event list to `queryset`."""
+    try:
+        if 'lat' in params:
+            latitude, longitude = float(params['lat']), float(params['lng'])
+            km = float(params.get('km', settings.NEAR_DISTANCE_KM))
+            if not all(map(math.isfinite, (latitude, longitude, km))) or km < 0:
+                raise ValueError
+            queryset = queryset.near(latitude, longitude, min(km, settings.NEAR_MAX_DISTANCE_KM))
+        if params.get('city'):
+            queryset = queryset.in_city(int(params['city']))
+    except (KeyError, ValueError):
+        raise Http404
+    return queryset
+
+
+class EventListView(ReplicaReadMixin, KeysetPaginationMixin, generic.ListView):
+    queryset = Event.objects.get_valid()
     paginate_by = settings.PAGINATE_BY
 
+    def get_queryset(self):
+        # 公開的、自己開的、所屬球團的活動，一個查詢
+        return filter_events(super().get_queryset().visible_to(self.request.user), self.request.GET)
+
 
-class EventDetailView(generic.DetailView):
-    queryset = Event.objects.select_related('initiator').select_related('court').prefetch_related('participants')
+class EventDetailView(ReplicaReadMixin, generic.DetailView):
+    queryset = Event.objects.select_related('initiator')
+
+    def get_queryset(self):
+        return super().get_queryset().visible_to(self.request.user)
 
     def get(self, request, *args, **kwargs):
-        self.object = self.get_object()
-        if not self.object.is_viewable_by(request.user):
-            return HttpResponseForbidden()
+        try:
+            self.object = self.get_object()
+        except Http404:
+            # 看不到的活動維持403，只有真的不存在才404
+            if Event.objects.filter(pk=kwargs['pk']).exists():
+                return HttpResponseForbidden()
+            raise
         context = self.get_context_data(object=self.object)
         return self.render_to_response(context)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['can_edit'] = self.object.can_edit_by(self.request.user)
+        user = self.request.user
+        context['can_edit'] = self.object.can_edit_by(user)
+        # 參加者名單在快取片段裡，這裡只查看的人自己有沒有報名
+        context['is_participant'] = user.is_authenticated and Participation.objects.filter(
+            event=self.object, player=user).exists()
+        context.update(fragment_context('event:%d' % self.object.id, 'court-list', 'player-names'))
+        context['live_url'] = live_url('event', self.object.id)
+        return context
+
+
+class EventHistoryView(LoginRequiredMixin, ReplicaReadMixin, KeysetPaginationMixin, generic.ListView):
+    """Finished events the player took part in, archived ones included."""
+    template_name = 'volleyball/event_history.html'
+    context_object_name = 'events'
+    paginate_by = settings.PAGINATE_BY
+    ordering = ['-play_date', '-play_start_time', '-id']
+
+    def get_queryset(self):
+        return event_history(player=self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['title'] = _('My past events')
         return context
 
 
@@ -325,19 +487,15 @@ class EventDeleteView(LoginRequiredMixin, generic.DeleteView):
 @login_required
 def event_signup(request, pk):
     event = get_object_or_404(Event.objects.get_valid(), pk=pk)
-    participants = list(Participation.objects.filter(event=event))
-    if any([
-        not event.is_viewable_by(request.user),
-        len(participants) == event.player_quota,
-    ]): return HttpResponseForbidden()
-    if request.user not in participants:
-        event.participants.add(request.user)
+    if not event.is_viewable_by(request.user):
+        return HttpResponseForbidden()
+    if not event.add_participant(request.user):
+        messages.warning(request, _('This event is full.'))
     return HttpResponseRedirect(reverse_lazy('event-detail', args=[pk]))
 
 
 @login_required
 def event_quit(request, pk):
     event = get_object_or_404(Event.objects.get_valid(), pk=pk)
-    if request.user in event.participants.all():
-        event.participants.remove(request.user)
+    event.remove_participant(request.user)
     return HttpResponseRedirect(reverse_lazy('event-detail', args=[pk]))